@@ -109,7 +109,7 @@ cps_err_t dxl_servo_move_velocity(movedata_t data);
  *
  * @param data TODO
  * @param count TODO
- * @arraysize data count
+ * @arraysize data count max DXL_MAX_SERVOS
  */
 cps_err_t dxl_servo_move_many_abs(movedata_t data[], size_t count);
 
@@ -117,7 +117,7 @@ cps_err_t dxl_servo_move_many_abs(movedata_t data[], size_t count);
  *
  * @param data TODO
  * @param count TODO
- * @arraysize data count
+ * @arraysize data count max DXL_MAX_SERVOS
  */
 cps_err_t dxl_servo_move_many_duration_abs(movedata_t data[], size_t count);
 
@@ -125,7 +125,7 @@ cps_err_t dxl_servo_move_many_duration_abs(movedata_t data[], size_t count);
  *
  * @param data TODO
  * @param count TODO
- * @arraysize data count
+ * @arraysize data count max DXL_MAX_SERVOS
  */
 cps_err_t dxl_servo_move_many_velocity_abs(movedata_t data[], size_t count);
 
@@ -134,7 +134,7 @@ cps_err_t dxl_servo_move_many_velocity_abs(movedata_t data[], size_t count);
  *
  * @param data TODO
  * @param count TODO
- * @arraysize data count
+ * @arraysize data count max DXL_MAX_SERVOS
  */
 cps_err_t dxl_servo_move_many(movedata_t data[], size_t count);
 
@@ -142,7 +142,7 @@ cps_err_t dxl_servo_move_many(movedata_t data[], size_t count);
  *
  * @param data TODO
  * @param count TODO
- * @arraysize data count
+ * @arraysize data count max DXL_MAX_SERVOS
  */
 cps_err_t dxl_servo_move_many_duration(movedata_t data[], size_t count);
 
@@ -150,7 +150,7 @@ cps_err_t dxl_servo_move_many_duration(movedata_t data[], size_t count);
  *
  * @param data TODO
  * @param count TODO
- * @arraysize data count
+ * @arraysize data count max DXL_MAX_SERVOS
  */
 cps_err_t dxl_servo_move_many_velocity(movedata_t data[], size_t count);
 
@@ -213,6 +213,7 @@ cps_err_t dxl_set_operating_mode(uint8_t id, uint8_t operatingMode);
  *
  * @param id
  * @param[out] result
+ * @stream
  */
 cps_err_t dxl_get_current_position(uint8_t id, uint32_t *result);
 
@@ -221,6 +222,7 @@ cps_err_t dxl_get_current_position(uint8_t id, uint32_t *result);
  *
  * @param id
  * @param[out] result
+ * @stream
  */
 cps_err_t dxl_get_current_velocity(uint8_t id, uint32_t *result);
 
@@ -229,6 +231,7 @@ cps_err_t dxl_get_current_velocity(uint8_t id, uint32_t *result);
  *
  * @param id
  * @param[out] result
+ * @stream
  */
 cps_err_t dxl_get_current_input_voltage(uint8_t id, uint16_t *result);
 
@@ -237,5 +240,6 @@ cps_err_t dxl_get_current_input_voltage(uint8_t id, uint16_t *result);
  *
  * @param id
  * @param[out] result
+ * @stream
  */
 cps_err_t dxl_get_is_moving(uint8_t id, uint8_t *result);
@@ -133,6 +133,12 @@ int main(void) {
 
     CPS_ERR_CHECK(cps_rpc_server_init("0.0.0.0", 27272));
     puts("server initialized");
+
+#ifdef CPS_RPC_PACKED
+    // server code generated with rpc.py -p: any number of clients, one
+    // worker thread per device
+    CPS_ERR_CHECK(cps_rpc_serve());
+#else
     CPS_ERR_CHECK(cps_rpc_server_accept());
     puts("client accepted");
 
@@ -142,6 +148,7 @@ int main(void) {
         printf("fn: 0x%x\n", fn);
         CPS_ERR_CHECK(cps_rpc_handle(fn));
     }
+#endif
 
     return 0;
 }
\ No newline at end of file
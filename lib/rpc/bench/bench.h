@@ -0,0 +1,54 @@
+/**
+ * @file bench.h
+ * @brief Synthetic functions for benchmarking the generated RPC code.
+ *
+ * @details
+ * Covers the argument shapes supported by rpc.py. The implementations in
+ * bench_server.c do nothing, so that only the RPC overhead is measured.
+ */
+#pragma once
+#include <stdbool.h>
+#include <stddef.h>
+#include <stdint.h>
+
+#include "cps.h"
+
+/** Packed struct argument */
+typedef struct __attribute__((packed)) {
+    uint8_t id;
+    int32_t position;
+    uint16_t velocity;
+    bool enabled;
+} bench_sample_t;
+
+/** @brief No arguments. */
+cps_err_t bench_void(void);
+
+/** @brief Scalar arguments of every size. */
+cps_err_t bench_scalars(uint8_t a, uint16_t b, uint32_t c, int d, bool e);
+
+/** @brief Packed struct passed by value. */
+cps_err_t bench_struct(bench_sample_t sample);
+
+/**
+ * @brief Struct passed by pointer, and one returned by pointer.
+ *
+ * @param[in] in
+ * @param[out] out
+ */
+cps_err_t bench_pointers(bench_sample_t *in, bench_sample_t *out);
+
+/**
+ * @brief Array of structs sent to the server.
+ *
+ * @arraysize data count
+ */
+cps_err_t bench_array_in(bench_sample_t data[], size_t count);
+
+/**
+ * @brief Array sent to the server and back.
+ *
+ * @param[in,out] data
+ * @arraysize data count
+ */
+cps_err_t bench_array_inout(uint32_t data[], size_t count);
@@ -0,0 +1,284 @@
+'''
+Round-trip benchmark of the generated RPC code.
+
+`run` serves bench.h with bench_server over loopback TCP and a UNIX socket,
+times the C client (bench_client) and the generated Python client against
+it, and writes the results as JSON. `compare` shows the change between two
+such files, e.g. from before and after a commit. `check` makes sure that
+malformed requests are rejected without stopping the server.
+'''
+import click
+import ctypes
+import datetime
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+# element counts of the @arraysize cases, same as bench_client.c
+SIZES = (1, 4, 16, 64, 256, 1024, 4096)
+# fields identifying a measurement across result files
+KEY = ('client', 'transport', 'fn', 'elems')
+# CPS_RPC_BATCH of rpc.h, and ids no function has
+BATCH = 0x9000
+UNKNOWN = (0x1234, 0xAFFF)
+
+def cases(rpc):
+    '''
+    (fn, elems, bytes, call) of every benchmarked call, in the order of
+    bench_client.c. `bytes` is the size of the argument data.
+    '''
+    sample = rpc.bench_sample_t(id=1, position=2, velocity=3, enabled=True)
+    size = ctypes.sizeof(sample)
+    yield 'bench_void', 0, 0, lambda c: c.bench_void()
+    yield 'bench_scalars', 0, 12, lambda c: c.bench_scalars(1, 2, 3, 4, True)
+    yield 'bench_struct', 0, size, lambda c: c.bench_struct(sample)
+    yield 'bench_pointers', 0, size, lambda c: c.bench_pointers(sample)
+    for n in SIZES:
+        samples = (rpc.bench_sample_t * n)()
+        words = (ctypes.c_uint32 * n)()
+        yield 'bench_array_in', n, n * size, lambda c, a=samples: c.bench_array_in(a)
+        yield 'bench_array_inout', n, n * 4, lambda c, a=words: c.bench_array_inout(a)
+
+def percentile(lat, p):
+    # nearest rank of sorted latencies
+    return lat[max((p * len(lat) + 99) // 100 - 1, 0)]
+
+def measure(client, call, iterations):
+    for _ in range(iterations // 10):
+        call(client)
+    lat = [0] * iterations
+    start = time.perf_counter_ns()
+    for i in range(iterations):
+        t = time.perf_counter_ns()
+        call(client)
+        lat[i] = time.perf_counter_ns() - t
+    total = time.perf_counter_ns() - start
+    lat.sort()
+    return {
+        'calls': iterations,
+        'p50_us': round(percentile(lat, 50) / 1e3, 3),
+        'p99_us': round(percentile(lat, 99) / 1e3, 3),
+        'calls_per_s': round(iterations / (total / 1e9), 1),
+    }
+
+def run_python(rpc, transport, address, iterations):
+    if transport == 'tcp':
+        client = rpc.Client.connect(*address)
+    else:
+        client = rpc.Client.connect_unix(address)
+    with client:
+        for fn, elems, size, call in cases(rpc):
+            yield {'client': 'python', 'transport': transport, 'fn': fn,
+                'elems': elems, 'bytes': size, **measure(client, call, iterations)}
+
+def run_c(transport, address, iterations):
+    args = [os.path.join(BENCH_DIR, 'bench_client'), transport]
+    args += list(map(str, address)) if transport == 'tcp' else [address]
+    out = subprocess.run(args + [str(iterations)],
+        check=True, capture_output=True, text=True).stdout
+    return [json.loads(line) for line in out.splitlines()]
+
+class Server:
+    '''
+    bench_server on the given transport, one per client run. A legacy
+    server serves a single connection.
+    '''
+    def __init__(self, transport, address):
+        self.transport = transport
+        self.address = address
+
+    def __enter__(self):
+        args = [os.path.join(BENCH_DIR, 'bench_server'), self.transport]
+        args += list(map(str, self.address)) if self.transport == 'tcp' else [self.address]
+        self.proc = subprocess.Popen(args, stderr=subprocess.DEVNULL)
+        try:
+            self._wait_ready()
+        except BaseException:
+            self.__exit__()
+            raise
+        return self
+
+    def _wait_ready(self, timeout=5):
+        # probing TCP with a connection would take the only slot of a
+        # legacy server, so wait until the port is listening instead
+        deadline = time.monotonic() + timeout
+        while not self._listening():
+            if self.proc.poll() is not None:
+                raise click.ClickException(f'bench_server exited with {self.proc.returncode}')
+            if time.monotonic() >= deadline:
+                raise click.ClickException('bench_server did not start')
+            time.sleep(0.01)
+
+    def _listening(self):
+        if self.transport == 'unix':
+            # flag 00010000 is __SO_ACCEPTCON, set by listen()
+            with open('/proc/net/unix') as f:
+                return any(line.split()[3] == '00010000' and line.split()[-1] == self.address
+                    for line in f if len(line.split()) == 8)
+        port = f':{self.address[1]:04X} '
+        # state 0A is LISTEN
+        with open('/proc/net/tcp') as f:
+            return any(port in line and ' 0A ' in line for line in f)
+
+    def __exit__(self, *exc):
+        self.proc.kill()
+        self.proc.wait()
+        if self.transport == 'unix' and os.path.exists(self.address):
+            os.unlink(self.address)
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'],
+            cwd=BENCH_DIR, check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def load_rpc():
+    sys.path.insert(0, os.path.join(BENCH_DIR, 'gen'))
+    import bench_rpc
+    return bench_rpc
+
+@click.group()
+def main():
+    pass
+
+@main.command()
+@click.option('-n', 'iterations',
+    default=2000, show_default=True, type=click.IntRange(min=1),
+    help='Timed calls per function and size.')
+@click.option('-t', 'transports',
+    multiple=True, default=('tcp', 'unix'), show_default=True,
+    type=click.Choice(['tcp', 'unix']),
+    help='Transports to benchmark.')
+@click.option('-l', 'clients',
+    multiple=True, default=('c', 'python'), show_default=True,
+    type=click.Choice(['c', 'python']),
+    help='Clients to benchmark.')
+@click.option('--port',
+    default=27280, show_default=True,
+    help='Loopback TCP port of the server.')
+@click.option('-o', 'output',
+    type=click.File('w'), default='-',
+    help='Results file, JSON.')
+def run(iterations, transports, clients, port, output):
+    '''
+    Benchmark the binaries and the Python client built by `make`.
+    '''
+    rpc = load_rpc()
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for transport in transports:
+            address = ('127.0.0.1', port) if transport == 'tcp' else os.path.join(tmp, 'bench.sock')
+            for client in clients:
+                with Server(transport, address):
+                    if client == 'c':
+                        rows = run_c(transport, address, iterations)
+                    else:
+                        rows = run_python(rpc, transport, address, iterations)
+                    for row in rows:
+                        click.echo(f"{row['client']:6} {row['transport']:4} {row['fn']:17} {row['elems']:5} "
+                            f"p50 {row['p50_us']:9.2f} us  p99 {row['p99_us']:9.2f} us  "
+                            f"{row['calls_per_s']:10.0f} calls/s", err=True)
+                        results.append(row)
+
+    json.dump({
+        'commit': git_commit(),
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'host': platform.node(),
+        'machine': platform.machine(),
+        'mode': 'packed' if rpc.PACKED else 'legacy',
+        'iterations': iterations,
+        'results': results,
+    }, output, indent=2)
+    output.write('\n')
+
+def connect(transport, address):
+    if transport == 'tcp':
+        return socket.create_connection(address)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(address)
+    return sock
+
+def recv_frame(rpc, sock):
+    # header and payload of a reply frame
+    hdr = sock.recv(rpc._HDR.size, socket.MSG_WAITALL)
+    if len(hdr) < rpc._HDR.size:
+        raise click.ClickException('bench_server closed the connection')
+    fn, length, tag = rpc._HDR.unpack(hdr)
+    return fn, tag, sock.recv(length, socket.MSG_WAITALL)
+
+def check_unknown(rpc, sock):
+    # a call of an unknown function gets CPS_ERR_ARG with its tag
+    for tag, fn in enumerate(UNKNOWN, 1):
+        sock.sendall(rpc._HDR.pack(fn, 0, tag))
+        _, reply_tag, payload = recv_frame(rpc, sock)
+        if reply_tag != tag or rpc._ERR.unpack_from(payload)[0] != rpc.ERRORS.index('CPS_ERR_ARG'):
+            raise click.ClickException(f'unknown function {fn:#x} not rejected')
+
+    # a batch calling one is not run, and gets an empty reply
+    calls = rpc._REQ_bench_void.pack(rpc.CPS_RPC_bench_void, 0, 0) + rpc._HDR.pack(UNKNOWN[-1], 0, 0)
+    sock.sendall(rpc._HDR.pack(BATCH, len(calls), 10) + calls)
+    _, tag, payload = recv_frame(rpc, sock)
+    if tag != 10 or payload:
+        raise click.ClickException('batch with an unknown function not rejected')
+
+def change(old, new):
+    return f'{(new - old) / old * 100:+6.1f}%' if old else '       '
+
+@main.command()
+@click.argument('old', type=click.File())
+@click.argument('new', type=click.File())
+def compare(old, new):
+    '''
+    Compare two results files, e.g. of two commits.
+    '''
+    old, new = json.load(old), json.load(new)
+    click.echo(f"{old['commit']} ({old['mode']}) -> {new['commit']} ({new['mode']})")
+    before = {tuple(row[k] for k in KEY): row for row in old['results']}
+    for row in new['results']:
+        prev = before.get(tuple(row[k] for k in KEY))
+        if prev is None:
+            continue
+        click.echo(f"{row['client']:6} {row['transport']:4} {row['fn']:17} {row['elems']:5} "
+            f"p50 {row['p50_us']:9.2f} us {change(prev['p50_us'], row['p50_us'])}  "
+            f"p99 {row['p99_us']:9.2f} us {change(prev['p99_us'], row['p99_us'])}  "
+            f"{row['calls_per_s']:10.0f} calls/s {change(prev['calls_per_s'], row['calls_per_s'])}")
+
+@main.command()
+@click.option('-t', 'transports',
+    multiple=True, default=('tcp', 'unix'), show_default=True,
+    type=click.Choice(['tcp', 'unix']),
+    help='Transports to check.')
+@click.option('--port',
+    default=27280, show_default=True,
+    help='Loopback TCP port of the server.')
+def check(transports, port):
+    '''
+    Send calls of unknown functions, and check that they are rejected while
+    the server keeps serving (packed mode).
+    '''
+    rpc = load_rpc()
+    if not rpc.PACKED:
+        raise click.ClickException('check needs a packed build')
+    with tempfile.TemporaryDirectory() as tmp:
+        for transport in transports:
+            address = ('127.0.0.1', port) if transport == 'tcp' else os.path.join(tmp, 'bench.sock')
+            with Server(transport, address) as server:
+                with connect(transport, address) as sock:
+                    check_unknown(rpc, sock)
+                # other clients are still served
+                client = rpc.Client.connect(*address) if transport == 'tcp' else rpc.Client.connect_unix(address)
+                with client:
+                    client.bench_void()
+                if server.proc.poll() is not None:
+                    raise click.ClickException(f'bench_server exited with {server.proc.returncode}')
+            click.echo(f'{transport:4} ok', err=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+
+#include "rpc.h"
+#include "bench.h"
+
+// element counts of the @arraysize cases
+static const size_t sizes[] = { 1, 4, 16, 64, 256, 1024, 4096 };
+#define MAX_ELEMS 4096
+
+static const char *transport;
+static size_t iters;
+static uint64_t *lat;
+
+static uint64_t now_ns(void) {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (uint64_t)ts.tv_sec * 1000000000 + ts.tv_nsec;
+}
+
+static int cmp_u64(const void *a, const void *b) {
+    uint64_t x = *(const uint64_t *)a;
+    uint64_t y = *(const uint64_t *)b;
+    return (x > y) - (x < y);
+}
+
+// nearest-rank percentile of the sorted latencies, in microseconds
+static double percentile_us(unsigned p) {
+    size_t rank = (p * iters + 99) / 100;
+    return lat[rank > 0 ? rank - 1 : 0] / 1e3;
+}
+
+// one JSON object per line, collected by bench.py
+static void report(const char *fn, size_t elems, size_t bytes, uint64_t total_ns) {
+    qsort(lat, iters, sizeof(*lat), cmp_u64);
+    printf("{\"client\": \"c\", \"transport\": \"%s\", \"fn\": \"%s\", "
+        "\"elems\": %zu, \"bytes\": %zu, \"calls\": %zu, "
+        "\"p50_us\": %.3f, \"p99_us\": %.3f, \"calls_per_s\": %.1f}\n",
+        transport, fn, elems, bytes, iters,
+        percentile_us(50), percentile_us(99), iters / (total_ns / 1e9));
+    fflush(stdout);
+}
+
+// time every call, after a warmup of a tenth of the iterations
+#define BENCH(fn, elems, bytes, call) do { \
+    for (size_t i = 0; i < iters / 10; i++) { \
+        CPS_ERR_CHECK(call); \
+    } \
+    uint64_t start = now_ns(); \
+    for (size_t i = 0; i < iters; i++) { \
+        uint64_t t = now_ns(); \
+        CPS_ERR_CHECK(call); \
+        lat[i] = now_ns() - t; \
+    } \
+    report(fn, elems, bytes, now_ns() - start); \
+} while (0)
+
+int main(int argc, char **argv) {
+    cps_err_t ret;
+    static bench_sample_t samples[MAX_ELEMS];
+    static uint32_t words[MAX_ELEMS];
+    bench_sample_t sample = { .id = 1, .position = 2, .velocity = 3, .enabled = true };
+    bench_sample_t out;
+
+    transport = argc > 1 ? argv[1] : "";
+    if (argc >= 4 && strcmp(transport, "tcp") == 0) {
+        CPS_ERR_CHECK(cps_rpc_client_init(argv[2], atoi(argv[3])));
+        iters = argc > 4 ? strtoul(argv[4], NULL, 10) : 0;
+    } else if (argc >= 3 && strcmp(transport, "unix") == 0) {
+        CPS_ERR_CHECK(cps_rpc_client_init_unix(argv[2]));
+        iters = argc > 3 ? strtoul(argv[3], NULL, 10) : 0;
+    } else {
+        fprintf(stderr, "usage: %s (tcp <ip> <port> | unix <path>) [iterations]\n", argv[0]);
+        return 1;
+    }
+
+    if (iters == 0) {
+        iters = 2000;
+    }
+    if ((lat = malloc(iters * sizeof(*lat))) == NULL) {
+        return 1;
+    }
+
+    BENCH("bench_void", 0, 0, bench_void());
+    BENCH("bench_scalars", 0, 12, bench_scalars(1, 2, 3, 4, true));
+    BENCH("bench_struct", 0, sizeof(sample), bench_struct(sample));
+    BENCH("bench_pointers", 0, sizeof(sample), bench_pointers(&sample, &out));
+    for (size_t i = 0; i < sizeof(sizes) / sizeof(*sizes); i++) {
+        size_t n = sizes[i];
+        BENCH("bench_array_in", n, n * sizeof(*samples), bench_array_in(samples, n));
+        BENCH("bench_array_inout", n, n * sizeof(*words), bench_array_inout(words, n));
+    }
+
+    free(lat);
+    return 0;
+}
@@ -0,0 +1,64 @@
+#include <stdbool.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+#include "rpc.h"
+#include "bench.h"
+
+// no-op implementations, only the RPC overhead is measured
+cps_err_t bench_void(void) {
+    return CPS_ERR_OK;
+}
+
+cps_err_t bench_scalars(uint8_t a, uint16_t b, uint32_t c, int d, bool e) {
+    (void)a; (void)b; (void)c; (void)d; (void)e;
+    return CPS_ERR_OK;
+}
+
+cps_err_t bench_struct(bench_sample_t sample) {
+    (void)sample;
+    return CPS_ERR_OK;
+}
+
+cps_err_t bench_pointers(bench_sample_t *in, bench_sample_t *out) {
+    *out = *in;
+    return CPS_ERR_OK;
+}
+
+cps_err_t bench_array_in(bench_sample_t data[], size_t count) {
+    (void)data; (void)count;
+    return CPS_ERR_OK;
+}
+
+cps_err_t bench_array_inout(uint32_t data[], size_t count) {
+    (void)data; (void)count;
+    return CPS_ERR_OK;
+}
+
+int main(int argc, char **argv) {
+    cps_err_t ret;
+
+    if (argc == 4 && strcmp(argv[1], "tcp") == 0) {
+        CPS_ERR_CHECK(cps_rpc_server_init(argv[2], atoi(argv[3])));
+    } else if (argc == 3 && strcmp(argv[1], "unix") == 0) {
+        CPS_ERR_CHECK(cps_rpc_server_init_unix(argv[2]));
+    } else {
+        fprintf(stderr, "usage: %s tcp <ip> <port> | unix <path>\n", argv[0]);
+        return 1;
+    }
+
+#ifdef CPS_RPC_PACKED
+    CPS_ERR_CHECK(cps_rpc_serve());
+#else
+    // a single client, exits once it disconnects
+    CPS_ERR_CHECK(cps_rpc_server_accept());
+    while (true) {
+        uint32_t fn;
+        CPS_ERR_CHECK(cps_rpc_read_fn(&fn));
+        CPS_ERR_CHECK(cps_rpc_handle(fn));
+    }
+#endif
+
+    return 0;
+}
@@ -1,7 +1,10 @@
 #include "cps.h"
+#include "rpc.h"
 
 #include <sys/socket.h> // socket, connect
 #include <arpa/inet.h> // inet_pton, sockaddr_in
+#include <sys/un.h> // sockaddr_un
+#include <string.h> // memcpy, memset, strcpy
 
 int cps_rpc_client_fd;
 
@@ -25,3 +28,148 @@ cps_err_t cps_rpc_client_init(const char *ip, int port) {
 
 	return CPS_ERR_OK;
 }
+
+cps_err_t cps_rpc_client_init_unix(const char *path) {
+	struct sockaddr_un addr = { .sun_family = AF_UNIX };
+
+	if (strlen(path) >= sizeof(addr.sun_path)) {
+		return CPS_ERR_ARG;
+	}
+	strcpy(addr.sun_path, path);
+
+	if ((cps_rpc_client_fd = socket(AF_UNIX, SOCK_STREAM, 0)) < 0) {
+		return CPS_ERR_SYS;
+	}
+
+	if (connect(cps_rpc_client_fd, (struct sockaddr *)&addr, sizeof(addr)) < 0) {
+		return CPS_ERR_SYS;
+	}
+
+	return CPS_ERR_OK;
+}
+
+// grow *buf to hold at least need elements of size elem
+static cps_err_t reserve(void *buf, size_t *cap, size_t need, size_t elem) {
+	void **p = buf;
+	if (need <= *cap) {
+		return CPS_ERR_OK;
+	}
+
+	size_t n = MAX(2 * *cap, need);
+	void *tmp = realloc(*p, n * elem);
+	if (tmp == NULL) {
+		return CPS_ERR_NO_MEM;
+	}
+
+	*p = tmp;
+	*cap = n;
+	return CPS_ERR_OK;
+}
+
+cps_err_t cps_rpc_batch_init(cps_rpc_batch_t *batch) {
+	memset(batch, 0, sizeof(*batch));
+	if (reserve(&batch->buf, &batch->cap, 256, 1) != CPS_ERR_OK) {
+		return CPS_ERR_NO_MEM;
+	}
+
+	// room for the batch header, filled in when flushing
+	batch->len = sizeof(cps_rpc_hdr_t);
+	return CPS_ERR_OK;
+}
+
+void cps_rpc_batch_free(cps_rpc_batch_t *batch) {
+	free(batch->buf);
+	free(batch->resp);
+	free(batch->slots);
+	memset(batch, 0, sizeof(*batch));
+}
+
+cps_err_t cps_rpc_batch_reserve(cps_rpc_batch_t *batch, size_t size, void **frame) {
+	cps_err_t ret;
+
+	CPS_RET_ON_ERR(reserve(&batch->buf, &batch->cap, batch->len + size, 1));
+	// slot for the error code of this call
+	CPS_RET_ON_ERR(cps_rpc_batch_out(batch, NULL, sizeof(cps_err_t)));
+
+	*frame = batch->buf + batch->len;
+	memset(*frame, 0, size);
+	batch->len += size;
+	batch->count++;
+
+	return CPS_ERR_OK;
+}
+
+cps_err_t cps_rpc_batch_out(cps_rpc_batch_t *batch, void *dst, size_t len) {
+	cps_err_t ret;
+
+	CPS_RET_ON_ERR(reserve(&batch->slots, &batch->slots_cap,
+		batch->nslots + 1, sizeof(*batch->slots)));
+	batch->slots[batch->nslots].dst = dst;
+	batch->slots[batch->nslots].len = len;
+	batch->nslots++;
+
+	return CPS_ERR_OK;
+}
+
+cps_err_t cps_rpc_batch_flush(cps_rpc_batch_t *batch, cps_err_t *errs) {
+	cps_err_t ret;
+	cps_err_t first = CPS_ERR_OK;
+	cps_rpc_hdr_t hdr = {
+		.fn = CPS_RPC_BATCH,
+		.len = batch->len - sizeof(hdr),
+	};
+
+	if (batch->count == 0) {
+		return CPS_ERR_OK;
+	}
+
+	memcpy(batch->buf, &hdr, sizeof(hdr));
+	CPS_RET_ON_ERR(cps_rpc_write(cps_rpc_client_fd, batch->buf, batch->len));
+
+	CPS_RET_ON_ERR(cps_rpc_read(cps_rpc_client_fd, &hdr, sizeof(hdr)));
+	CPS_RET_ON_ERR(reserve(&batch->resp, &batch->resp_cap, hdr.len, 1));
+	CPS_RET_ON_ERR(cps_rpc_read(cps_rpc_client_fd, batch->resp, hdr.len));
+
+	if (errs != NULL) {
+		for (size_t i = 0; i < batch->count; i++) {
+			errs[i] = CPS_ERR_ARG;
+		}
+	}
+
+	// results of a call are only present if it succeeded
+	size_t off = 0;
+	size_t call = 0;
+	cps_err_t err = CPS_ERR_ARG;
+	for (size_t i = 0; i < batch->nslots; i++) {
+		cps_rpc_batch_slot_t *slot = &batch->slots[i];
+		if (slot->dst == NULL) {
+			err = CPS_ERR_ARG;
+			if (hdr.len - off >= sizeof(err)) {
+				memcpy(&err, batch->resp + off, sizeof(err));
+				off += sizeof(err);
+			}
+
+			if (errs != NULL) {
+				errs[call] = err;
+			}
+			if (first == CPS_ERR_OK) {
+				first = err;
+			}
+			call++;
+		} else if (err == CPS_ERR_OK) {
+			if (hdr.len - off < slot->len) {
+				first = CPS_ERR_ARG;
+				break;
+			}
+
+			memcpy(slot->dst, batch->resp + off, slot->len);
+			off += slot->len;
+		}
+	}
+
+	batch->len = sizeof(hdr);
+	batch->nslots = 0;
+	batch->count = 0;
+
+	return first;
+}
@@ -2,6 +2,8 @@
 
 #include "rpc.h"
 
+uint8_t cps_rpc_pad[8];
+
 cps_err_t cps_rpc_read(int fd, void *buf, size_t count) {
     size_t nb = 0;
     while (nb < count) {
@@ -16,6 +18,20 @@ cps_err_t cps_rpc_read(int fd, void *buf, size_t count) {
     return CPS_ERR_OK;
 }
 
+cps_err_t cps_rpc_drain(int fd, size_t count) {
+    uint8_t buf[256];
+    while (count > 0) {
+        int result = read(fd, buf, MIN(count, sizeof(buf)));
+        if (result < 1) {
+            return CPS_ERR_RPC_SOCKET;
+        }
+
+        count -= result;
+    }
+
+    return CPS_ERR_OK;
+}
+
 cps_err_t cps_rpc_write(int fd, void *buf, size_t count) {
     size_t nb = 0;
     while (nb < count) {
@@ -29,3 +45,25 @@ cps_err_t cps_rpc_write(int fd, void *buf, size_t count) {
 
     return CPS_ERR_OK;
 }
+
+cps_err_t cps_rpc_writev(int fd, struct iovec *iov, int iovcnt) {
+    while (iovcnt > 0) {
+        ssize_t result = writev(fd, iov, iovcnt);
+        if (result < 1) {
+            return CPS_ERR_RPC_SOCKET;
+        }
+
+        // drop fully written buffers, advance into a partially written one
+        while (iovcnt > 0 && (size_t)result >= iov->iov_len) {
+            result -= iov->iov_len;
+            iov++;
+            iovcnt--;
+        }
+        if (iovcnt > 0) {
+            iov->iov_base += result;
+            iov->iov_len -= result;
+        }
+    }
+
+    return CPS_ERR_OK;
+}
@@ -1,6 +1,8 @@
 #pragma once
 
+#include <stdbool.h>
 #include <stdint.h>
+#include <sys/uio.h>
 
 #include "cps.h"
 
@@ -8,6 +10,22 @@
 #define cps_rpc_send_dynarray(x, c) CPS_RET_ON_ERR(cps_rpc_write(cps_rpc_client_fd, (x), sizeof(*(x)) * (c)))
 #define cps_rpc_recv(x) CPS_RET_ON_ERR(cps_rpc_read(cps_rpc_client_fd, (x), sizeof(*(x))))
 #define cps_rpc_recv_dynarray(x, c) CPS_RET_ON_ERR(cps_rpc_read(cps_rpc_client_fd, (x), sizeof(*(x)) * (c)))
+#define cps_rpc_recv_dynarray_or_drain(x, c) CPS_RET_ON_ERR((x) != NULL \
+    ? cps_rpc_read(cps_rpc_client_fd, (x), sizeof(*(x)) * (c)) \
+    : cps_rpc_drain(cps_rpc_client_fd, sizeof(*(x)) * (c)))
+#define cps_rpc_sendv(iov) CPS_RET_ON_ERR(cps_rpc_writev(cps_rpc_client_fd, (iov), sizeof(iov) / sizeof(*(iov))))
+#define cps_rpc_reply(x) CPS_RET_ON_ERR(cps_rpc_reply_append((x), sizeof(*(x))))
+#define cps_rpc_reply_dynarray(x, c) CPS_RET_ON_ERR(cps_rpc_reply_append((x), sizeof(*(x)) * (c)))
+
+/** Round up to the alignment of dynamic arrays inside a packed frame. */
+#define CPS_RPC_ALIGN(n) (((n) + 7) & ~(size_t)7)
+/** Number of padding bytes needed after `n` bytes of a packed frame. */
+#define CPS_RPC_PAD(n) (CPS_RPC_ALIGN(n) - (n))
+
+/** Largest accepted packed frame payload, in bytes. */
+#ifndef CPS_RPC_MAX_FRAME
+    #define CPS_RPC_MAX_FRAME (1 << 20)
+#endif
 
 extern int cps_rpc_client_fd;
 extern int cps_rpc_server_fd;
@@ -15,6 +33,132 @@ extern int cps_rpc_server_fd;
 // forwad declaration of generated function id enum
 typedef enum cps_rpc_cmd_t cps_rpc_cmd_t;
 
+/** Header in front of every packed request and reply frame. */
+typedef struct {
+    /** function id */
+    uint32_t fn;
+    /** payload length in bytes, excluding this header */
+    uint32_t len;
+    /** chosen by the client, echoed in the reply to match it to its request */
+    uint64_t tag;
+} cps_rpc_hdr_t;
+
+/** Zero bytes used to pad dynamic arrays in packed frames. */
+extern uint8_t cps_rpc_pad[8];
+
+/** Built-in function ids, below the generated ones. */
+enum {
+    /** packed frame holding several request frames, see #cps_rpc_batch_t */
+    CPS_RPC_BATCH = 0x9000,
+    /** start a stream of a `@stream` function, see #cps_rpc_subscribe_t */
+    CPS_RPC_SUBSCRIBE = 0x9001,
+    /** stop the stream with the tag of this frame, also ends every stream */
+    CPS_RPC_UNSUBSCRIBE = 0x9002,
+};
+
+/**
+ * @brief Payload of a #CPS_RPC_SUBSCRIBE frame.
+ *
+ * @details
+ * Followed by a request frame of a `@stream` function, which the server
+ * calls every `period_ns`. Its replies are pushed with the tag of the
+ * subscribe frame until the client sends a #CPS_RPC_UNSUBSCRIBE frame with
+ * that tag. The stream ends with a #CPS_RPC_UNSUBSCRIBE frame holding a
+ * `cps_err_t`: #CPS_ERR_OK once unsubscribed, #CPS_ERR_ARG if the
+ * subscription was rejected. No frames of the stream follow it.
+ */
+typedef struct {
+    /** time between calls */
+    uint64_t period_ns;
+} cps_rpc_subscribe_t;
+
+/** Number of latency buckets of #cps_rpc_stats_t. */
+#define CPS_RPC_STATS_BUCKETS 20
+
+/**
+ * @brief Timing of a server function, collected with `rpc.py -t`.
+ *
+ * @details
+ * Times are in nanoseconds, summed over all calls. Bucket 0 of `hist`
+ * counts calls taking less than 1 us in total, bucket i calls taking from
+ * 2^(i-1) to 2^i us, and the last bucket all longer calls.
+ */
+typedef struct __attribute__((packed)) {
+    /** function id, 0 for unused entries */
+    uint32_t fn;
+    /** number of calls */
+    uint64_t calls;
+    /** receiving and unpacking the arguments */
+    uint64_t recv_ns;
+    /** inside the function */
+    uint64_t call_ns;
+    /** sending the error code and results */
+    uint64_t send_ns;
+    /** longest call */
+    uint64_t max_ns;
+    uint32_t hist[CPS_RPC_STATS_BUCKETS];
+} cps_rpc_stats_t;
+
+/** Internal. Timing counters of a server function, see #cps_rpc_stats_t. */
+typedef struct {
+    uint32_t fn;
+    uint64_t calls;
+    uint64_t recv_ns;
+    uint64_t call_ns;
+    uint64_t send_ns;
+    uint64_t max_ns;
+    uint32_t hist[CPS_RPC_STATS_BUCKETS];
+} cps_rpc_timing_t;
+
+/** Generated function (packed mode). Handle a single request frame. */
+typedef cps_err_t (*cps_rpc_dispatch_t)(cps_rpc_hdr_t *frame);
+
+/** Generated function (packed mode). Worker group of a request frame. */
+typedef unsigned (*cps_rpc_group_t)(const cps_rpc_hdr_t *frame);
+
+/** Generated function (packed mode). Whether a function id may be streamed. */
+typedef bool (*cps_rpc_streamable_t)(uint32_t fn);
+
+/** Generated function (packed mode). Whether a function id is handled. */
+typedef bool (*cps_rpc_known_t)(uint32_t fn);
+
+/** Group of a batch calling functions of several groups. */
+#define CPS_RPC_GROUP_ALL (~0u)
+
+/** Internal. Where to copy a result of a batched call. */
+typedef struct {
+    /** destination, NULL for the error code of the next call */
+    void *dst;
+    /** number of bytes */
+    size_t len;
+} cps_rpc_batch_slot_t;
+
+/**
+ * @brief Queue of packed requests, sent with a single write.
+ *
+ * @details
+ * Calls are queued with the generated `cps_rpc_batch_<fn>()` functions
+ * (see the generated client header) and sent with #cps_rpc_batch_flush.
+ * The server runs them in order and sends back all error codes and
+ * `@param[out]` results as one response. Output pointers passed when
+ * queueing must stay valid until the batch is flushed.
+ */
+typedef struct {
+    /** batch frame: header followed by the queued request frames */
+    uint8_t *buf;
+    size_t len;
+    size_t cap;
+    /** response buffer */
+    uint8_t *resp;
+    size_t resp_cap;
+    /** result destinations, in response order */
+    cps_rpc_batch_slot_t *slots;
+    size_t nslots;
+    size_t slots_cap;
+    /** number of queued calls */
+    size_t count;
+} cps_rpc_batch_t;
+
 /** @brief Initialize RPC client.
  * 
  * @param ip connect host
@@ -25,6 +169,67 @@ typedef enum cps_rpc_cmd_t cps_rpc_cmd_t;
  */
 cps_err_t cps_rpc_client_init(const char *ip, int port);
 
+/** @brief Initialize RPC client over a UNIX domain socket.
+ *
+ * @param path socket path
+ *
+ * @retval CPS_ERR_ARG path too long
+ * @retval CPS_ERR_SYS socket setup/connection failed
+ * @retval CPS_ERR_OK no error
+ */
+cps_err_t cps_rpc_client_init_unix(const char *path);
+
+/** @brief Initialize an empty batch.
+ *
+ * @param batch batch to initialize
+ *
+ * @retval CPS_ERR_NO_MEM buffer allocation failed
+ * @retval CPS_ERR_OK no error
+ */
+cps_err_t cps_rpc_batch_init(cps_rpc_batch_t *batch);
+
+/** @brief Free the buffers of a batch. Queued calls are dropped. */
+void cps_rpc_batch_free(cps_rpc_batch_t *batch);
+
+/** @brief Send all queued calls and wait for their results.
+ *
+ * @details
+ * The calls are run in order on the server, each one regardless of the
+ * result of the previous ones. Results of failed calls are not copied.
+ * The batch is empty afterwards and can be reused.
+ *
+ * @param batch batch to send
+ * @param[out] errs error code of every queued call, may be NULL
+ *
+ * @retval CPS_ERR_RPC_SOCKET RPC socket read/write failed
+ * @retval CPS_ERR_NO_MEM response buffer allocation failed
+ * @retval CPS_ERR_ARG malformed response
+ * @return first error code of the queued calls otherwise
+ */
+cps_err_t cps_rpc_batch_flush(cps_rpc_batch_t *batch, cps_err_t *errs);
+
+/** @brief Internal function. Append a zeroed request frame to a batch.
+ *
+ * @param batch target batch
+ * @param size frame size, including dynamic arrays
+ * @param[out] frame start of the frame inside the batch
+ *
+ * @retval CPS_ERR_NO_MEM buffer allocation failed
+ * @retval CPS_ERR_OK no error
+ */
+cps_err_t cps_rpc_batch_reserve(cps_rpc_batch_t *batch, size_t size, void **frame);
+
+/** @brief Internal function. Register a result destination of the last queued call.
+ *
+ * @param batch target batch
+ * @param dst destination of the result
+ * @param len result size
+ *
+ * @retval CPS_ERR_NO_MEM buffer allocation failed
+ * @retval CPS_ERR_OK no error
+ */
+cps_err_t cps_rpc_batch_out(cps_rpc_batch_t *batch, void *dst, size_t len);
+
 
 /** @brief Accept RPC client.
  * 
@@ -43,6 +248,19 @@ cps_err_t cps_rpc_server_accept(void);
  */
 cps_err_t cps_rpc_server_init(const char *ip, int port);
 
+/** @brief Initialize RPC server on a UNIX domain socket.
+ *
+ * @details
+ * A file left at `path` by a previous server is removed.
+ *
+ * @param path socket path
+ *
+ * @retval CPS_ERR_ARG path too long
+ * @retval CPS_ERR_SYS socket setup failed
+ * @retval CPS_ERR_OK no error
+ */
+cps_err_t cps_rpc_server_init_unix(const char *path);
+
 /** @brief Helper function. Read function id from the client socket.
  * 
  * @param fn function id
@@ -61,6 +279,165 @@ cps_err_t cps_rpc_read_fn(uint32_t *fn);
  */
 cps_err_t cps_rpc_handle(uint32_t fn);
 
+/** @brief Helper function. Read a packed request frame from the client socket.
+ *
+ * @details
+ * The header and the payload are read with one call each. The frame is
+ * stored in a buffer owned by the server which is reused (and only grown)
+ * between calls, so it stays valid until the next call.
+ *
+ * @param[out] frame received frame
+ *
+ * @retval CPS_ERR_RPC_SOCKET RPC socket read failed
+ * @retval CPS_ERR_ARG frame larger than #CPS_RPC_MAX_FRAME
+ * @retval CPS_ERR_NO_MEM frame buffer allocation failed
+ * @retval CPS_ERR_OK no error
+ */
+cps_err_t cps_rpc_recv_frame(cps_rpc_hdr_t **frame);
+
+/** @brief Generated function (packed mode). Handle a packed request frame.
+ *
+ * @details
+ * The reply is collected with #cps_rpc_reply_append and sent with a single
+ * write, as a frame with the function id and tag of the request. Batches
+ * (#CPS_RPC_BATCH) are handled by #cps_rpc_handle_batch. Streams need the
+ * timer of #cps_rpc_server_run, a #CPS_RPC_SUBSCRIBE frame is ended right
+ * away with #CPS_ERR_ARG, as is a frame calling an unknown function.
+ *
+ * @param frame frame read by #cps_rpc_recv_frame
+ *
+ * @retval CPS_ERR_RPC_SOCKET RPC socket write failed
+ * @retval CPS_ERR_NO_MEM reply buffer allocation failed
+ * @retval CPS_ERR_OK no error
+ */
+cps_err_t cps_rpc_handle_frame(cps_rpc_hdr_t *frame);
+
+/** @brief Helper function. Run all request frames of a batch in order.
+ *
+ * @details
+ * The reply payload holds the replies of all calls. A malformed batch, or
+ * one calling an unknown function, is not run at all, and gets an empty
+ * reply.
+ *
+ * @param frame batch frame
+ * @param dispatch handler of a single request frame
+ * @param known whether a function id is handled by @p dispatch
+ *
+ * @retval CPS_ERR_NO_MEM reply buffer allocation failed
+ * @retval CPS_ERR_OK no error
+ */
+cps_err_t cps_rpc_handle_batch(cps_rpc_hdr_t *frame, cps_rpc_dispatch_t dispatch,
+    cps_rpc_known_t known);
+
+/** @brief Generated function (packed mode). Serve clients with #cps_rpc_server_run.
+ *
+ * @retval CPS_ERR_SYS poll/accept/thread creation failed
+ * @retval CPS_ERR_NO_MEM allocation failed
+ */
+cps_err_t cps_rpc_serve(void);
+
+/** @brief Serve any number of clients with one worker thread per group.
+ *
+ * @details
+ * Frames are read by the calling thread from all connections and queued to
+ * the worker of their group (the input header of rpc.py), so calls to
+ * different devices run concurrently while calls to the same device run in
+ * order of arrival. Replies are sent as soon as they are ready and may
+ * overtake each other, clients match them by their tag. A batch calling
+ * functions of several groups (#CPS_RPC_GROUP_ALL) runs while all other
+ * workers are idle.
+ *
+ * Subscriptions (#CPS_RPC_SUBSCRIBE) are run by a timer thread, which
+ * queues a call to the worker of the function every period. A call is
+ * skipped while the previous one of the stream is still queued or running,
+ * so a slow function lowers the rate of its stream instead of filling the
+ * queue. Streams end when unsubscribed or when their connection is closed.
+ * Only returns on error.
+ *
+ * @param handle handler of a request frame, sending its reply
+ * @param group worker group of a request frame
+ * @param streamable whether a function may be subscribed to
+ * @param ngroups number of worker groups
+ *
+ * @retval CPS_ERR_SYS poll/accept/thread creation failed
+ * @retval CPS_ERR_NO_MEM allocation failed
+ */
+cps_err_t cps_rpc_server_run(cps_rpc_dispatch_t handle, cps_rpc_group_t group,
+    cps_rpc_streamable_t streamable, unsigned ngroups);
+
+/** @brief Helper function. Worker group shared by all calls of a batch.
+ *
+ * @param frame batch frame
+ * @param group worker group of a single request frame
+ *
+ * @return group of the calls, #CPS_RPC_GROUP_ALL if they differ
+ */
+unsigned cps_rpc_batch_group(const cps_rpc_hdr_t *frame, cps_rpc_group_t group);
+
+/** @brief Internal function. Start a reply to a request frame.
+ *
+ * @param frame request being replied to
+ *
+ * @retval CPS_ERR_NO_MEM reply buffer allocation failed
+ * @retval CPS_ERR_OK no error
+ */
+cps_err_t cps_rpc_reply_begin(const cps_rpc_hdr_t *frame);
+
+/** @brief Internal function. Append data to the reply buffer.
+ *
+ * @param data source buffer
+ * @param len number of bytes
+ *
+ * @retval CPS_ERR_NO_MEM reply buffer allocation failed
+ * @retval CPS_ERR_OK no error
+ */
+cps_err_t cps_rpc_reply_append(const void *data, size_t len);
+
+/** @brief Internal function. Send the reply frame with a single write.
+ *
+ * @retval CPS_ERR_RPC_SOCKET RPC socket write failed
+ * @retval CPS_ERR_OK no error
+ */
+cps_err_t cps_rpc_reply_flush(void);
+
+/** @brief Internal function. Monotonic clock in nanoseconds. */
+uint64_t cps_rpc_clock_ns(void);
+
+/** @brief Internal function. Start of the call being handled (`rpc.py -t`).
+ *
+ * @details
+ * Legacy calls start now, after their function id has been read. Packed
+ * calls start when the header of their frame has been read, or when the
+ * previous call of their batch ended, so that the time the frame spent
+ * being read and queued is included.
+ *
+ * @return timestamp of #cps_rpc_clock_ns
+ */
+uint64_t cps_rpc_stats_start(void);
+
+/** @brief Internal function. End of a call timed with `rpc.py -t`.
+ *
+ * @details
+ * Packed calls are recorded once their reply has been written, legacy
+ * calls right away. The write of a batch reply is counted for its last
+ * call.
+ *
+ * @param timing counters of the function
+ * @param t start, call start and call end, the end of the call is stored in t[3]
+ */
+void cps_rpc_stats_end(cps_rpc_timing_t *timing, uint64_t t[4]);
+
+/** @brief Internal function. Copy timing counters into #cps_rpc_stats_t entries.
+ *
+ * @param timing counters of all functions
+ * @param n number of counters
+ * @param[out] stats target entries, zeroed past n
+ * @param count number of entries
+ *
+ * @retval CPS_ERR_OK no error
+ */
+cps_err_t cps_rpc_stats_read(const cps_rpc_timing_t *timing, size_t n, cps_rpc_stats_t stats[], size_t count);
+
 /**
  * @brief Internal function. read() until count bytes have been read
  *
@@ -73,6 +450,17 @@ cps_err_t cps_rpc_handle(uint32_t fn);
  */
 cps_err_t cps_rpc_read(int fd, void *buf, size_t count);
 
+/**
+ * @brief Internal function. read() and discard count bytes
+ *
+ * @param fd source file descriptor
+ * @param count number of bytes to discard
+ *
+ * @retval CPS_ERR_RPC_SOCKET error in read() call
+ * @retval CPS_ERR_OK no error
+ */
+cps_err_t cps_rpc_drain(int fd, size_t count);
+
 /**
  * @brief Internal function. write() until count bytes have been written
  *
@@ -84,3 +472,15 @@ cps_err_t cps_rpc_read(int fd, void *buf, size_t count);
  * @retval CPS_ERR_OK no error
  */
 cps_err_t cps_rpc_write(int fd, void *buf, size_t count);
+
+/**
+ * @brief Internal function. writev() until all buffers have been written
+ *
+ * @param fd target file descriptor
+ * @param iov source buffers, modified in case of partial writes
+ * @param iovcnt number of buffers
+ *
+ * @retval CPS_ERR_RPC_SOCKET error in writev() call
+ * @retval CPS_ERR_OK no error
+ */
+cps_err_t cps_rpc_writev(int fd, struct iovec *iov, int iovcnt);
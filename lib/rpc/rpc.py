@@ -1,14 +1,23 @@
 import click
+import concurrent.futures
+import hashlib
+import json
+import keyword
+import os
 import sys
 import re
-from clang.cindex import Index, Config, CursorKind, TypeKind
+from clang.cindex import Index, Config, CursorKind, TranslationUnit, TypeKind
 
 CLANG_LIBRARY_FILE = 'libclang.so'
+# bump when the cached function model changes
+CACHE_VERSION = 4
+# declares the built-in cps_rpc_stats() of rpc.py -t
+STATS_HEADER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rpc_stats.h')
 CLIENT_FILE_TEMPLATE = '''\
 #include <string.h>
 
 #include "cps.h"
-#include "dxl.h"
+{includes}
 #include "rpc.h"
 
 {fn_id_enum}
@@ -20,12 +29,12 @@ SERVER_FILE_TEMPLATE = '''\
 #include <string.h>
 
 #include "cps.h"
-#include "dxl.h"
+{includes}
 #include "rpc.h"
 
 {fn_id_enum}
 
-cps_err_t cps_rpc_handle(uint32_t fn) {{
+{timing}cps_err_t cps_rpc_handle(uint32_t fn) {{
     cps_err_t ret;
     switch (fn) {{
 {text}
@@ -56,16 +65,532 @@ SERVER_CASE_TEMPLATE = '''\
         break;
     }}'''
 
-RE_ARRAYSIZE = re.compile(r'\@arraysize\s+([_a-zA-Z0-9]+)\s+([_a-zA-Z0-9]+)')
+# packed mode: function id, fixed-size arguments and size variables are
+# sent as one struct, followed by the dynamically sized arrays
+PACKED_CLIENT_FILE_TEMPLATE = '''\
+#include <string.h>
+
+#include "cps.h"
+{includes}
+#include "rpc.h"
+
+{fn_id_enum}
+
+{req_structs}
+
+{text}
+'''
+PACKED_SERVER_FILE_TEMPLATE = '''\
+#include <stdint.h>
+#include <string.h>
+
+#include "cps.h"
+{includes}
+#include "rpc.h"
+
+{fn_id_enum}
+
+{req_structs}
+
+{timing}static cps_err_t cps_rpc_dispatch(cps_rpc_hdr_t *frame) {{
+    cps_err_t ret;
+    switch (frame->fn) {{
+{text}
+    default:
+        // unknown function, its payload was read with the frame
+        ret = CPS_ERR_ARG;
+        cps_rpc_reply(&ret);
+        break;
+    }}
+
+    return CPS_ERR_OK;
+}}
+
+// functions handled by cps_rpc_dispatch
+static bool cps_rpc_known(uint32_t fn) {{
+    return fn >= 0xA000 && fn - 0xA000 < {nfns};
+}}
+
+cps_err_t cps_rpc_handle_frame(cps_rpc_hdr_t *frame) {{
+    cps_err_t ret;
+
+    if (frame->fn == CPS_RPC_SUBSCRIBE) {{
+        // streams are run by cps_rpc_server_run, end this one right away
+        frame->fn = CPS_RPC_UNSUBSCRIBE;
+    }}
+
+    CPS_RET_ON_ERR(cps_rpc_reply_begin(frame));
+    if (frame->fn == CPS_RPC_BATCH) {{
+        CPS_RET_ON_ERR(cps_rpc_handle_batch(frame, cps_rpc_dispatch,
+            cps_rpc_known));
+    }} else if (frame->fn == CPS_RPC_UNSUBSCRIBE) {{
+        ret = CPS_ERR_ARG;
+        cps_rpc_reply(&ret);
+    }} else {{
+        CPS_RET_ON_ERR(cps_rpc_dispatch(frame));
+    }}
+
+    return cps_rpc_reply_flush();
+}}
+
+// one worker group per input header
+static unsigned cps_rpc_group(const cps_rpc_hdr_t *frame) {{
+    switch (frame->fn) {{
+{groups}
+    case CPS_RPC_BATCH:
+        return cps_rpc_batch_group(frame, cps_rpc_group);
+    default:
+        return 0;
+    }}
+}}
+
+// functions with @stream
+static bool cps_rpc_streamable(uint32_t fn) {{
+    switch (fn) {{
+{streams}    default:
+        return false;
+    }}
+}}
+
+cps_err_t cps_rpc_serve(void) {{
+    return cps_rpc_server_run(cps_rpc_handle_frame, cps_rpc_group,
+        cps_rpc_streamable, {ngroups});
+}}
+'''
+PACKED_CLIENT_HEADER_TEMPLATE = '''\
+#pragma once
+
+#include "cps.h"
+{includes}
+#include "rpc.h"
+
+{text}
+'''
+PACKED_STRUCT_TEMPLATE = '''\
+struct __attribute__((packed, aligned(8))) cps_rpc_req_{fn_name} {{
+    {p_fields}
+}};'''
+PACKED_CLIENT_FN_TEMPLATE = '''{fn_type} {fn_name}({c_fn_args}) {{
+    cps_err_t ret;
+    cps_err_t __rpc_err;
+    cps_rpc_hdr_t __rpc_hdr;
+    struct cps_rpc_req_{fn_name} __rpc_req = {{ .hdr.fn = CPS_RPC_{fn_name} }};
+
+    {c_args_pack}
+
+    struct iovec __rpc_iov[] = {{
+        {c_iov}
+    }};
+    cps_rpc_sendv(__rpc_iov);
+
+    cps_rpc_recv(&__rpc_hdr);
+    cps_rpc_recv(&__rpc_err);
+    if (__rpc_err != CPS_ERR_OK) return __rpc_err;{c_result_recv}
+
+    return CPS_ERR_OK;
+}}'''
+PACKED_SERVER_CASE_TEMPLATE = '''\
+    case CPS_RPC_{fn_name}: {{
+        struct cps_rpc_req_{fn_name} *__rpc_req = (void *)frame;
+        if ({s_len_check}) {{
+            ret = CPS_ERR_ARG;
+            cps_rpc_reply(&ret);
+            break;
+        }}
+
+        {s_args}
+
+        {s_call}
+        {s_errcode_send}{s_result_send}
+
+        break;
+    }}'''
+# rpc.py -t: counters of every function, served by the built-in
+# cps_rpc_stats() of rpc_stats.h
+TIMING_TEMPLATE = '''\
+static cps_rpc_timing_t cps_rpc_timing[] = {{
+{t_entries}
+}};
+
+cps_err_t cps_rpc_stats(cps_rpc_stats_t stats[], size_t count) {{
+    return cps_rpc_stats_read(cps_rpc_timing,
+        sizeof(cps_rpc_timing) / sizeof(*cps_rpc_timing), stats, count);
+}}
+
+'''
+PACKED_BATCH_FN_TEMPLATE = '''cps_err_t cps_rpc_batch_{fn_name}({b_fn_args}) {{
+    cps_err_t ret;
+    struct cps_rpc_req_{fn_name} *__rpc_req;
+    size_t __rpc_size = {b_size};{b_max_check}
+
+    CPS_RET_ON_ERR(cps_rpc_batch_reserve(rpc_batch, __rpc_size, (void **)&__rpc_req));
+    __rpc_req->hdr.fn = CPS_RPC_{fn_name};
+    __rpc_req->hdr.len = __rpc_size - sizeof(__rpc_req->hdr);
+    {b_args_pack}{b_out}
+
+    return CPS_ERR_OK;
+}}'''
+
+# Python client: same wire protocol as the C client of the chosen mode
+PY_CLIENT_FILE_TEMPLATE = '''\
+"""
+RPC client generated by rpc.py, do not edit.
+
+Speaks the {mode} wire protocol of the generated C server. `@arraysize`
+arrays take any C-contiguous buffer (NumPy array, ctypes array, bytearray)
+and are sent without copying, plain sequences are packed first.
+`@param[out]` pointers are returned, `@param[out]` arrays are received
+into the (writable) buffer that was passed in.
+"""
+import asyncio
+import ctypes
+import socket
+import struct
+
+# cps_err_t
+ERRORS = (
+{errors}
+)
+
+class RPCError(Exception):
+    """
+    Non-zero `cps_err_t` returned by the server.
+    """
+    def __init__(self, code):
+        self.code = code
+        super().__init__(ERRORS[code] if 0 <= code < len(ERRORS) else f'CPS error {{code}}')
+
+# wire protocol of the generated server
+PACKED = {packed}
+
+{fn_ids}
+
+{records}_HDR = struct.Struct('=IIQ')
+_ERR = struct.Struct('=i')
+# error code of a reply, after its header in packed mode
+_RET = struct.Struct('{ret_fmt}')
+_PAD = bytes(8)
+
+{structs}
+
+def _align(n):
+    return (n + 7) & ~7
+
+def _pad(view):
+    return _PAD[:-len(view) % 8]
+
+def _buffer(obj, elem, size):
+    # bytes of a buffer protocol object, without copying it
+    try:
+        view = memoryview(obj)
+    except TypeError:
+        if isinstance(elem, str):
+            view = memoryview(struct.pack(f'={{len(obj)}}{{elem}}', *obj))
+        else:
+            view = memoryview((elem * len(obj))(*obj))
+    view = view.cast('B')
+    if len(view) % size:
+        raise ValueError(f'buffer of {{len(view)}} bytes is not a multiple of {{size}}')
+    return view
+
+class Client:
+    """
+    Connection to a generated RPC server.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self._buf = bytearray(256)
+        self._view = memoryview(self._buf)
+
+    @classmethod
+    def connect(cls, ip, port):
+        sock = socket.create_connection((ip, port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return cls(sock)
+
+    @classmethod
+    def connect_unix(cls, path):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        return cls(sock)
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _send(self, *parts):
+        # a single sendmsg() per call, like the writev() of the C client
+        n = self.sock.sendmsg(parts)
+        for part in parts:
+            if n < len(part):
+                self.sock.sendall(memoryview(part)[n:])
+                n = 0
+            else:
+                n -= len(part)
+
+    def _recv_into(self, view):
+        while view:
+            n = self.sock.recv_into(view)
+            if n == 0:
+                raise ConnectionError('RPC server closed the connection')
+            view = view[n:]
+
+    def _recv(self, size):
+        # the returned view is only valid until the next receive
+        if size > len(self._buf):
+            self._buf = bytearray(size)
+            self._view = memoryview(self._buf)
+        view = self._view[:size]
+        self._recv_into(view)
+        return view
+
+    def _check(self):
+        ret, = _RET.unpack(self._recv(_RET.size))
+        if ret != 0:
+            raise RPCError(ret)
+
+{text}
+{async_client}'''
+PY_ASYNC_CLIENT_TEMPLATE = '''
+# built-in function ids, see rpc.h
+CPS_RPC_SUBSCRIBE = 0x9001
+CPS_RPC_UNSUBSCRIBE = 0x9002
+
+# header and cps_rpc_subscribe_t
+_SUBSCRIBE = struct.Struct('=IIQQ')
+
+class Stream:
+    """
+    Results of a `@stream` function, pushed by the server every period
+    until the stream is closed (see cps_rpc_subscribe_t). Iterate with
+    `async for`. A failed call raises RPCError without ending the stream.
+    Results queue up while they are not consumed.
+    """
+    def __init__(self, client, tag, decode):
+        self._client = client
+        self.tag = tag
+        self._decode = decode
+        self._queue = asyncio.Queue()
+        self._closing = False
+        self._done = False
+
+    def _push(self, fn, payload):
+        self._queue.put_nowait((fn, payload))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._done:
+            raise StopAsyncIteration
+        fn, payload = await self._queue.get()
+        if fn is None:
+            # connection closed
+            self._done = True
+            raise payload
+
+        err, = _ERR.unpack_from(payload)
+        if fn == CPS_RPC_UNSUBSCRIBE:
+            # last frame of the stream
+            self._done = True
+            if err != 0:
+                raise RPCError(err)
+            raise StopAsyncIteration
+        if err != 0:
+            raise RPCError(err)
+        return self._decode(memoryview(payload)[_ERR.size:])
+
+    async def close(self):
+        """
+        Unsubscribe, dropping the results that were not consumed.
+        """
+        if not (self._closing or self._done or self._client._receiver.done()):
+            self._closing = True
+            self._client._writer.write(_HDR.pack(CPS_RPC_UNSUBSCRIBE, 0, self.tag))
+            await self._client._writer.drain()
+        while not self._done:
+            try:
+                await self.__anext__()
+            except (RPCError, ConnectionError, StopAsyncIteration):
+                pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+class AsyncClient:
+    """
+    asyncio connection to a generated RPC server, with any number of calls
+    in flight. Replies are matched to their call by the tag of the frame,
+    so they may arrive in any order (see cps_rpc_serve()).
+    """
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self._tag = 0
+        self._pending = {{}}
+        self._streams = {{}}
+        self._receiver = asyncio.get_running_loop().create_task(self._receive())
+
+    @classmethod
+    async def connect(cls, ip, port):
+        # asyncio disables Nagle's algorithm on TCP connections
+        return cls(*await asyncio.open_connection(ip, port))
+
+    @classmethod
+    async def connect_unix(cls, path):
+        return cls(*await asyncio.open_unix_connection(path))
+
+    async def close(self):
+        self._writer.close()
+        await self._writer.wait_closed()
+        await self._receiver
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _receive(self):
+        try:
+            while True:
+                fn, length, tag = _HDR.unpack(await self._reader.readexactly(_HDR.size))
+                payload = await self._reader.readexactly(length)
+                stream = self._streams.get(tag)
+                if stream is not None:
+                    if fn == CPS_RPC_UNSUBSCRIBE:
+                        del self._streams[tag]
+                    stream._push(fn, payload)
+                    continue
+
+                reply = self._pending.pop(tag, None)
+                if reply is None or reply.done():
+                    # cancelled call
+                    continue
+
+                err, = _ERR.unpack_from(payload)
+                if err != 0:
+                    reply.set_exception(RPCError(err))
+                else:
+                    reply.set_result(memoryview(payload)[_ERR.size:])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for reply in self._pending.values():
+                if not reply.done():
+                    reply.set_exception(ConnectionError('RPC connection closed'))
+            self._pending.clear()
+            for stream in self._streams.values():
+                stream._push(None, ConnectionError('RPC connection closed'))
+            self._streams.clear()
+
+    def _request(self):
+        if self._receiver.done():
+            raise ConnectionError('RPC connection closed')
+        self._tag += 1
+        reply = self._receiver.get_loop().create_future()
+        self._pending[self._tag] = reply
+        return self._tag, reply
+
+    async def _wait(self, reply):
+        await self._writer.drain()
+        return await reply
+
+    async def _subscribe(self, period, decode, parts):
+        period_ns = round(period * 1e9)
+        if period_ns < 1:
+            raise ValueError('period must be positive')
+        if self._receiver.done():
+            raise ConnectionError('RPC connection closed')
+        self._tag += 1
+        stream = Stream(self, self._tag, decode)
+        self._streams[self._tag] = stream
+        length = _SUBSCRIBE.size - _HDR.size + sum(map(len, parts))
+        self._writer.writelines((
+            _SUBSCRIBE.pack(CPS_RPC_SUBSCRIBE, length, self._tag, period_ns), *parts))
+        await self._writer.drain()
+        return stream
+
+{text}
+'''
+PY_RECORD_TEMPLATE = '''\
+class {r_name}(ctypes.Structure):
+    {r_pack}_fields_ = [
+        {r_fields}
+    ]
+
+if ctypes.sizeof({r_name}) != {r_size}:
+    raise ImportError('{r_name} does not match the C struct layout')
+
+'''
+PY_STATS_METHOD_TEMPLATE = '''\
+    {py_def} stats(self):
+        """
+        Timing of the server functions by name, see cps_rpc_stats().
+        """
+        stats = (cps_rpc_stats_t * len(_FN_NAMES))()
+        {py_await}self.cps_rpc_stats(stats)
+        return {{_FN_NAMES[s.fn]: s for s in stats if s.fn in _FN_NAMES}}'''
+PY_METHOD_TEMPLATE = '''\
+    {py_def} {fn_name}(self{py_params}):
+        """
+        {py_proto}
+        """
+        {py_body}'''
+PY_STREAM_METHOD_TEMPLATE = '''\
+    async def {fn_name}_stream(self, period{py_params}):
+        """
+        Stream of {fn_name}() results, called by the server every `period`
+        seconds. See Stream.
+        """
+        {py_body}'''
+
+# keep in sync with cps_err_t in cps.h
+CPS_ERRORS = ['CPS_ERR_OK', 'CPS_ERR_FAIL', 'CPS_ERR_SYS', 'CPS_ERR_DXL',
+    'CPS_ERR_ARG', 'CPS_ERR_NOT_READY', 'CPS_ERR_DRIVE_MODE', 'CPS_ERR_TORQUE_OFF',
+    'CPS_ERR_TORQUE_ON', 'CPS_ERR_NO_MEM', 'CPS_ERR_RPC_SOCKET']
+
+PY_STRUCT_FORMATS = {
+    ('int', 1): 'b', ('int', 2): 'h', ('int', 4): 'i', ('int', 8): 'q',
+    ('uint', 1): 'B', ('uint', 2): 'H', ('uint', 4): 'I', ('uint', 8): 'Q',
+    ('bool', 1): '?', ('float', 4): 'f', ('float', 8): 'd',
+}
+PY_CTYPES = {
+    ('int', 1): 'ctypes.c_int8', ('int', 2): 'ctypes.c_int16',
+    ('int', 4): 'ctypes.c_int32', ('int', 8): 'ctypes.c_int64',
+    ('uint', 1): 'ctypes.c_uint8', ('uint', 2): 'ctypes.c_uint16',
+    ('uint', 4): 'ctypes.c_uint32', ('uint', 8): 'ctypes.c_uint64',
+    ('bool', 1): 'ctypes.c_bool', ('float', 4): 'ctypes.c_float',
+    ('float', 8): 'ctypes.c_double',
+}
+
+RE_ARRAYSIZE = re.compile(r'\@arraysize\s+([_a-zA-Z0-9]+)\s+([_a-zA-Z0-9]+)(?:\s+max\s+([_a-zA-Z0-9]+))?')
+RE_INT_SUFFIX = re.compile(r'[uUlL]+$')
+RE_STREAM = re.compile(r'\@stream\b')
 RE_PARAM_OUT = re.compile(r'\@param\s*\[.*\bout\b.*\]\s+([_a-zA-Z0-9]+)')
+RE_CONST = re.compile(r'\bconst\b\s*')
+RE_STRUCT = re.compile(r'\bstruct\b\s*')
+
+SIGNED_KINDS = (TypeKind.CHAR_S, TypeKind.SCHAR, TypeKind.SHORT, TypeKind.INT,
+    TypeKind.LONG, TypeKind.LONGLONG)
+UNSIGNED_KINDS = (TypeKind.CHAR_U, TypeKind.UCHAR, TypeKind.USHORT, TypeKind.UINT,
+    TypeKind.ULONG, TypeKind.ULONGLONG)
 
 # helper functions
 def die(s): click.echo(s, err=True); sys.exit(1)
 def indent(s = '', n = 1): return (n * '    ') + s
 
 def name(sym): return sym.spelling
-def is_ptr(sym): return sym.type.kind == TypeKind.POINTER
-def is_array(sym): return sym.type.kind == TypeKind.INCOMPLETEARRAY
+def is_ptr(arg): return arg.kind == 'pointer'
+def is_array(arg): return arg.kind == 'array'
 
 def is_dynsize(arg):
     return arg.szvar is not None
@@ -84,17 +609,15 @@ def emit_sizeof(arg):
 def emit_ptr_type(arg):
     # pointer to data stored inside
     if is_ptr(arg) or is_array(arg):
-        return name(deref(arg)) + ' *'
+        return deref(arg) + ' *'
     else:
-        return name(arg.type) + ' *'
+        return arg.type + ' *'
 
 def deref(arg):
-    if is_array(arg):
-        return arg.type.get_array_element_type()
-    elif is_ptr(arg):
-        return arg.type.get_pointee()
+    if is_array(arg) or is_ptr(arg):
+        return arg.elem_type
     else:
-        raise
+        raise ValueError(f'not an array or pointer: {name(arg)}')
 
 def emit_send(arg):
     if is_dynsize(arg):
@@ -112,92 +635,406 @@ def emit_recv(arg):
     else:
         return f'cps_rpc_recv(&{name(arg)});'
 
+def emit_max_check(arg, prefix = ''):
+    return f'{prefix}{name(arg.szvar)} > {arg.maxlen}'
+
 def emit_server_alloc(arg):
-    if is_dynsize(arg):
+    if is_dynsize(arg) and arg.maxlen is not None:
+        # static scratch buffer, the legacy server has a single client
+        return [
+            f'static {emit_elem_type(arg)} _{name(arg)}[{arg.maxlen}];',
+            f'{emit_ptr_type(arg)}{name(arg)} = {name(arg.szvar)} <= {arg.maxlen} ? _{name(arg)} : NULL;'
+        ]
+    elif is_dynsize(arg):
         return [f'{emit_ptr_type(arg)}{name(arg)} = malloc({emit_sizeof(arg)});']
-        # TODO: check malloc return for NULL
     elif is_ptr(arg) or is_array(arg):
         return [
-            f'{name(deref(arg))} _{name(arg)};',
+            f'{deref(arg)} _{name(arg)};',
             f'{emit_ptr_type(arg)}{name(arg)} = &_{name(arg)};'
         ]
     else:
-        return [f'{name(arg.type)} {name(arg)};']
+        return [f'{arg.type} {name(arg)};']
 
-def emit_server_free(arg):
+def emit_server_recv(arg):
+    # arrays that could not be stored are still read, to stay in sync
     if is_dynsize(arg):
+        return f'cps_rpc_recv_dynarray_or_drain({name(arg)}, {name(arg.szvar)});'
+    else:
+        return emit_recv(arg)
+
+def emit_server_check(arg):
+    # condition and error code rejecting a call instead of running it
+    if arg.maxlen is not None:
+        return (emit_max_check(arg), 'CPS_ERR_ARG')
+    else:
+        return (f'{name(arg)} == NULL && {name(arg.szvar)} > 0', 'CPS_ERR_NO_MEM')
+
+def emit_checked_call(s_call, checks):
+    if not checks:
+        return s_call
+
+    lines = []
+    for i, (cond, err) in enumerate(checks):
+        lines += [('} else if' if i else 'if') + f' ({cond}) {{', indent(f'ret = {err};')]
+    lines += ['} else {', indent(s_call), '}']
+    return ('\n' + indent(n=2)).join(lines)
+
+def emit_result_send(s_errcode_send, s_result_send, nested):
+    # results only follow a successful call. Sending the error code
+    # overwrites ret with the status of the write, so the status of the
+    # call is kept aside. Nesting the results instead of breaking out
+    # early keeps the code after them running
+    s_errcode_send = ('cps_err_t __rpc_ret = ret;\n'
+        + indent(n=2) + s_errcode_send)
+    if nested:
+        return s_errcode_send, ('\n' + indent('if (__rpc_ret == CPS_ERR_OK) {', n=2)
+            + '\n' + indent(s_result_send.replace('\n', '\n' + indent()), n=3)
+            + '\n' + indent('}', n=2))
+    return s_errcode_send, ('\n' + indent('if (__rpc_ret != CPS_ERR_OK) break;', n=2)
+        + '\n\n' + indent(s_result_send, n=2))
+
+def emit_server_free(arg):
+    if is_dynsize(arg) and arg.maxlen is None:
         return f'free({name(arg)});';
     else:
         return None
 
+def emit_elem_type(arg):
+    # element type of an array or pointer, without qualifiers
+    return RE_CONST.sub('', deref(arg)).strip()
+
+def emit_field_type(arg):
+    # type of the request struct field holding a fixed-size argument
+    if is_ptr(arg):
+        return emit_elem_type(arg)
+    else:
+        return RE_CONST.sub('', arg.type).strip()
+
+def emit_field(arg):
+    return f'{emit_field_type(arg)} {name(arg)};'
+
+def emit_dynlen(arg, prefix = ''):
+    # byte length of a dynamically sized array
+    return f'sizeof({emit_elem_type(arg)}) * {prefix}{name(arg.szvar)}'
+
+def emit_pack(arg, req = '__rpc_req.'):
+    if is_ptr(arg):
+        return f'{req}{name(arg)} = *{name(arg)};'
+    else:
+        return f'{req}{name(arg)} = {name(arg)};'
+
+def emit_pack_dynarray(arg):
+    # the batch buffer is zeroed, so padding needs no extra work
+    return [
+        f'memcpy(__rpc_dyn, {name(arg)}, {emit_dynlen(arg)});',
+        f'__rpc_dyn += CPS_RPC_ALIGN({emit_dynlen(arg)});'
+    ]
+
+def emit_reply(arg):
+    if is_dynsize(arg):
+        return f'cps_rpc_reply_dynarray({name(arg)}, {name(arg.szvar)});'
+    else:
+        return f'cps_rpc_reply({name(arg)});'
+
+def emit_batch_out(arg):
+    return f'CPS_RET_ON_ERR(cps_rpc_batch_out(rpc_batch, {name(arg)}, {emit_sizeof(arg)}));'
+
+def emit_iov(arg):
+    return [
+        f'{{ (void *){name(arg)}, {emit_dynlen(arg)} }},',
+        f'{{ cps_rpc_pad, CPS_RPC_PAD({emit_dynlen(arg)}) }},',
+    ]
+
+def emit_unpack(arg):
+    # packed struct fields are copied out, since they might be unaligned
+    if is_ptr(arg):
+        return [
+            f'{emit_field_type(arg)} _{name(arg)} = __rpc_req->{name(arg)};',
+            f'{emit_field_type(arg)} *{name(arg)} = &_{name(arg)};'
+        ]
+    else:
+        return [f'{emit_field_type(arg)} {name(arg)} = __rpc_req->{name(arg)};']
+
+def emit_unpack_dynarray(arg):
+    # dynamic arrays start at 8 byte boundaries after the struct
+    return [
+        f'{emit_elem_type(arg)} *{name(arg)} = (void *)__rpc_dyn;',
+        f'__rpc_dyn += CPS_RPC_ALIGN({emit_dynlen(arg)});'
+    ]
+
+def reorder_args(args):
+    '''
+    Send order: size variables go right before their array.
+    '''
+    szvars = [arg.szvar for arg in args if arg.szvar is not None]
+    for arg in args:
+        if arg in szvars:
+            continue
+        if arg.szvar is not None:
+            yield arg.szvar
+        yield arg
+
+def py_name(sym):
+    s = name(sym)
+    return s + '_' if keyword.iskeyword(s) or s == 'self' else s
+
+def py_format(layout):
+    # struct format of a value, anything but scalars is copied as bytes
+    return PY_STRUCT_FORMATS.get((layout['kind'], layout['size']), f'{layout["size"]}s')
+
+def is_scalar(layout):
+    return (layout['kind'], layout['size']) in PY_STRUCT_FORMATS
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def write_if_changed(path, text):
+    '''
+    Only touch the output when its content changes, so that nothing
+    depending on it gets rebuilt needlessly.
+    '''
+    try:
+        with open(path) as f:
+            if f.read() == text:
+                return
+    except FileNotFoundError:
+        pass
+
+    with open(path, 'w') as f:
+        f.write(text)
+
 class Argument:
     '''
-    Simple proxy over existing data to house size variable as needed.
+    Function argument, detached from libclang so that it can be cached.
+
+    `kind` is one of `value`, `pointer` or `array`, `elem_type` is the
+    pointed to type for the latter two, `decl` the declaration as written
+    in the header and `szvar` the `@arraysize` size variable, if any.
+    `maxlen` is the `max` of `@arraysize` as written (a number or a macro)
+    and `max_count` its value. `layout` describes the value or element
+    type (see `HeaderParser.describe_type`).
     '''
-    def __init__(self, arg):
-        self.arg = arg
+    def __init__(self, spelling, kind, type, elem_type=None, decl='', out=False, layout=None,
+            maxlen=None, max_count=None):
+        self.spelling = spelling
+        self.kind = kind
+        self.type = type
+        self.elem_type = elem_type
+        self.decl = decl
+        self.out = out
+        self.layout = layout
+        self.maxlen = maxlen
+        self.max_count = max_count
         self.szvar = None
 
-    def __getattr__(self, attr):
-        if attr in ['szvar']:
-            return object.__getattribute__(self, attr)
-        else:
-            return object.__getattribute__(self.arg, attr)
+    def to_dict(self):
+        d = dict(vars(self))
+        d['szvar'] = name(self.szvar) if self.szvar is not None else None
+        return d
 
-class RPCCodeGenerator:
-    client_data = []
-    server_data = []
-    fn_names = []
-    content = ''
-    socket_name = 'cps_rpc_client_fd'
+class Function:
+    '''
+    Function declaration with its arguments in the original order.
 
-    def __init__(self):
-        Config.set_library_file(CLANG_LIBRARY_FILE)
+    `stream` is set by a `@stream` line, allowing clients to subscribe to
+    the function (packed mode).
+    '''
+    def __init__(self, spelling, result_type, args, stream=False):
+        self.spelling = spelling
+        self.result_type = result_type
+        self.args = args
+        self.stream = stream
 
-    def fn_id_enum(self):
-        lines = [indent(f'CPS_RPC_{i},') for i in sorted(self.fn_names)]
-        lines[0] = lines[0][:-1] + ' = 0xA000,'
-        return '\n'.join([
-            'enum cps_rpc_cmd_t {',
-        ] + lines + [
-            '};'
+    def to_dict(self):
+        return {
+            'spelling': self.spelling,
+            'result_type': self.result_type,
+            'args': [arg.to_dict() for arg in self.args],
+            'stream': self.stream,
+        }
+
+    @staticmethod
+    def from_dict(d):
+        args = {}
+        for a in d['args']:
+            arg = Argument(a['spelling'], a['kind'], a['type'],
+                a['elem_type'], a['decl'], a['out'], a['layout'],
+                a['maxlen'], a['max_count'])
+            args[name(arg)] = arg
+        for a in d['args']:
+            if a['szvar'] is not None:
+                args[a['spelling']].szvar = args[a['szvar']]
+        return Function(d['spelling'], d['result_type'], list(args.values()), d['stream'])
+
+class ParseCache:
+    '''
+    On-disk cache of the functions extracted from a header, so that
+    libclang is skipped when nothing changed.
+
+    An entry is keyed by the header path and contents, the clang arguments
+    and the whitelist. It also records the digest of every file included
+    while parsing, and is only used if none of them changed.
+    '''
+    def __init__(self, path):
+        self.path = path
+
+    def key(self, filename, content, args, whitelist):
+        data = json.dumps([
+            CACHE_VERSION,
+            os.path.abspath(filename),
+            content,
+            args,
+            sorted(whitelist) if whitelist is not None else None,
         ])
+        return hashlib.sha256(data.encode()).hexdigest()
 
-    def client_code(self):
-        text = '\n'.join(self.client_data)
-        return CLIENT_FILE_TEMPLATE.format(text=text, fn_id_enum=self.fn_id_enum())
+    def load(self, key):
+        try:
+            with open(os.path.join(self.path, key + '.json')) as f:
+                entry = json.load(f)
+            for dep, digest in entry['deps'].items():
+                if file_digest(dep) != digest:
+                    return None
+        except (OSError, ValueError, KeyError):
+            # missing, corrupt or outdated entry
+            return None
 
-    def server_code(self):
-        text = '\n'.join(self.server_data)
-        return SERVER_FILE_TEMPLATE.format(text=text, fn_id_enum=self.fn_id_enum())
+        return [Function.from_dict(fn) for fn in entry['fns']]
 
-    def emit_param_decl(self, arg):
+    def store(self, key, fns, deps):
+        entry = {
+            'deps': {dep: file_digest(dep) for dep in deps},
+            'fns': [fn.to_dict() for fn in fns],
+        }
+        os.makedirs(self.path, exist_ok=True)
+        tmp = os.path.join(self.path, key + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp, os.path.join(self.path, key + '.json'))
+
+def init_libclang():
+    # can only be set once per process, before libclang is used
+    if not Config.loaded:
+        Config.set_library_file(CLANG_LIBRARY_FILE)
+
+class HeaderParser:
+    '''
+    libclang front end, producing the Function model of a header.
+    '''
+    def __init__(self):
+        init_libclang()
+        self.content = ''
+        self.macros = {}
+
+    def extract_param_decl(self, sym):
         # TODO: this information should be inside clang somewhere
         # NOTE: get_tokens() sometimes returns no tokens, which is
         # why this function works by directly extracting text
-        return self.content[arg.extent.start.offset:arg.extent.end.offset]
+        return self.content[sym.extent.start.offset:sym.extent.end.offset]
+
+    def parse(self, filename, content, args, whitelist):
+        '''
+        Extract the functions of a header with libclang.
 
-    def process(self, file, args, whitelist):
+        Returns the functions and the files included while parsing.
+        '''
         idx = Index.create()
-        self.content = file.read()
-        tu = idx.parse(file.name, args=args)
+        self.content = content
+        # macros are kept for the `max` of @arraysize
+        tu = idx.parse(filename, args=args,
+            options=TranslationUnit.PARSE_DETAILED_PROCESSING_RECORD)
         diagnostics = list(tu.diagnostics)
         if diagnostics:
             # error messages during parsing
             for i in diagnostics: click.echo(i, err=True)
             sys.exit(1)
 
+        self.macros = {
+            name(sym): [t.spelling for t in sym.get_tokens()][1:]
+            for sym in tu.cursor.get_children()
+            if sym.kind == CursorKind.MACRO_DEFINITION
+        }
+
         # extract only function declarations from the provided file
         # check whitelist if provided
-        fns = filter(lambda sym:
-            sym.location.file.name == file.name and
+        syms = filter(lambda sym:
             sym.kind == CursorKind.FUNCTION_DECL and
+            sym.location.file.name == filename and
             (name(sym) in whitelist if whitelist is not None else True)
             , tu.cursor.get_children())
-        results = map(self.process_fn, fns)
-        for (c, s) in results:
-            self.client_data.append(c)
-            self.server_data.append(s)
+        fns = list(map(self.extract_fn, syms))
+        deps = sorted({os.path.abspath(inc.include.name) for inc in tu.get_includes()})
+        return fns, deps
+
+    def extract_fn(self, fn):
+        try:
+            args = list(self.validate_args(fn.get_arguments()))
+            self.find_szvars(fn, args)
+
+            # TODO: extract @arraysize here too
+            doc_copy = self.process_doc(fn)
+            for arg in args:
+                arg.out = name(arg) in doc_copy
+
+            stream = bool(fn.raw_comment and RE_STREAM.search(fn.raw_comment))
+            if stream and not any(arg.out for arg in args):
+                raise ValueError('only functions with @param[out] results can be streamed')
+
+            return Function(name(fn), name(fn.result_type), args, stream)
+        except Exception as e:
+            die(f'{name(fn)}: {e}')
+
+    def make_arg(self, sym, kind, elem_type=None):
+        return Argument(name(sym), kind, name(sym.type),
+            name(elem_type) if elem_type is not None else None,
+            self.extract_param_decl(sym),
+            layout=self.describe_type(elem_type if elem_type is not None else sym.type))
+
+    def describe_type(self, type):
+        '''
+        Size and layout of a type, for clients generated in other languages.
+
+        `kind` is `int`, `uint`, `bool` or `float` for scalars, `record` for
+        structs (with `name`, `packed` and `fields` at byte offsets),
+        `array` for constant arrays (with `count` elements of `type`) and
+        `opaque` for anything else, which is only copied as bytes.
+        '''
+        canonical = type.get_canonical()
+        kind = canonical.kind
+        if kind == TypeKind.ENUM:
+            kind = canonical.get_declaration().enum_type.get_canonical().kind
+
+        layout = {'size': canonical.get_size()}
+        if kind == TypeKind.BOOL:
+            layout['kind'] = 'bool'
+        elif kind in SIGNED_KINDS:
+            layout['kind'] = 'int'
+        elif kind in UNSIGNED_KINDS:
+            layout['kind'] = 'uint'
+        elif kind in (TypeKind.FLOAT, TypeKind.DOUBLE):
+            layout['kind'] = 'float'
+        elif kind == TypeKind.CONSTANTARRAY:
+            layout['kind'] = 'array'
+            layout['count'] = canonical.element_count
+            layout['type'] = self.describe_type(canonical.element_type)
+        elif (kind == TypeKind.RECORD
+                and canonical.get_declaration().kind == CursorKind.STRUCT_DECL
+                and not any(f.is_bitfield() for f in canonical.get_fields())):
+            decl = canonical.get_declaration()
+            layout['kind'] = 'record'
+            layout['name'] = RE_STRUCT.sub('', RE_CONST.sub('', name(type))).strip()
+            layout['packed'] = any(c.kind == CursorKind.PACKED_ATTR
+                for c in decl.get_children())
+            layout['fields'] = [{
+                'name': name(f),
+                'offset': f.get_field_offsetof() // 8,
+                'type': self.describe_type(f.type),
+            } for f in canonical.get_fields()]
+        else:
+            layout['kind'] = 'opaque'
+
+        return layout
 
     def validate_args(self, args):
         '''
@@ -217,61 +1054,75 @@ class RPCCodeGenerator:
 
         for arg in args:
             type = arg.type.get_canonical()
-            if type.kind in ok_types:
-                yield Argument(arg)
-            elif is_ptr(arg):
+            if type.kind == TypeKind.INCOMPLETEARRAY:
+                yield self.make_arg(arg, 'array', arg.type.get_array_element_type())
+            elif type.kind in ok_types:
+                yield self.make_arg(arg, 'value')
+            elif arg.type.kind == TypeKind.POINTER:
                 target = type.get_pointee()
                 if target == TypeKind.POINTER:
                     raise NotImplementedError('only a single level of pointers is supported')
                 elif target.kind == TypeKind.SCHAR:
                     raise NotImplementedError('C-String are not supported yet')
                 elif target.kind in ok_types:
-                    yield Argument(arg)
+                    yield self.make_arg(arg, 'pointer', arg.type.get_pointee())
                 else:
                     raise NotImplementedError(f'unsupported type: {target.kind}')
             else:
                 raise NotImplementedError(f'unsupported type: {type.kind}')
 
-    def reorder_args(self, fn, args):
+    def find_szvars(self, fn, args):
         if not fn.raw_comment:
             # no sizevars since no comment
-            yield from args
             return
 
         # find all sizevars
         doc_szvars = {}
+        doc_max = {}
         for line in fn.raw_comment.splitlines():
             s = line.strip()
             match = RE_ARRAYSIZE.search(s)
             if not match:
                 continue
 
-            var, szvar = match.groups()
+            var, szvar, maxlen = match.groups()
             doc_szvars[var] = szvar
+            if maxlen is not None:
+                doc_max[var] = maxlen
 
         szvar2var = {}
-        tmp = []
         for arg in args:
             if name(arg) in doc_szvars:
                 if not (is_array(arg) or is_ptr(arg)):
                     raise ValueError('only arrays or pointers can '
                         f'have a corresponding size variable: {name(arg)}')
-                tmp.append(arg)
                 # szvar will be added later, once encountered
                 szvar2var[doc_szvars[name(arg)]] = arg
+                if name(arg) in doc_max:
+                    arg.maxlen = doc_max[name(arg)]
+                    arg.max_count = self.eval_int(arg.maxlen)
             elif is_array(arg):
                 raise ValueError('array variable does not have a '
                     f'corresponding size variable: {name(arg)}')
             elif name(arg) in doc_szvars.values():
-                # a size variable itself, save and skip it
+                # a size variable itself
                 szvar2var[name(arg)].szvar = arg
-            else:
-                tmp.append(arg)
 
-        for arg in tmp:
-            if arg.szvar is not None:
-                yield arg.szvar
-            yield arg
+    def eval_int(self, s):
+        '''
+        Value of an integer literal, or of a macro defined as one.
+        '''
+        seen = set()
+        while s in self.macros and s not in seen:
+            seen.add(s)
+            tokens = self.macros[s]
+            if len(tokens) != 1:
+                raise ValueError(f'{s} is not defined as an integer')
+            s = tokens[0]
+        try:
+            return int(RE_INT_SUFFIX.sub('', s), 0)
+        except ValueError:
+            raise ValueError(f'not an integer: {s}') from None
 
     def process_doc(self, fn):
         doc_copy = []
@@ -285,6 +1136,156 @@ class RPCCodeGenerator:
 
         return doc_copy
 
+def parse_header(filename, content, args, whitelist):
+    # entry point of the worker processes
+    return HeaderParser().parse(filename, content, args, whitelist)
+
+def parse_headers(headers, args, whitelist, cache=None, jobs=1):
+    '''
+    Extract the functions of all headers, given as (name, content) pairs.
+
+    Cache misses are parsed in a process pool. The result is in input
+    order no matter which worker finishes first, so the generated code
+    does not depend on scheduling.
+    '''
+    results = [None] * len(headers)
+    keys = [None] * len(headers)
+    todo = []
+    for i, (filename, content) in enumerate(headers):
+        if cache is not None:
+            keys[i] = cache.key(filename, content, args, whitelist)
+            results[i] = cache.load(keys[i])
+        if results[i] is None:
+            todo.append(i)
+
+    jobs = min(jobs, len(todo))
+    if jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(parse_header, *headers[i], args, whitelist)
+                for i in todo]
+            parsed = [future.result() for future in futures]
+    else:
+        parsed = [parse_header(*headers[i], args, whitelist) for i in todo]
+
+    for i, (fns, deps) in zip(todo, parsed):
+        results[i] = fns
+        if cache is not None:
+            cache.store(keys[i], fns, deps)
+
+    return results
+
+class RPCCodeGenerator:
+    socket_name = 'cps_rpc_client_fd'
+
+    def __init__(self, packed=False, includes=(), timing=False):
+        self.packed = packed
+        self.includes = includes
+        self.timing = timing
+        self.client_data = []
+        self.server_data = []
+        self.struct_data = []
+        self.header_data = []
+        self.fn_names = []
+        self.groups = []
+        self.streams = []
+
+    def fn_id_enum(self):
+        lines = [indent(f'CPS_RPC_{i},') for i in sorted(self.fn_names)]
+        lines[0] = lines[0][:-1] + ' = 0xA000,'
+        return '\n'.join([
+            'enum cps_rpc_cmd_t {',
+        ] + lines + [
+            '};'
+        ])
+
+    def emit_includes(self):
+        # the input headers, for the functions and their argument types
+        return '\n'.join(f'#include "{i}"' for i in self.includes)
+
+    def client_code(self):
+        text = '\n'.join(self.client_data)
+        includes = self.emit_includes()
+        if self.packed:
+            return PACKED_CLIENT_FILE_TEMPLATE.format(text=text, includes=includes,
+                fn_id_enum=self.fn_id_enum(), req_structs=self.req_structs())
+        return CLIENT_FILE_TEMPLATE.format(text=text, includes=includes,
+            fn_id_enum=self.fn_id_enum())
+
+    def server_code(self):
+        text = '\n'.join(self.server_data)
+        includes = self.emit_includes()
+        if self.packed:
+            return PACKED_SERVER_FILE_TEMPLATE.format(text=text, includes=includes,
+                fn_id_enum=self.fn_id_enum(), req_structs=self.req_structs(),
+                timing=self.timing_code(), streams=self.stream_cases(),
+                groups=self.group_cases(), ngroups=max(len(self.groups), 1),
+                nfns=len(self.fn_names))
+        return SERVER_FILE_TEMPLATE.format(text=text, includes=includes,
+            fn_id_enum=self.fn_id_enum(), timing=self.timing_code())
+
+    def timing_code(self):
+        if not self.timing:
+            return ''
+        t_entries = '\n'.join(
+            indent(f'[CPS_RPC_{fn_name} - 0xA000] = {{ .fn = CPS_RPC_{fn_name} }},')
+            for fn_name in sorted(self.fn_names)
+        )
+        return TIMING_TEMPLATE.format(t_entries=t_entries)
+
+    def emit_timing(self, fn_name, s_args, s_call, s_result_send):
+        '''
+        Timestamps around receiving the arguments, the call and sending
+        the results of a server case (-t). The results must be nested (see
+        `emit_result_send`), so that failed calls are counted.
+        '''
+        s_args = ('\n' + indent(n=2)).join(filter(None,
+            ['uint64_t __rpc_t[4] = { cps_rpc_stats_start() };', s_args]))
+        s_call = ('\n' + indent(n=2)).join([
+            '__rpc_t[1] = cps_rpc_clock_ns();',
+            s_call,
+            '__rpc_t[2] = cps_rpc_clock_ns();',
+        ])
+        s_result_send += '\n' + indent(
+            f'cps_rpc_stats_end(&cps_rpc_timing[CPS_RPC_{fn_name} - 0xA000], __rpc_t);', n=2)
+        return s_args, s_call, s_result_send
+
+    def client_header(self):
+        text = '\n'.join(self.header_data)
+        return PACKED_CLIENT_HEADER_TEMPLATE.format(text=text,
+            includes=self.emit_includes())
+
+    def group_cases(self):
+        return '\n'.join(
+            '\n'.join(indent(f'case CPS_RPC_{fn_name}:') for fn_name in group)
+            + '\n' + indent(f'return {i};', n=2)
+            for i, group in enumerate(self.groups)
+        )
+
+    def stream_cases(self):
+        if not self.streams:
+            return ''
+        return '\n'.join(
+            [indent(f'case CPS_RPC_{fn_name}:') for fn_name in sorted(self.streams)]
+            + [indent('return true;', n=2), ''])
+
+    def req_structs(self):
+        return '\n\n'.join(self.struct_data)
+
+    def emit_param_decl(self, arg):
+        return arg.decl
+
+    def process(self, fns):
+        if fns:
+            self.groups.append(list(map(name, fns)))
+        results = map(self.process_fn, fns)
+        for (c, s, st, h) in results:
+            self.client_data.append(c)
+            self.server_data.append(s)
+            if st is not None:
+                self.struct_data.append(st)
+            if h is not None:
+                self.header_data.append(h)
+
     def process_fn(self, fn):
         try:
             return self._process_fn(fn)
@@ -294,21 +1295,21 @@ class RPCCodeGenerator:
     def _process_fn(self, fn):
         socket_name = self.socket_name
         fn_name = name(fn)
-        fn_type = name(fn.result_type)
-
-        orig_args = list(self.validate_args(fn.get_arguments()))
-        args = list(self.reorder_args(fn, orig_args))
-
-        # TODO: extract @arraysize here too
-        doc_copy = self.process_doc(fn)
+        fn_type = fn.result_type
 
+        orig_args = fn.args
+        args = list(reorder_args(orig_args))
 
         ## CLIENT SIDE ##
         # use original argument order for the function since this is
         # what the caller expects
         c_fn_args = ', '.join(map(self.emit_param_decl, orig_args))
 
-        c_args_send = ('\n' + indent()).join([
+        # too long arrays are rejected before anything is sent
+        c_max_checks = [f'if ({emit_max_check(arg)}) return CPS_ERR_ARG;'
+            for arg in orig_args if is_dynsize(arg) and arg.maxlen is not None]
+
+        c_args_send = ('\n' + indent()).join(c_max_checks + [
             f'uint32_t __rpc_fn_id = CPS_RPC_{fn_name};',
             f'cps_rpc_send(&__rpc_fn_id);'
         ] + list(map(emit_send, args))
@@ -319,14 +1320,20 @@ class RPCCodeGenerator:
             'if (ret != CPS_ERR_OK) return ret;'
         ])
 
-        args_recv_back = list(filter(lambda x: name(x) in doc_copy, args))
+        args_recv_back = list(filter(lambda x: x.out, args))
         c_result_recv = ('\n' + indent()).join(
             map(emit_recv, args_recv_back)
         )
 
+        if self.packed:
+            if fn.stream:
+                self.streams.append(fn_name)
+            return self.emit_packed(fn_name, fn_type, orig_args, c_fn_args,
+                args_recv_back, c_result_recv, c_max_checks)
+
         ## SERVER SIDE ##
         args_alloc = map(emit_server_alloc, args)
-        args_recv = map(emit_recv, args)
+        args_recv = map(emit_server_recv, args)
         s_args = ('\n\n' + indent(n=2)).join(
             map(lambda x: ('\n' + indent(n=2)).join(x[0]) + '\n' + indent(x[1], n=2), zip(args_alloc, args_recv))
         )
@@ -335,7 +1342,8 @@ class RPCCodeGenerator:
             filter(lambda x: x is not None, map(emit_server_free, args))
         )
         srv_fn_args = ', '.join(map(name, orig_args))
-        s_call = f'ret = {fn_name}({srv_fn_args});'
+        s_call = emit_checked_call(f'ret = {fn_name}({srv_fn_args});',
+            [emit_server_check(arg) for arg in args if is_dynsize(arg)])
         s_errcode_send = ('\n' + indent(n=2)).join([
             'cps_rpc_send(&ret);'
         ])
@@ -347,14 +1355,343 @@ class RPCCodeGenerator:
         if c_result_recv != '':
             c_result_recv = '\n\n' + indent(c_result_recv)
         if s_result_send != '':
-            s_result_send = ('\n' + indent('if (ret != CPS_ERR_OK) break;', n=2)
-                + '\n\n' + indent(s_result_send, n=2))
+            s_errcode_send, s_result_send = emit_result_send(s_errcode_send, s_result_send, self.timing or s_args_free != '')
+        if self.timing:
+            s_args, s_call, s_result_send = self.emit_timing(fn_name, s_args, s_call, s_result_send)
         if s_args_free != '':
             s_args_free = '\n\n' + indent(s_args_free, n=2)
 
         # register function as processed
         self.fn_names.append(fn_name)
-        return (CLIENT_FN_TEMPLATE.format(**locals()), SERVER_CASE_TEMPLATE.format(**locals()))
+        return (CLIENT_FN_TEMPLATE.format(**locals()), SERVER_CASE_TEMPLATE.format(**locals()), None, None)
+
+    def emit_packed(self, fn_name, fn_type, orig_args, c_fn_args, args_recv_back, c_result_recv, c_max_checks):
+        '''
+        Packed mode: everything except dynamically sized arrays goes into
+        a request struct, so that a call is a single writev() on the client
+        and a header read plus a payload read on the server. The same
+        struct is used to queue the call into a batch.
+        '''
+        fixed = [arg for arg in orig_args if not is_dynsize(arg)]
+        dyn = [arg for arg in orig_args if is_dynsize(arg)]
+
+        p_fields = ('\n' + indent()).join(
+            ['cps_rpc_hdr_t hdr;'] + list(map(emit_field, fixed))
+        )
+
+        ## CLIENT SIDE ##
+        c_len = ' + '.join(
+            ['sizeof(__rpc_req) - sizeof(__rpc_req.hdr)']
+            + [f'CPS_RPC_ALIGN({emit_dynlen(arg)})' for arg in dyn]
+        )
+        c_args_pack = ('\n' + indent()).join(
+            c_max_checks
+            + list(map(emit_pack, fixed))
+            + [f'__rpc_req.hdr.len = {c_len};']
+        )
+        c_iov = ('\n' + indent(n=2)).join(
+            ['{ &__rpc_req, sizeof(__rpc_req) },']
+            + [line for arg in dyn for line in emit_iov(arg)]
+        )
+
+        ## SERVER SIDE ##
+        s_fixed_len = 'sizeof(*__rpc_req) - sizeof(*frame)'
+        if dyn:
+            # make sure the size variables are inside the frame before
+            # using them, and that they cannot overflow the length
+            s_len_check = [f'frame->len < {s_fixed_len}']
+            s_len_check += [emit_max_check(arg, '__rpc_req->')
+                for arg in dyn if arg.maxlen is not None]
+            s_len_check += [
+                f'__rpc_req->{name(arg.szvar)} > frame->len / sizeof({emit_elem_type(arg)})'
+                for arg in dyn
+            ]
+            s_len_check.append(' + '.join(
+                [f'frame->len != {s_fixed_len}']
+                + [f'CPS_RPC_ALIGN({emit_dynlen(arg, "__rpc_req->")})' for arg in dyn]
+            ))
+        else:
+            s_len_check = [f'frame->len != {s_fixed_len}']
+        s_len_check = (' ||\n' + indent(n=3)).join(s_len_check)
+
+        s_args = [line for arg in fixed for line in emit_unpack(arg)]
+        if dyn:
+            s_args.append('uint8_t *__rpc_dyn = (void *)(__rpc_req + 1);')
+            s_args += [line for arg in dyn for line in emit_unpack_dynarray(arg)]
+        s_args = ('\n' + indent(n=2)).join(s_args)
+
+        srv_fn_args = ', '.join(map(name, orig_args))
+        s_call = f'ret = {fn_name}({srv_fn_args});'
+        s_errcode_send = 'cps_rpc_reply(&ret);'
+        s_result_send = ('\n' + indent(n=2)).join(
+            map(emit_reply, args_recv_back)
+        )
+
+        ## BATCH CLIENT SIDE ##
+        b_fn_args = ', '.join(['cps_rpc_batch_t *rpc_batch']
+            + list(map(self.emit_param_decl, orig_args)))
+        b_size = ' + '.join(
+            ['sizeof(*__rpc_req)']
+            + [f'CPS_RPC_ALIGN({emit_dynlen(arg)})' for arg in dyn]
+        )
+        b_args_pack = [emit_pack(arg, '__rpc_req->') for arg in fixed]
+        if dyn:
+            b_args_pack.append('uint8_t *__rpc_dyn = (void *)(__rpc_req + 1);')
+            b_args_pack += [line for arg in dyn for line in emit_pack_dynarray(arg)]
+        b_args_pack = ('\n' + indent()).join(b_args_pack)
+        b_out = ('\n' + indent()).join(map(emit_batch_out, args_recv_back))
+        b_max_check = ''.join('\n' + indent(line) for line in c_max_checks)
+
+        ## WHITESPACE ##
+        if c_result_recv != '':
+            c_result_recv = '\n\n' + indent(c_result_recv)
+        if s_result_send != '':
+            s_errcode_send, s_result_send = emit_result_send(s_errcode_send, s_result_send, self.timing)
+        if self.timing:
+            s_args, s_call, s_result_send = self.emit_timing(fn_name, s_args, s_call, s_result_send)
+        if b_out != '':
+            b_out = '\n\n' + indent(b_out)
+
+        # register function as processed
+        self.fn_names.append(fn_name)
+        c_fn = PACKED_CLIENT_FN_TEMPLATE.format(**locals())
+        b_fn = PACKED_BATCH_FN_TEMPLATE.format(**locals())
+        return (c_fn + '\n\n' + b_fn,
+            PACKED_SERVER_CASE_TEMPLATE.format(**locals()),
+            PACKED_STRUCT_TEMPLATE.format(**locals()),
+            f'cps_err_t cps_rpc_batch_{fn_name}({b_fn_args});')
+
+class PythonClientGenerator:
+    '''
+    Python client module, speaking the same wire protocol as the C client
+    generated in the same mode.
+
+    Request layouts are precompiled into `struct.Struct` objects, and
+    structs used in arguments become `ctypes.Structure` classes, so that
+    NumPy arrays with a matching dtype can be sent as they are.
+    '''
+    def __init__(self, packed=False, timing=False):
+        self.packed = packed
+        self.timing = timing
+        self.fns = []
+        self.records = {}
+
+    def process(self, fns):
+        self.fns += fns
+
+    def code(self):
+        # same numbering as the fn_id_enum of the C code
+        fn_ids = '\n'.join(f'CPS_RPC_{fn_name} = {0xA000 + i:#x}'
+            for i, fn_name in enumerate(sorted(map(name, self.fns))))
+        structs, methods, async_methods = [], [], []
+        for fn in self.fns:
+            st, m, am = self.process_fn(fn)
+            structs += st
+            methods.append(m)
+            if am is not None:
+                async_methods.append(am)
+
+        if self.timing:
+            fn_ids += '\n\n_FN_NAMES = {\n' + '\n'.join(
+                indent(f"CPS_RPC_{fn_name}: '{fn_name}',")
+                for fn_name in sorted(map(name, self.fns))) + '\n}'
+            methods.append(PY_STATS_METHOD_TEMPLATE.format(py_def='def', py_await=''))
+            async_methods.append(PY_STATS_METHOD_TEMPLATE.format(
+                py_def='async def', py_await='await '))
+
+        async_client = ''
+        if self.packed:
+            async_client = PY_ASYNC_CLIENT_TEMPLATE.format(text='\n\n'.join(async_methods))
+        return PY_CLIENT_FILE_TEMPLATE.format(
+            mode='packed' if self.packed else 'legacy',
+            packed=self.packed,
+            ret_fmt='=16xi' if self.packed else '=i',
+            async_client=async_client,
+            errors='\n'.join(indent(f"'{e}',") for e in CPS_ERRORS),
+            fn_ids=fn_ids,
+            records=''.join(self.records.values()),
+            structs='\n'.join(structs),
+            text='\n\n'.join(methods),
+        )
+
+    def py_ctype(self, layout):
+        '''
+        ctypes type of a layout, defining the classes of structs on the way.
+        '''
+        key = (layout['kind'], layout['size'])
+        if key in PY_CTYPES:
+            return PY_CTYPES[key]
+        elif layout['kind'] == 'array':
+            return f'({self.py_ctype(layout["type"])} * {layout["count"]})'
+        elif layout['kind'] != 'record':
+            return f'(ctypes.c_uint8 * {layout["size"]})'
+
+        r_name = layout['name']
+        if not r_name.isidentifier():
+            r_name = f'_record{len(self.records)}'
+        if r_name in self.records:
+            return r_name
+
+        r_fields = ('\n' + indent(n=2)).join(
+            f"('{f['name']}', {self.py_ctype(f['type'])}),"
+            for f in layout['fields']
+        )
+        r_pack = '_pack_ = 1\n' + indent() if layout['packed'] else ''
+        r_size = layout['size']
+        self.records[r_name] = PY_RECORD_TEMPLATE.format(**locals())
+        return r_name
+
+    def py_elem(self, arg):
+        # element of a dynamic array: struct format or ctypes type
+        if is_scalar(arg.layout):
+            return repr(py_format(arg.layout))
+        return self.py_ctype(arg.layout)
+
+    def process_fn(self, fn):
+        try:
+            return self._process_fn(fn)
+        except Exception as e:
+            die(f'{name(fn)}: {e}')
+
+    def _process_fn(self, fn):
+        fn_name = name(fn)
+        args = list(reorder_args(fn.args))
+        dyn = [arg for arg in args if is_dynsize(arg)]
+        szvars = [arg.szvar for arg in dyn]
+        # size variables follow from the buffers, fixed outputs are returned
+        params = [arg for arg in fn.args
+            if arg not in szvars and (is_dynsize(arg) or not arg.out)]
+        outs = [arg for arg in args if arg.out]
+
+        def value(arg):
+            if arg in szvars or arg in params:
+                return py_name(arg) if is_scalar(arg.layout) else f'bytes({py_name(arg)})'
+            return '0' if is_scalar(arg.layout) else "b''"
+
+        structs = []
+        def struct(prefix, fmt):
+            s_name = f'{prefix}_{fn_name}'
+            if any(st.startswith(s_name + ' ') for st in structs):
+                s_name += f'_{len(structs)}'
+            structs.append(f"{s_name} = struct.Struct('{fmt}')")
+            return s_name
+
+        py_body = []
+        for arg in dyn:
+            size = arg.layout['size']
+            py_body += [
+                f'{py_name(arg)} = _buffer({py_name(arg)}, {self.py_elem(arg)}, {size})',
+                f'{py_name(arg.szvar)} = len({py_name(arg)}) // {size}',
+            ]
+            if arg.max_count is not None:
+                py_body += [
+                    f'if {py_name(arg.szvar)} > {arg.max_count}:',
+                    indent(f"raise ValueError('{name(arg)} has more than {arg.max_count} elements')"),
+                ]
+
+        ## REQUEST ##
+        parts = []
+        if self.packed:
+            # header and fixed-size arguments, padded like the C struct
+            fixed = [arg for arg in fn.args if not is_dynsize(arg)]
+            size = 16 + sum(arg.layout['size'] for arg in fixed)
+            fmt = '=IIQ' + ''.join(py_format(arg.layout) for arg in fixed)
+            if size % 8:
+                fmt += f'{-size % 8}x'
+            req = struct('_REQ', fmt)
+            length = ' + '.join([f'{req}.size - _HDR.size']
+                + [f'_align(len({py_name(arg)}))' for arg in dyn])
+            values = [f'CPS_RPC_{fn_name}', length, '{tag}'] + list(map(value, fixed))
+            parts.append(f'{req}.pack({", ".join(values)})')
+            for arg in dyn:
+                parts += [py_name(arg), f'_pad({py_name(arg)})']
+        else:
+            # one run of values between every dynamic array, as the
+            # C client sends them one after another
+            fmt, values = '=I', [f'CPS_RPC_{fn_name}']
+            for arg in args + [None]:
+                if arg is not None and not is_dynsize(arg):
+                    fmt += py_format(arg.layout)
+                    values.append(value(arg))
+                    continue
+                if values:
+                    parts.append(f'{struct("_REQ", fmt)}.pack({", ".join(values)})')
+                    fmt, values = '=', []
+                if arg is not None:
+                    parts.append(py_name(arg))
+        # the sync client has a single call in flight, with tag 0
+        py_parts = (',\n' + indent(n=3)).join(parts)
+        if len(parts) == 1:
+            py_parts += ','
+        py_prelude = list(py_body)
+        py_async_body = py_body + [
+            'tag, reply = self._request()',
+            f'self._writer.writelines(({py_parts.format(tag="tag")}))',
+            ('payload = ' if outs else '') + 'await self._wait(reply)',
+        ]
+        # a stream decodes every pushed payload like a reply
+        py_decode_start = len(py_async_body)
+        py_body.append(f'self._send({py_parts.format(tag="0").rstrip(",")})')
+
+        ## RESPONSE ##
+        # the async client parses the payload, the sync one reads directly
+        # into the results
+        py_body.append('self._check()')
+        results = []
+        run = []
+        offset = []
+        for arg in outs + [None]:
+            if arg is not None and not is_dynsize(arg):
+                run.append(arg)
+                continue
+            if run:
+                rep = struct('_REP', '=' + ''.join(py_format(a.layout) for a in run))
+                targets = ''.join(f'{py_name(a)}, ' for a in run)[:-1]
+                py_body.append(f'{targets} = {rep}.unpack(self._recv({rep}.size))')
+                py_async_body.append(f'{targets} = {rep}.unpack_from(payload, '
+                    f'{" + ".join(offset) or 0})')
+                offset.append(f'{rep}.size')
+                for a in run:
+                    if a.layout['kind'] == 'record':
+                        unwrap = (f'{py_name(a)} = '
+                            f'{self.py_ctype(a.layout)}.from_buffer_copy({py_name(a)})')
+                        py_body.append(unwrap)
+                        py_async_body.append(unwrap)
+                results += run
+                run = []
+            if arg is not None:
+                py_body.append(f'self._recv_into({py_name(arg)})')
+                start = ' + '.join(offset)
+                end = ' + '.join(offset + [f'len({py_name(arg)})'])
+                py_async_body.append(f'{py_name(arg)}[:] = payload[{start}:{end}]')
+                offset.append(f'len({py_name(arg)})')
+        if results:
+            py_body.append('return ' + ', '.join(map(py_name, results)))
+            py_async_body.append('return ' + ', '.join(map(py_name, results)))
+
+        py_params = ''.join(f', {py_name(arg)}' for arg in params)
+        py_proto = f'{fn.result_type} {fn_name}({", ".join(arg.decl for arg in fn.args)})'
+        py_body = ('\n' + indent(n=2)).join(py_body)
+        py_def = 'def'
+        method = PY_METHOD_TEMPLATE.format(**locals())
+        if not self.packed:
+            # replies can only be matched to requests by their tag
+            return structs, method, None
+
+        py_body = ('\n' + indent(n=2)).join(py_async_body)
+        py_def = 'async def'
+        async_method = PY_METHOD_TEMPLATE.format(**locals())
+        if fn.stream:
+            if 'period' in map(py_name, params):
+                raise ValueError('a streamed function cannot have an argument named period')
+            # the request of a stream has tag 0, its frames carry the
+            # tag of the subscription
+            py_body = ('\n' + indent(n=2)).join(py_prelude
+                + ['def decode(payload):']
+                + [indent(line) for line in py_async_body[py_decode_start:]]
+                + [f'return await self._subscribe(period, decode, ({py_parts.format(tag="0")}))'])
+            async_method += '\n\n' + PY_STREAM_METHOD_TEMPLATE.format(**locals())
+        return structs, method, async_method
 
 @click.command()
 @click.option('-i', 'inputs',
@@ -366,35 +1703,74 @@ class RPCCodeGenerator:
     help='Include directories.')
 @click.option('-os', 'server',
     default='server/generated.c', show_default=True,
-    type=click.File('w'),
+    type=click.Path(dir_okay=False, writable=True),
     help='Server code output file.')
 @click.option('-oc', 'client',
     default='client/generated.c', show_default=True,
-    type=click.File('w'),
+    type=click.Path(dir_okay=False, writable=True),
     help='Client code output file.')
+@click.option('-oh', 'client_header',
+    default='client/generated.h', show_default=True,
+    type=click.Path(dir_okay=False, writable=True),
+    help='Client batch API header output file (packed mode only).')
+@click.option('-op', 'python_client',
+    default=None,
+    type=click.Path(dir_okay=False, writable=True),
+    help='Python client module output file.')
 @click.option('-w', 'whitelist',
     type=click.File(), default=None,
     help='Whitelisted functions, one per line.')
-def main(inputs, include_dirs, server, client, whitelist):
+@click.option('-p', 'packed',
+    is_flag=True, default=False,
+    help='Send arguments packed into a single request frame.')
+@click.option('-c', 'cache_dir',
+    default='.rpc-cache', show_default=True,
+    help='Parse cache directory, empty to disable caching.')
+@click.option('-t', 'timing',
+    is_flag=True, default=False,
+    help='Time every server function, readable with the built-in cps_rpc_stats().')
+@click.option('-j', 'jobs',
+    default=os.cpu_count() or 1, show_default=True,
+    type=click.IntRange(min=1),
+    help='Number of headers parsed in parallel.')
+def main(inputs, include_dirs, server, client, client_header, python_client, whitelist, packed, cache_dir, timing, jobs):
     if len(inputs) == 0:
         die('no input files provided')
 
     if whitelist is not None:
         whitelist = whitelist.read().splitlines()
 
-    codegen = RPCCodeGenerator()
+    cache = ParseCache(cache_dir) if cache_dir else None
+    includes = [os.path.basename(file.name) for file in inputs]
+    if timing:
+        includes.append(os.path.basename(STATS_HEADER))
+    codegen = RPCCodeGenerator(packed, includes, timing)
+    pycodegen = PythonClientGenerator(packed, timing)
     # TODO: newer standard
     # TODO: better way to collect flags for clang
     args = ['-std=c99']
     args += [f'-I{i}' for i in include_dirs]
-    for file in inputs:
-        codegen.process(file, args, whitelist)
+    headers = [(file.name, file.read()) for file in inputs]
+    results = parse_headers(headers, args, whitelist, cache, jobs)
+    if timing:
+        # the built-in functions are never filtered by the whitelist
+        with open(STATS_HEADER) as f:
+            results += parse_headers([(STATS_HEADER, f.read())], args, None, cache)
+    for fns in results:
+        codegen.process(fns)
+        pycodegen.process(fns)
 
     code = codegen.client_code()
-    client.write(code)
+    write_if_changed(client, code)
 
     code = codegen.server_code()
-    server.write(code)
+    write_if_changed(server, code)
+
+    if packed:
+        write_if_changed(client_header, codegen.client_header())
+
+    if python_client is not None:
+        write_if_changed(python_client, pycodegen.code())
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,22 @@
+#pragma once
+
+#include <stddef.h>
+
+#include "cps.h"
+#include "rpc.h"
+
+/**
+ * @brief Built-in function of servers generated with `rpc.py -t`. Timing
+ * of every generated function.
+ *
+ * @details
+ * Entries are in function id order. Entries past the number of functions
+ * are zeroed.
+ *
+ * @param[out] stats timing of each function
+ * @param count number of entries
+ * @arraysize stats count
+ *
+ * @retval CPS_ERR_OK no error
+ */
+cps_err_t cps_rpc_stats(cps_rpc_stats_t stats[], size_t count);
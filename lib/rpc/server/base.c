@@ -3,10 +3,26 @@
 
 #include <sys/socket.h> // socket, bind, listen, setsockopt
 #include <arpa/inet.h> // inet_pton, sockaddr_in
+#include <sys/un.h> // sockaddr_un
+#include <string.h> // memcpy, memset, strcpy
+#include <stdbool.h>
+#include <errno.h>
+#include <poll.h> // poll
+#include <pthread.h>
+#include <signal.h> // signal
+#include <time.h> // clock_gettime
+#include <unistd.h> // close, unlink
 
 int cps_rpc_server_fd;
 int cps_rpc_client_fd;
 
+// timing of calls (rpc.py -t): header read of the frame being handled, or
+// end of the previous call of its batch
+static __thread uint64_t stats_start = 0;
+// call waiting for its reply to be written, with its timestamps
+static __thread cps_rpc_timing_t *stats_pending = NULL;
+static __thread uint64_t stats_t[4];
+
 cps_err_t cps_rpc_server_init(const char *ip, int port) {
     int opt = 1;
     struct sockaddr_in _addr;
@@ -39,6 +55,31 @@ cps_err_t cps_rpc_server_init(const char *ip, int port) {
     return CPS_ERR_OK;
 }
 
+cps_err_t cps_rpc_server_init_unix(const char *path) {
+    struct sockaddr_un addr = { .sun_family = AF_UNIX };
+
+    if (strlen(path) >= sizeof(addr.sun_path)) {
+        return CPS_ERR_ARG;
+    }
+    strcpy(addr.sun_path, path);
+
+    if ((cps_rpc_server_fd = socket(AF_UNIX, SOCK_STREAM, 0)) < 0) {
+        return CPS_ERR_SYS;
+    }
+
+    // socket file left behind by a previous server
+    unlink(path);
+    if (bind(cps_rpc_server_fd, (struct sockaddr *)&addr, sizeof(addr)) < 0) {
+        return CPS_ERR_SYS;
+    }
+
+    if (listen(cps_rpc_server_fd, 1) < 0) {
+        return CPS_ERR_SYS;
+    }
+
+    return CPS_ERR_OK;
+}
+
 cps_err_t cps_rpc_server_accept(void) {
 	socklen_t addrlen = 0;
     struct sockaddr_in _addr;
@@ -60,3 +101,764 @@ cps_err_t cps_rpc_read_fn(uint32_t *fn) {
 
     return CPS_ERR_OK;
 }
+
+cps_err_t cps_rpc_recv_frame(cps_rpc_hdr_t **frame) {
+    static cps_rpc_hdr_t *buf = NULL;
+    static size_t cap = 0;
+
+    cps_err_t ret;
+    cps_rpc_hdr_t hdr;
+
+    CPS_RET_ON_ERR(cps_rpc_read(cps_rpc_client_fd, &hdr, sizeof(hdr)));
+    stats_start = cps_rpc_clock_ns();
+    if (hdr.len > CPS_RPC_MAX_FRAME) {
+        return CPS_ERR_ARG;
+    }
+
+    size_t size = sizeof(hdr) + hdr.len;
+    if (size > cap) {
+        cps_rpc_hdr_t *tmp = realloc(buf, size);
+        if (tmp == NULL) {
+            return CPS_ERR_NO_MEM;
+        }
+
+        buf = tmp;
+        cap = size;
+    }
+
+    *buf = hdr;
+    CPS_RET_ON_ERR(cps_rpc_read(cps_rpc_client_fd, buf + 1, hdr.len));
+    *frame = buf;
+
+    return CPS_ERR_OK;
+}
+
+// spare request buffers kept per connection
+#ifndef CPS_RPC_SPARE_JOBS
+    #define CPS_RPC_SPARE_JOBS 16
+#endif
+// smallest request buffer, so that spares fit most frames
+#define CPS_RPC_JOB_MIN 512
+
+struct job;
+
+// connection served by cps_rpc_server_run
+typedef struct {
+    int fd;
+    // serializes the replies of the workers, protects refs and spare
+    pthread_mutex_t lock;
+    // reader and queued requests
+    unsigned refs;
+    // handled requests, reused for the next ones instead of reallocating
+    struct job *spare;
+    unsigned nspare;
+} conn_t;
+
+// the reply being built, per thread since workers reply concurrently
+static __thread uint8_t *reply_buf = NULL;
+static __thread size_t reply_len = 0;
+static __thread size_t reply_cap = 0;
+// connection of the request being handled, NULL for cps_rpc_client_fd
+static __thread conn_t *reply_conn = NULL;
+
+cps_err_t cps_rpc_reply_begin(const cps_rpc_hdr_t *frame) {
+    cps_rpc_hdr_t hdr = { .fn = frame->fn, .len = 0, .tag = frame->tag };
+
+    reply_len = 0;
+    stats_pending = NULL;
+    return cps_rpc_reply_append(&hdr, sizeof(hdr));
+}
+
+cps_err_t cps_rpc_reply_append(const void *data, size_t len) {
+    if (reply_len + len > reply_cap) {
+        size_t cap = MAX(2 * reply_cap, reply_len + len);
+        uint8_t *tmp = realloc(reply_buf, cap);
+        if (tmp == NULL) {
+            return CPS_ERR_NO_MEM;
+        }
+
+        reply_buf = tmp;
+        reply_cap = cap;
+    }
+
+    memcpy(reply_buf + reply_len, data, len);
+    reply_len += len;
+
+    return CPS_ERR_OK;
+}
+
+cps_err_t cps_rpc_reply_flush(void) {
+    cps_err_t ret;
+    cps_rpc_hdr_t *hdr = (void *)reply_buf;
+
+    // fill in the reply length now that it is known
+    hdr->len = reply_len - sizeof(*hdr);
+    if (reply_conn == NULL) {
+        ret = cps_rpc_write(cps_rpc_client_fd, reply_buf, reply_len);
+    } else {
+        pthread_mutex_lock(&reply_conn->lock);
+        ret = cps_rpc_write(reply_conn->fd, reply_buf, reply_len);
+        pthread_mutex_unlock(&reply_conn->lock);
+    }
+
+    // no reply is being built until the next cps_rpc_reply_begin()
+    reply_len = 0;
+    if (stats_pending != NULL && ret == CPS_ERR_OK) {
+        cps_rpc_stats_end(stats_pending, stats_t);
+    }
+    stats_pending = NULL;
+
+    return ret;
+}
+
+uint64_t cps_rpc_clock_ns(void) {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (uint64_t)ts.tv_sec * 1000000000 + ts.tv_nsec;
+}
+
+uint64_t cps_rpc_stats_start(void) {
+    return reply_len > 0 ? stats_start : cps_rpc_clock_ns();
+}
+
+static void stats_add(cps_rpc_timing_t *timing, const uint64_t t[4]) {
+    uint64_t total = t[3] - t[0];
+    uint64_t us = total / 1000;
+    unsigned bucket = us == 0 ? 0 : 64 - __builtin_clzll(us);
+    if (bucket >= CPS_RPC_STATS_BUCKETS) {
+        bucket = CPS_RPC_STATS_BUCKETS - 1;
+    }
+
+    // calls of a function run on one thread at a time, the atomic stores
+    // only keep concurrent cps_rpc_stats_read() calls from tearing values
+    __atomic_store_n(&timing->calls, timing->calls + 1, __ATOMIC_RELAXED);
+    __atomic_store_n(&timing->recv_ns, timing->recv_ns + t[1] - t[0], __ATOMIC_RELAXED);
+    __atomic_store_n(&timing->call_ns, timing->call_ns + t[2] - t[1], __ATOMIC_RELAXED);
+    __atomic_store_n(&timing->send_ns, timing->send_ns + t[3] - t[2], __ATOMIC_RELAXED);
+    if (total > timing->max_ns) {
+        __atomic_store_n(&timing->max_ns, total, __ATOMIC_RELAXED);
+    }
+    __atomic_store_n(&timing->hist[bucket], timing->hist[bucket] + 1, __ATOMIC_RELAXED);
+}
+
+void cps_rpc_stats_end(cps_rpc_timing_t *timing, uint64_t t[4]) {
+    t[3] = cps_rpc_clock_ns();
+    if (reply_len == 0) {
+        // legacy call, its results have been written
+        stats_add(timing, t);
+        return;
+    }
+
+    // an earlier call of the same batch is complete
+    if (stats_pending != NULL) {
+        stats_add(stats_pending, stats_t);
+    }
+    stats_pending = timing;
+    memcpy(stats_t, t, sizeof(stats_t));
+    stats_start = t[3];
+}
+
+cps_err_t cps_rpc_stats_read(const cps_rpc_timing_t *timing, size_t n, cps_rpc_stats_t stats[], size_t count) {
+    memset(stats, 0, count * sizeof(*stats));
+    for (size_t i = 0; i < n && i < count; i++) {
+        const cps_rpc_timing_t *src = &timing[i];
+        cps_rpc_stats_t *dst = &stats[i];
+
+        dst->fn = src->fn;
+        dst->calls = __atomic_load_n(&src->calls, __ATOMIC_RELAXED);
+        dst->recv_ns = __atomic_load_n(&src->recv_ns, __ATOMIC_RELAXED);
+        dst->call_ns = __atomic_load_n(&src->call_ns, __ATOMIC_RELAXED);
+        dst->send_ns = __atomic_load_n(&src->send_ns, __ATOMIC_RELAXED);
+        dst->max_ns = __atomic_load_n(&src->max_ns, __ATOMIC_RELAXED);
+        for (unsigned b = 0; b < CPS_RPC_STATS_BUCKETS; b++) {
+            dst->hist[b] = __atomic_load_n(&src->hist[b], __ATOMIC_RELAXED);
+        }
+    }
+
+    return CPS_ERR_OK;
+}
+
+// the request frame of a batch at off, NULL if it is incomplete or nested
+static const cps_rpc_hdr_t *batch_frame(const cps_rpc_hdr_t *frame, size_t off) {
+    const cps_rpc_hdr_t *req = (const void *)((const uint8_t *)(frame + 1) + off);
+    if (frame->len - off < sizeof(*req) ||
+        req->len > frame->len - off - sizeof(*req) ||
+        req->fn == CPS_RPC_BATCH ||
+        req->fn == CPS_RPC_SUBSCRIBE ||
+        req->fn == CPS_RPC_UNSUBSCRIBE) {
+        return NULL;
+    }
+
+    return req;
+}
+
+cps_err_t cps_rpc_handle_batch(cps_rpc_hdr_t *frame, cps_rpc_dispatch_t dispatch,
+        cps_rpc_known_t known) {
+    cps_err_t ret;
+    const cps_rpc_hdr_t *req;
+
+    // check that all frames are complete and call known functions before
+    // running any of them
+    for (size_t off = 0; off < frame->len; off += CPS_RPC_ALIGN(sizeof(*req) + req->len)) {
+        if ((req = batch_frame(frame, off)) == NULL || !known(req->fn)) {
+            return CPS_ERR_OK;
+        }
+    }
+
+    for (size_t off = 0; off < frame->len; off += CPS_RPC_ALIGN(sizeof(*req) + req->len)) {
+        req = batch_frame(frame, off);
+        CPS_RET_ON_ERR(dispatch((cps_rpc_hdr_t *)req));
+    }
+
+    return CPS_ERR_OK;
+}
+
+unsigned cps_rpc_batch_group(const cps_rpc_hdr_t *frame, cps_rpc_group_t group) {
+    const cps_rpc_hdr_t *req;
+    unsigned result = CPS_RPC_GROUP_ALL;
+
+    for (size_t off = 0; off < frame->len; off += CPS_RPC_ALIGN(sizeof(*req) + req->len)) {
+        if ((req = batch_frame(frame, off)) == NULL) {
+            // rejected by cps_rpc_handle_batch
+            break;
+        }
+
+        unsigned g = group(req);
+        if (off == 0) {
+            result = g;
+        } else if (g != result) {
+            return CPS_RPC_GROUP_ALL;
+        }
+    }
+
+    return result;
+}
+
+struct sub;
+
+// request queued to a worker
+typedef struct job {
+    struct job *next;
+    conn_t *conn;
+    // stream this call belongs to, NULL for requests
+    struct sub *sub;
+    unsigned group;
+    // header read, see cps_rpc_stats_start()
+    uint64_t start;
+    // room for the payload
+    size_t cap;
+    // followed by the payload
+    cps_rpc_hdr_t frame;
+} job_t;
+
+typedef struct {
+    pthread_t thread;
+    pthread_mutex_t lock;
+    pthread_cond_t cond;
+    job_t *head;
+    job_t *tail;
+    cps_rpc_dispatch_t handle;
+} worker_t;
+
+// held for reading while running a call, and for writing by batches
+// spanning groups, which must not run concurrently with any other call
+static pthread_rwlock_t groups_lock;
+
+// subscription of a connection, see cps_rpc_subscribe_t
+typedef struct sub {
+    struct sub *next;
+    conn_t *conn;
+    worker_t *worker;
+    // tag of the subscribe frame, carried by every frame of the stream
+    uint64_t tag;
+    uint64_t period;
+    uint64_t deadline;
+    // the call, queued to the worker every period and reused
+    job_t *tick;
+    // protected by subs_lock: tick queued or running, so that ticks are
+    // skipped instead of piling up behind a slow call
+    bool queued;
+    // unsubscribed or connection closed, the worker ends the stream
+    bool cancelled;
+    cps_err_t reason;
+} sub_t;
+
+// active subscriptions, run by streamer_main
+static sub_t *subs = NULL;
+static pthread_mutex_t subs_lock = PTHREAD_MUTEX_INITIALIZER;
+// signalled when a subscription is added
+static pthread_cond_t subs_cond;
+
+static void conn_release(conn_t *conn) {
+    pthread_mutex_lock(&conn->lock);
+    bool last = --conn->refs == 0;
+    pthread_mutex_unlock(&conn->lock);
+
+    if (last) {
+        while (conn->spare != NULL) {
+            job_t *job = conn->spare;
+            conn->spare = job->next;
+            free(job);
+        }
+        close(conn->fd);
+        pthread_mutex_destroy(&conn->lock);
+        free(conn);
+    }
+}
+
+// a request buffer with room for len payload bytes, spare if possible
+static job_t *job_alloc(conn_t *conn, size_t len) {
+    pthread_mutex_lock(&conn->lock);
+    job_t *job = conn->spare;
+    if (job != NULL) {
+        conn->spare = job->next;
+        conn->nspare--;
+    }
+    pthread_mutex_unlock(&conn->lock);
+
+    if (job != NULL && job->cap >= len) {
+        return job;
+    }
+
+    free(job);
+    size_t cap = MAX(len, CPS_RPC_JOB_MIN);
+    if ((job = malloc(sizeof(*job) + cap)) != NULL) {
+        job->cap = cap;
+    }
+    return job;
+}
+
+// last frame of a stream, see cps_rpc_subscribe_t
+static void stream_end(conn_t *conn, uint64_t tag, cps_err_t err) {
+    struct __attribute__((packed)) {
+        cps_rpc_hdr_t hdr;
+        cps_err_t err;
+    } end = { { .fn = CPS_RPC_UNSUBSCRIBE, .len = sizeof(err), .tag = tag }, err };
+
+    // errors only concern this connection, its reader notices them too
+    pthread_mutex_lock(&conn->lock);
+    (void)cps_rpc_write(conn->fd, &end, sizeof(end));
+    pthread_mutex_unlock(&conn->lock);
+}
+
+// keep a handled request buffer for the next request of its connection
+static void job_free(job_t *job) {
+    conn_t *conn = job->conn;
+
+    pthread_mutex_lock(&conn->lock);
+    if (conn->nspare < CPS_RPC_SPARE_JOBS) {
+        job->next = conn->spare;
+        conn->spare = job;
+        conn->nspare++;
+        job = NULL;
+    }
+    pthread_mutex_unlock(&conn->lock);
+
+    free(job);
+}
+
+// whether a stream goes on, marking its tick as handled if done
+static bool stream_running(sub_t *sub, bool done) {
+    pthread_mutex_lock(&subs_lock);
+    bool running = !sub->cancelled;
+    if (running && done) {
+        sub->queued = false;
+    }
+    pthread_mutex_unlock(&subs_lock);
+
+    return running;
+}
+
+// end a cancelled stream, once the worker is done with its calls
+static void stream_free(sub_t *sub) {
+    conn_t *conn = sub->conn;
+
+    stream_end(conn, sub->tag, sub->reason);
+    job_free(sub->tick);
+    free(sub);
+    conn_release(conn);
+}
+
+static void *worker_main(void *arg) {
+    worker_t *worker = arg;
+
+    while (true) {
+        pthread_mutex_lock(&worker->lock);
+        while (worker->head == NULL) {
+            pthread_cond_wait(&worker->cond, &worker->lock);
+        }
+        job_t *job = worker->head;
+        worker->head = job->next;
+        if (worker->head == NULL) {
+            worker->tail = NULL;
+        }
+        pthread_mutex_unlock(&worker->lock);
+
+        sub_t *sub = job->sub;
+        if (sub != NULL && !stream_running(sub, false)) {
+            stream_free(sub);
+            continue;
+        }
+
+        if (job->group == CPS_RPC_GROUP_ALL) {
+            pthread_rwlock_wrlock(&groups_lock);
+        } else {
+            pthread_rwlock_rdlock(&groups_lock);
+        }
+
+        // errors only concern this connection, its reader notices them too
+        reply_conn = job->conn;
+        stats_start = job->start;
+        (void)worker->handle(&job->frame);
+        reply_conn = NULL;
+        pthread_rwlock_unlock(&groups_lock);
+
+        if (sub != NULL) {
+            // the tick stays with the stream for its next call
+            if (!stream_running(sub, true)) {
+                stream_free(sub);
+            }
+            continue;
+        }
+
+        conn_t *conn = job->conn;
+        job_free(job);
+        conn_release(conn);
+    }
+
+    return NULL;
+}
+
+static void worker_push(worker_t *worker, job_t *job) {
+    job->next = NULL;
+
+    pthread_mutex_lock(&worker->lock);
+    if (worker->tail == NULL) {
+        worker->head = job;
+    } else {
+        worker->tail->next = job;
+    }
+    worker->tail = job;
+    pthread_cond_signal(&worker->cond);
+    pthread_mutex_unlock(&worker->lock);
+}
+
+// with subs_lock held: unlink a stream and let its worker end it, after
+// any call of the stream it has queued before
+static void stream_cancel(sub_t **link, cps_err_t reason) {
+    sub_t *sub = *link;
+
+    *link = sub->next;
+    sub->cancelled = true;
+    sub->reason = reason;
+    if (!sub->queued) {
+        sub->queued = true;
+        worker_push(sub->worker, sub->tick);
+    }
+}
+
+// end all streams of a connection
+static void stream_cancel_conn(conn_t *conn) {
+    pthread_mutex_lock(&subs_lock);
+    sub_t **link = &subs;
+    while (*link != NULL) {
+        if ((*link)->conn == conn) {
+            stream_cancel(link, CPS_ERR_RPC_SOCKET);
+        } else {
+            link = &(*link)->next;
+        }
+    }
+    pthread_mutex_unlock(&subs_lock);
+}
+
+static cps_err_t stream_unsubscribe(conn_t *conn, uint64_t tag) {
+    cps_err_t ret = CPS_ERR_ARG;
+
+    pthread_mutex_lock(&subs_lock);
+    for (sub_t **link = &subs; *link != NULL; link = &(*link)->next) {
+        if ((*link)->conn == conn && (*link)->tag == tag) {
+            stream_cancel(link, CPS_ERR_OK);
+            ret = CPS_ERR_OK;
+            break;
+        }
+    }
+    pthread_mutex_unlock(&subs_lock);
+
+    return ret;
+}
+
+// turn a subscribe frame into the tick of a new stream
+static cps_err_t stream_subscribe(job_t *job, worker_t *workers, unsigned ngroups,
+        cps_rpc_group_t group, cps_rpc_streamable_t streamable) {
+    cps_err_t ret = CPS_ERR_OK;
+    cps_rpc_hdr_t *frame = &job->frame;
+    cps_rpc_subscribe_t *req = (void *)(frame + 1);
+    cps_rpc_hdr_t *call = (void *)(req + 1);
+
+    if (frame->len < sizeof(*req) + sizeof(*call) ||
+        call->len != frame->len - sizeof(*req) - sizeof(*call) ||
+        req->period_ns == 0 ||
+        !streamable(call->fn)) {
+        return CPS_ERR_ARG;
+    }
+
+    pthread_mutex_lock(&subs_lock);
+    for (sub_t *sub = subs; sub != NULL; sub = sub->next) {
+        if (sub->conn == job->conn && sub->tag == frame->tag) {
+            // tag already streaming
+            ret = CPS_ERR_ARG;
+            goto out;
+        }
+    }
+
+    sub_t *sub = malloc(sizeof(*sub));
+    if (sub == NULL) {
+        ret = CPS_ERR_NO_MEM;
+        goto out;
+    }
+    *sub = (sub_t){
+        .conn = job->conn,
+        .tag = frame->tag,
+        .period = req->period_ns,
+        .deadline = cps_rpc_clock_ns(),
+        .tick = job,
+    };
+
+    // the call replaces the subscribe frame, replying with its tag
+    memmove(frame, call, sizeof(*call) + call->len);
+    frame->tag = sub->tag;
+    job->sub = sub;
+    job->group = group(frame);
+    sub->worker = &workers[job->group < ngroups ? job->group : 0];
+
+    pthread_mutex_lock(&job->conn->lock);
+    job->conn->refs++;
+    pthread_mutex_unlock(&job->conn->lock);
+
+    sub->next = subs;
+    subs = sub;
+    pthread_cond_signal(&subs_cond);
+
+out:
+    pthread_mutex_unlock(&subs_lock);
+    return ret;
+}
+
+// subscribe or unsubscribe frame, handled by the reader
+static void stream_request(job_t *job, worker_t *workers, unsigned ngroups,
+        cps_rpc_group_t group, cps_rpc_streamable_t streamable) {
+    cps_err_t ret;
+    conn_t *conn = job->conn;
+    uint64_t tag = job->frame.tag;
+
+    if (job->frame.fn == CPS_RPC_UNSUBSCRIBE) {
+        // the stream is ended by its worker
+        ret = stream_unsubscribe(conn, tag);
+        job_free(job);
+    } else if ((ret = stream_subscribe(job, workers, ngroups, group, streamable)) != CPS_ERR_OK) {
+        job_free(job);
+    }
+
+    if (ret != CPS_ERR_OK) {
+        stream_end(conn, tag, ret);
+    }
+}
+
+// queues the calls of all streams when they are due
+static void *streamer_main(void *arg) {
+    (void)arg;
+
+    pthread_mutex_lock(&subs_lock);
+    while (true) {
+        uint64_t now = cps_rpc_clock_ns();
+        uint64_t next = UINT64_MAX;
+        for (sub_t *sub = subs; sub != NULL; sub = sub->next) {
+            if (sub->deadline <= now) {
+                if (!sub->queued) {
+                    sub->queued = true;
+                    sub->tick->start = now;
+                    worker_push(sub->worker, sub->tick);
+                }
+                // next period after now, missed ones are skipped
+                sub->deadline += ((now - sub->deadline) / sub->period + 1) * sub->period;
+            }
+            next = MIN(next, sub->deadline);
+        }
+
+        if (next == UINT64_MAX) {
+            pthread_cond_wait(&subs_cond, &subs_lock);
+        } else {
+            struct timespec ts = { .tv_sec = next / 1000000000, .tv_nsec = next % 1000000000 };
+            pthread_cond_timedwait(&subs_cond, &subs_lock, &ts);
+        }
+    }
+
+    return NULL;
+}
+
+static cps_err_t start_streamer(void) {
+    pthread_condattr_t attr;
+    pthread_t thread;
+
+    // deadlines are in cps_rpc_clock_ns() time
+    pthread_condattr_init(&attr);
+    pthread_condattr_setclock(&attr, CLOCK_MONOTONIC);
+    if (pthread_cond_init(&subs_cond, &attr) != 0 ||
+        pthread_create(&thread, NULL, streamer_main, NULL) != 0) {
+        return CPS_ERR_SYS;
+    }
+
+    return CPS_ERR_OK;
+}
+
+static cps_err_t read_job(conn_t *conn, job_t **job) {
+    cps_err_t ret;
+    cps_rpc_hdr_t hdr;
+
+    CPS_RET_ON_ERR(cps_rpc_read(conn->fd, &hdr, sizeof(hdr)));
+    uint64_t start = cps_rpc_clock_ns();
+    if (hdr.len > CPS_RPC_MAX_FRAME) {
+        return CPS_ERR_ARG;
+    }
+
+    job_t *tmp = job_alloc(conn, hdr.len);
+    if (tmp == NULL) {
+        return CPS_ERR_NO_MEM;
+    }
+
+    tmp->frame = hdr;
+    tmp->start = start;
+    if ((ret = cps_rpc_read(conn->fd, &tmp->frame + 1, hdr.len)) != CPS_ERR_OK) {
+        free(tmp);
+        return ret;
+    }
+
+    *job = tmp;
+    return CPS_ERR_OK;
+}
+
+static cps_err_t start_workers(worker_t *workers, unsigned n, cps_rpc_dispatch_t handle) {
+    pthread_rwlockattr_t attr;
+
+    pthread_rwlockattr_init(&attr);
+#ifdef __GLIBC__
+    // do not starve batches spanning groups while calls keep coming in
+    pthread_rwlockattr_setkind_np(&attr, PTHREAD_RWLOCK_PREFER_WRITER_NONRECURSIVE_NP);
+#endif
+    if (pthread_rwlock_init(&groups_lock, &attr) != 0) {
+        return CPS_ERR_SYS;
+    }
+
+    for (unsigned i = 0; i < n; i++) {
+        worker_t *worker = &workers[i];
+        worker->handle = handle;
+        if (pthread_mutex_init(&worker->lock, NULL) != 0 ||
+            pthread_cond_init(&worker->cond, NULL) != 0 ||
+            pthread_create(&worker->thread, NULL, worker_main, worker) != 0) {
+            return CPS_ERR_SYS;
+        }
+    }
+
+    return CPS_ERR_OK;
+}
+
+cps_err_t cps_rpc_server_run(cps_rpc_dispatch_t handle, cps_rpc_group_t group,
+        cps_rpc_streamable_t streamable, unsigned ngroups) {
+    cps_err_t ret;
+    struct pollfd *fds = NULL;
+    conn_t **conns = NULL;
+    size_t nfds = 0;
+    size_t cap = 0;
+
+    worker_t *workers = calloc(ngroups, sizeof(*workers));
+    if (workers == NULL) {
+        return CPS_ERR_NO_MEM;
+    }
+    CPS_RET_ON_ERR(start_workers(workers, ngroups, handle));
+    CPS_RET_ON_ERR(start_streamer());
+
+    // replies to closed connections must fail instead of killing the server
+    signal(SIGPIPE, SIG_IGN);
+
+    while (true) {
+        if (nfds + 1 > cap) {
+            // room for the server socket or a new connection
+            cap = MAX(2 * cap, 8);
+            struct pollfd *tmp_fds = realloc(fds, cap * sizeof(*fds));
+            if (tmp_fds == NULL) {
+                return CPS_ERR_NO_MEM;
+            }
+            fds = tmp_fds;
+
+            conn_t **tmp_conns = realloc(conns, cap * sizeof(*conns));
+            if (tmp_conns == NULL) {
+                return CPS_ERR_NO_MEM;
+            }
+            conns = tmp_conns;
+        }
+        if (nfds == 0) {
+            fds[nfds++] = (struct pollfd){ .fd = cps_rpc_server_fd, .events = POLLIN };
+        }
+
+        if (poll(fds, nfds, -1) < 0) {
+            if (errno == EINTR) {
+                continue;
+            }
+            return CPS_ERR_SYS;
+        }
+
+        for (size_t i = 1; i < nfds; i++) {
+            job_t *job;
+            if (fds[i].revents == 0) {
+                continue;
+            }
+
+            if ((fds[i].revents & POLLIN) && read_job(conns[i], &job) == CPS_ERR_OK) {
+                job->conn = conns[i];
+                job->sub = NULL;
+                if (job->frame.fn == CPS_RPC_SUBSCRIBE || job->frame.fn == CPS_RPC_UNSUBSCRIBE) {
+                    stream_request(job, workers, ngroups, group, streamable);
+                    continue;
+                }
+
+                job->group = group(&job->frame);
+                pthread_mutex_lock(&job->conn->lock);
+                job->conn->refs++;
+                pthread_mutex_unlock(&job->conn->lock);
+
+                unsigned w = job->group < ngroups ? job->group : 0;
+                worker_push(&workers[w], job);
+            } else {
+                // closed by the client, or unusable
+                stream_cancel_conn(conns[i]);
+                conn_release(conns[i]);
+                nfds--;
+                fds[i] = fds[nfds];
+                conns[i] = conns[nfds];
+                i--;
+            }
+        }
+
+        if (fds[0].revents & POLLIN) {
+            int fd = accept(cps_rpc_server_fd, NULL, NULL);
+            if (fd < 0) {
+                return CPS_ERR_SYS;
+            }
+
+            conn_t *conn = malloc(sizeof(*conn));
+            if (conn == NULL) {
+                close(fd);
+                return CPS_ERR_NO_MEM;
+            }
+            conn->fd = fd;
+            conn->refs = 1;
+            conn->spare = NULL;
+            conn->nspare = 0;
+            pthread_mutex_init(&conn->lock, NULL);
+
+            fds[nfds] = (struct pollfd){ .fd = fd, .events = POLLIN };
+            conns[nfds] = conn;
+            nfds++;
+        }
+    }
+}
@@ -1,5 +1,11 @@
 #!/usr/bin/env python
 from dynamixel_sdk import *                    # Uses Dynamixel SDK library
+import dynamixel_sdk.port_handler
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import struct
+import numpy as np
 
 ADDR_TORQUE_ENABLE          = 64
 ADDR_GOAL_POSITION          = 116
@@ -8,12 +14,96 @@ ADDR_DRIVE_MODE             = 10
 ADDR_PRESENT_POSITION       = 132
 ADDR_PRESENT_VOLTAGE        = 144
 ADDR_PROFILE_ACCELERATION   = 108
+ADDR_PRESENT_PWM            = 124
+ADDR_PRESENT_CURRENT        = 126
+ADDR_PRESENT_VELOCITY       = 128
+ADDR_PRESENT_TEMPERATURE    = 146
+ADDR_HARDWARE_ERROR_STATUS  = 70
+ADDR_INDIRECT_ADDRESS       = 168
+ADDR_INDIRECT_DATA          = 224
+INDIRECT_SIZE               = 20               # Indirect address/data 1-20
+EEPROM_SIZE                 = 64               # Registers below are locked while torque is on
 BAUDRATE                    = 57600
+PORT_NAME                   = '/dev/tty.usbserial-FT6Z8AGE'
 PROTOCOL_VERSION            = 2.0
 
+# Bus settings chosen with python/baudrate.py, by port name:
+# {port: {"baudrate": ..., "return_delay_time": ..., "latency_timer": ...}}
+BUS_CONFIG                  = os.path.expanduser('~/.config/cps/dynamixel.json')
+
+# The FTDI USB serial converter holds received bytes for up to latency_timer ms (16 by
+# default) before passing them on, which adds to every status packet
+LATENCY_TIMER_PATH          = '/sys/bus/usb-serial/devices/%s/latency_timer'
+
+# Profile acceleration, profile velocity and goal position are contiguous (108-119)
+# and are written together as one sync write
+PROFILE_GOAL = struct.Struct('<IIi')
+
+# Registers that can be mapped into the indirect data block: field name -> (address, dtype)
+REGISTER_FIELDS = {
+    'pwm':            (ADDR_PRESENT_PWM, '<i2'),
+    'current':        (ADDR_PRESENT_CURRENT, '<i2'),
+    'velocity':       (ADDR_PRESENT_VELOCITY, '<i4'),
+    'position':       (ADDR_PRESENT_POSITION, '<i4'),
+    'voltage':        (ADDR_PRESENT_VOLTAGE, '<u2'),
+    'temperature':    (ADDR_PRESENT_TEMPERATURE, 'u1'),
+    'hardware_error': (ADDR_HARDWARE_ERROR_STATUS, 'u1'),
+}
+
+def load_bus_config(port_name):
+    try:
+        with open(BUS_CONFIG) as file:
+            return json.load(file).get(port_name, {})
+    except (OSError, ValueError):
+        return {}
+
+def read_latency_timer(port_name):
+    try:
+        with open(LATENCY_TIMER_PATH % os.path.basename(port_name)) as file:
+            return int(file.read())
+    except (OSError, ValueError):
+        return None
+
+def set_latency_timer(port_name, latency_timer):
+    # Linux only, and writing usually needs root (or a udev rule)
+    try:
+        with open(LATENCY_TIMER_PATH % os.path.basename(port_name), 'w') as file:
+            file.write(str(latency_timer))
+    except OSError as e:
+        print("Failed to set the latency timer: %s" % e)
+        return False
+
+    # The SDK adds twice the latency timer to its status packet timeouts
+    dynamixel_sdk.port_handler.LATENCY_TIMER = latency_timer
+    return True
+
+class SyncWriter:
+    # Sync write of one struct layout to a fixed set of servos. The parameter buffer
+    # ([id, data] per servo) is kept between writes, and only the data of servos whose
+    # values changed is packed again
+    def __init__(self, portHandler, packetHandler, ids, address, layout):
+        self.portHandler = portHandler
+        self.packetHandler = packetHandler
+        self.address = address
+        self.layout = layout
+        self.stride = 1 + layout.size
+        self.param = bytearray(self.stride * len(ids))
+        self.param[::self.stride] = bytes(ids)
+        self.values = [None] * len(ids)
+
+    def write(self, values):
+        # One tuple of layout fields per servo, in the order of ids
+        for index, value in enumerate(values):
+            if value != self.values[index]:
+                self.layout.pack_into(self.param, index * self.stride + 1, *value)
+                self.values[index] = value
+
+        return self.packetHandler.syncWriteTxOnly(self.portHandler, self.address, self.layout.size, self.param, len(self.param))
+
 class DynamixelHandler:
-    def __init__(self):
-        self.portHandler = PortHandler('/dev/tty.usbserial-FT6Z8AGE')
+    def __init__(self, portHandler=None, fast_read=True):
+        # Another port can be given, e.g. a SimulatedPort (python/simulated_port.py)
+        self.portHandler = portHandler or PortHandler(PORT_NAME)
 
         self.packetHandler = PacketHandler(PROTOCOL_VERSION)
         if self.portHandler.openPort():
@@ -22,41 +112,184 @@ class DynamixelHandler:
             print("Failed to open the port")
             quit()
 
+        # Baud rate and latency timer of a migrated chain, see python/baudrate.py
+        self.bus_config = load_bus_config(self.portHandler.getPortName())
+        latency_timer = self.bus_config.get('latency_timer')
+        if latency_timer is not None:
+            if read_latency_timer(self.portHandler.getPortName()) == latency_timer:
+                dynamixel_sdk.port_handler.LATENCY_TIMER = latency_timer
+            else:
+                set_latency_timer(self.portHandler.getPortName(), latency_timer)
+
         # Set port baudrate
-        if self.portHandler.setBaudRate(BAUDRATE):
+        if self.portHandler.setBaudRate(self.bus_config.get('baudrate', BAUDRATE)):
             print("Succeeded to change the baudrate")
         else:
             print("Failed to change the baudrate")
             quit()
 
-    def move_many_servos(self, ids, positions, durations):
-        groupSyncWrite = GroupSyncWrite(self.portHandler, self.packetHandler, ADDR_GOAL_POSITION, 4)
+        # Last value written to each register, per servo: {id: {address: value}}
+        # Writes of values a servo already holds are skipped
+        self.register_cache = {}
 
-        for index, id in enumerate(ids):
-            self.packetHandler.write1ByteTxRx(self.portHandler, id, ADDR_TORQUE_ENABLE, 1)
-            self.packetHandler.write1ByteTxRx(self.portHandler, id, ADDR_DRIVE_MODE, 4)         # 4 = Time-based profile
-            self.packetHandler.write4ByteTxRx(self.portHandler, id, ADDR_PROFILE_VELOCITY, durations[index])
-            self.packetHandler.write4ByteTxRx(self.portHandler, id, ADDR_PROFILE_ACCELERATION, durations[index]//3)
+        # Prepared sync reads and writes, by (address, length or layout, ids)
+        self.sync_reads = {}
+        self.sync_writers = {}
+        self.bulk_reads = {}
 
-            param_goal_position = [DXL_LOBYTE(DXL_LOWORD(positions[index])), DXL_HIBYTE(DXL_LOWORD(positions[index])), DXL_LOBYTE(DXL_HIWORD(positions[index])), DXL_HIBYTE(DXL_HIWORD(positions[index]))]
-            groupSyncWrite.addParam(id, param_goal_position)
+        # Fast Sync/Bulk Read is tried first, groups of servos that do not support it are
+        # remembered here and read normally
+        self.fast_read = fast_read
+        self.slow_reads = set()
+
+        # Structured dtype of the indirect data block, per servo, see configure_indirect()
+        self.indirect_layouts = {}
+
+    def sync_read(self, ids, address, bytelen):
+        key = (address, bytelen, tuple(ids))
+        groupSyncRead = self.sync_reads.get(key)
+        if groupSyncRead is None:
+            groupSyncRead = GroupSyncRead(self.portHandler, self.packetHandler, address, bytelen)
+            for id in ids:
+                groupSyncRead.addParam(id)
+            self.sync_reads[key] = groupSyncRead
+        return groupSyncRead
+
+    def bulk_read(self, reads):
+        # reads: (id, address, bytelen) per servo, at most one per id
+        key = tuple(reads)
+        groupBulkRead = self.bulk_reads.get(key)
+        if groupBulkRead is None:
+            groupBulkRead = GroupBulkRead(self.portHandler, self.packetHandler)
+            for id, address, bytelen in reads:
+                groupBulkRead.addParam(id, address, bytelen)
+            self.bulk_reads[key] = groupBulkRead
+        return groupBulkRead
+
+    def read_group(self, group):
+        # Fast Sync/Bulk Read: all servos answer in one status packet instead of one each.
+        # If it fails but a normal read works, the servos do not support it (older
+        # firmware) and the group is read normally from then on
+        if not self.fast_read or group in self.slow_reads:
+            return group.txRxPacket()
+
+        if isinstance(group, GroupSyncRead):
+            dxl_comm_result = group.fastSyncRead()
+        else:
+            dxl_comm_result = group.fastBulkRead()
+        if dxl_comm_result == COMM_SUCCESS:
+            return dxl_comm_result
+
+        dxl_comm_result = group.txRxPacket()
+        if dxl_comm_result == COMM_SUCCESS:
+            self.slow_reads.add(group)
+        return dxl_comm_result
+
+    def sync_writer(self, ids, address, layout):
+        key = (address, layout.format, tuple(ids))
+        writer = self.sync_writers.get(key)
+        if writer is None:
+            writer = SyncWriter(self.portHandler, self.packetHandler, ids, address, layout)
+            self.sync_writers[key] = writer
+        return writer
+
+    def invalidate_cache(self, ids=None):
+        # Forget what was written, so that the next move writes everything again
+        if ids is None:
+            self.register_cache.clear()
+        else:
+            for id in ids:
+                self.register_cache.pop(id, None)
+
+    def read_register(self, id, address, bytelen):
+        if bytelen == 1:
+            value, dxl_comm_result, dxl_error = self.packetHandler.read1ByteTxRx(self.portHandler, id, address)
+        elif bytelen == 2:
+            value, dxl_comm_result, dxl_error = self.packetHandler.read2ByteTxRx(self.portHandler, id, address)
+        else:
+            value, dxl_comm_result, dxl_error = self.packetHandler.read4ByteTxRx(self.portHandler, id, address)
+
+        if dxl_comm_result != COMM_SUCCESS or dxl_error != 0:
+            return None
+        return value
+
+    def write_register(self, id, address, value, bytelen):
+        cache = self.register_cache.setdefault(id, {})
+        if cache.get(address) == value:
+            return True
+
+        if bytelen == 1:
+            dxl_comm_result, dxl_error = self.packetHandler.write1ByteTxRx(self.portHandler, id, address, value)
+        elif bytelen == 2:
+            dxl_comm_result, dxl_error = self.packetHandler.write2ByteTxRx(self.portHandler, id, address, value)
+        else:
+            dxl_comm_result, dxl_error = self.packetHandler.write4ByteTxRx(self.portHandler, id, address, value)
 
-        dxl_comm_result = groupSyncWrite.txPacket()
         if dxl_comm_result != COMM_SUCCESS:
             print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
+            # The servo state is unknown after a communication error
+            self.invalidate_cache([id])
+            return False
 
-        groupSyncWrite.clearParam()
+        if dxl_error != 0 and self.read_register(id, address, bytelen) != value:
+            # Rejected, e.g. the EEPROM area (drive mode) is locked while torque is enabled,
+            # which is only fine if the register already holds the value
+            print("%s" % self.packetHandler.getRxPacketError(dxl_error))
+            return False
 
-    def read_servos(self, ids, addr, bytelen):
-        groupSyncRead = GroupSyncRead(self.portHandler, self.packetHandler, addr, int(bytelen))
+        cache[address] = value
+        return True
+
+    def sync_write_register(self, ids, address, value, bytelen):
+        # Write a value to all servos that do not hold it yet, as one sync write
+        ids = [id for id in ids if self.register_cache.get(id, {}).get(address) != value]
+        if not ids:
+            return True
+
+        if address < EEPROM_SIZE:
+            # Only the status packet tells whether an EEPROM write was rejected, so these are
+            # written one by one and only cached once they took
+            return all([self.write_register(id, address, value, bytelen) for id in ids])
+
+        groupSyncWrite = GroupSyncWrite(self.portHandler, self.packetHandler, address, bytelen)
+        param = list(value.to_bytes(bytelen, 'little'))
+        for id in ids:
+            groupSyncWrite.addParam(id, param)
 
+        dxl_comm_result = groupSyncWrite.txPacket()
+        if dxl_comm_result != COMM_SUCCESS:
+            print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
+            self.invalidate_cache(ids)
+            return False
+
+        # Sync writes have no status packets, RAM registers are assumed to be written
         for id in ids:
-            groupSyncRead.addParam(id)
+            self.register_cache.setdefault(id, {})[address] = value
+        return True
+
+    def move_many_servos_profiled(self, ids, positions, durations, accelerations):
+        # Time-based profile: durations and accelerations are in ms
+        # Drive mode is in the EEPROM area, which is locked once torque is enabled
+        self.sync_write_register(ids, ADDR_DRIVE_MODE, 4, 1)         # 4 = Time-based profile
+        self.sync_write_register(ids, ADDR_TORQUE_ENABLE, 1, 1)
+
+        writer = self.sync_writer(ids, ADDR_PROFILE_ACCELERATION, PROFILE_GOAL)
+        dxl_comm_result = writer.write(zip(accelerations, durations, positions))
+        if dxl_comm_result != COMM_SUCCESS:
+            print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
+            self.invalidate_cache(ids)
+
+    def move_many_servos(self, ids, positions, durations):
+        self.move_many_servos_profiled(ids, positions, durations, [duration//3 for duration in durations])
+
+    def read_servos(self, ids, addr, bytelen):
+        groupSyncRead = self.sync_read(ids, addr, int(bytelen))
 
-        dxl_comm_result = groupSyncRead.txRxPacket()
+        dxl_comm_result = self.read_group(groupSyncRead)
 
         if dxl_comm_result != COMM_SUCCESS:
             print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
+            self.invalidate_cache(ids)
 
         res = []
         
@@ -66,6 +299,87 @@ class DynamixelHandler:
 
         return res
 
+    def read_servos_bulk(self, reads):
+        # Read a register of every servo, which may differ per servo, in one bulk read.
+        # reads: (id, address, bytelen) per servo, at most one per id
+        groupBulkRead = self.bulk_read(reads)
+
+        dxl_comm_result = self.read_group(groupBulkRead)
+        if dxl_comm_result != COMM_SUCCESS:
+            print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
+            self.invalidate_cache([id for id, _, _ in reads])
+
+        res = []
+        for id, address, bytelen in reads:
+            res.append(groupBulkRead.getData(id, address, int(bytelen)))
+
+        return res
+
+    def read_block(self, ids, start, dtype):
+        # One sync read of dtype.itemsize bytes from start, as a structured array with one
+        # row per id. Servos that did not answer are left as zeros, like getData() does
+        groupSyncRead = self.sync_read(ids, start, dtype.itemsize)
+
+        dxl_comm_result = self.read_group(groupSyncRead)
+        if dxl_comm_result != COMM_SUCCESS:
+            print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
+            self.invalidate_cache(ids)
+
+        raw = np.zeros((len(ids), dtype.itemsize), dtype=np.uint8)
+        for index, id in enumerate(ids):
+            if groupSyncRead.isAvailable(id, start, dtype.itemsize):
+                raw[index] = groupSyncRead.data_dict[id]
+
+        return raw.view(dtype).reshape(len(ids))
+
+    def configure_indirect(self, ids, fields):
+        # Map the fields (of REGISTER_FIELDS) one after the other into the indirect data block
+        # of every servo, so that read_indirect() gets them all in one sync read. Servos that
+        # are mapped like this already are left alone, the others need torque disabled
+        dtype = np.dtype([(field, REGISTER_FIELDS[field][1]) for field in fields])
+        if dtype.itemsize > INDIRECT_SIZE:
+            print("Fields %s take %d bytes, the indirect data block has %d" % (list(fields), dtype.itemsize, INDIRECT_SIZE))
+            return False
+
+        addresses = []
+        for field in fields:
+            address = REGISTER_FIELDS[field][0]
+            addresses += range(address, address + dtype[field].itemsize)
+        param = struct.pack('<%dH' % len(addresses), *addresses)
+
+        groupSyncRead = self.sync_read(ids, ADDR_INDIRECT_ADDRESS, len(param))
+        for attempt in range(2):
+            dxl_comm_result = self.read_group(groupSyncRead)
+            if dxl_comm_result != COMM_SUCCESS:
+                print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
+                return False
+
+            ids_to_write = [id for id in ids if bytes(groupSyncRead.data_dict[id]) != param]
+            if not ids_to_write:
+                break
+            if attempt > 0:
+                print("Servos %s did not accept the indirect addresses, is torque disabled?" % ids_to_write)
+                return False
+
+            groupSyncWrite = GroupSyncWrite(self.portHandler, self.packetHandler, ADDR_INDIRECT_ADDRESS, len(param))
+            for id in ids_to_write:
+                groupSyncWrite.addParam(id, list(param))
+                self.indirect_layouts.pop(id, None)
+            groupSyncWrite.txPacket()
+
+        for id in ids:
+            self.indirect_layouts[id] = dtype
+        return True
+
+    def read_indirect(self, ids):
+        # Read the fields mapped with configure_indirect() of all servos in one sync read.
+        # Returns a structured array with one row per id
+        dtype = self.indirect_layouts.get(ids[0])
+        if dtype is None or any(self.indirect_layouts.get(id) != dtype for id in ids):
+            raise ValueError("Servos %s do not share an indirect layout, see configure_indirect()" % list(ids))
+
+        return self.read_block(ids, ADDR_INDIRECT_DATA, dtype)
+
     def read_servo_positions(self, ids):
         return self.read_servos(ids, ADDR_PRESENT_POSITION, 4)
 
@@ -74,4 +388,87 @@ class DynamixelHandler:
 
     def disable_torques(self, ids):
         for id in ids:
-            self.packetHandler.write1ByteTxRx(self.portHandler, id, ADDR_TORQUE_ENABLE, 0)
\ No newline at end of file
+            self.packetHandler.write1ByteTxRx(self.portHandler, id, ADDR_TORQUE_ENABLE, 0)
+        # Servos may be moved, power cycled or reconfigured while limp
+        self.invalidate_cache(ids)
+
+    def reboot_servos(self, ids):
+        for id in ids:
+            dxl_comm_result, dxl_error = self.packetHandler.reboot(self.portHandler, id)
+            if dxl_comm_result != COMM_SUCCESS:
+                print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
+        # A reboot resets the RAM area of the control table, including torque enable
+        self.invalidate_cache(ids)
+
+class DynamixelBuses:
+    # Servos spread over several serial ports, e.g. one adapter per limb group. Every port
+    # has its own DynamixelHandler and I/O thread, calls are split by port, the parts run in
+    # parallel and their results are merged in the order of the ids
+    def __init__(self, ports, fast_read=True):
+        # ports: {port name or PortHandler: ids on that port}
+        self.handlers = []
+        self.workers = []
+        self.bus_of_id = {}
+        for port, ids in ports.items():
+            if not isinstance(port, PortHandler):
+                port = PortHandler(port)
+            for id in ids:
+                self.bus_of_id[id] = len(self.handlers)
+            self.handlers.append(DynamixelHandler(port, fast_read))
+            self.workers.append(ThreadPoolExecutor(max_workers=1))
+
+    def run(self, ids, call, *per_servo):
+        # call(handler, ids, *per_servo) on every bus with its part of the ids and of the
+        # per servo lists
+        parts = {}
+        for index, id in enumerate(ids):
+            parts.setdefault(self.bus_of_id[id], []).append(index)
+
+        futures = []
+        for bus, indices in parts.items():
+            args = [[values[index] for index in indices] for values in per_servo]
+            futures.append((indices, self.workers[bus].submit(call, self.handlers[bus], [ids[index] for index in indices], *args)))
+
+        res = [None] * len(ids)
+        for indices, future in futures:
+            values = future.result()
+            if values is not None:
+                for index, value in zip(indices, values):
+                    res[index] = value
+        return res
+
+    def move_many_servos_profiled(self, ids, positions, durations, accelerations):
+        self.run(ids, DynamixelHandler.move_many_servos_profiled, positions, durations, accelerations)
+
+    def move_many_servos(self, ids, positions, durations):
+        self.run(ids, DynamixelHandler.move_many_servos, positions, durations)
+
+    def read_servos(self, ids, addr, bytelen):
+        return self.run(ids, lambda handler, ids: handler.read_servos(ids, addr, bytelen))
+
+    def read_servos_bulk(self, reads):
+        return self.run([id for id, _, _ in reads], lambda handler, ids, reads: handler.read_servos_bulk(reads), reads)
+
+    def read_servo_positions(self, ids):
+        return self.run(ids, DynamixelHandler.read_servo_positions)
+
+    def read_servo_voltages(self, ids):
+        return self.run(ids, DynamixelHandler.read_servo_voltages)
+
+    def disable_torques(self, ids):
+        self.run(ids, DynamixelHandler.disable_torques)
+
+    def configure_indirect(self, ids, fields):
+        return all(self.run(ids, lambda handler, ids: [handler.configure_indirect(ids, fields)] * len(ids)))
+
+    def read_indirect(self, ids):
+        return np.array(self.run(ids, DynamixelHandler.read_indirect))
+
+    def reboot_servos(self, ids):
+        self.run(ids, DynamixelHandler.reboot_servos)
+
+    def close(self):
+        for worker in self.workers:
+            worker.shutdown()
+        for handler in self.handlers:
+            handler.portHandler.closePort()
@@ -1,5 +1,7 @@
-from helper_functions import DynamixelHandler
-import time
+from helper_functions import DynamixelBuses, PORT_NAME, REGISTER_FIELDS
+from motion import MotionEngine, load_motions
+import numpy as np
+import os
 
 NECK_Y = 1
 NECK_X = 2
@@ -26,275 +28,106 @@ L_HIP_Y = 22
 L_KNEE = 23
 L_FOOT = 24
 
+id_to_name = {
+    1 : "neck_y",
+    2 : "neck_x",
+    3 : "neck_z",
+    4 : "r_shoulder_y",
+    5 : "r_shoulder_x",
+    6 : "r_shoulder_z",
+    7 : "r_elbow",
+    8 : "l_shoulder_y",
+    9 : "l_shoulder_x",
+    10 : "l_shoulder_z",
+    11 : "l_elbow",
+    12 : "torso_z",
+    13 : "torso_y",
+    14 : "torso_x",
+    15 : "r_hip_x",
+    16 : "r_hip_z",
+    17 : "r_hip_y",
+    18 : "r_knee",
+    19 : "r_foot",
+    20 : "l_hip_x",
+    21 : "l_hip_z",
+    22 : "l_hip_y",
+    23 : "l_knee",
+    24 : "l_foot"
+}
+name_to_id = {name: id for id, name in id_to_name.items()}
+
+# Poses and sequences of the motions, see motion.py
+MOTIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'motions.json')
+
+# Read together in one transaction by read_all_state(), through the indirect data block
+MONITOR_FIELDS = ('position', 'voltage', 'temperature', 'hardware_error')
+
 class Humanoid:
-    def __init__(self):
-        self.dynamixel_handler = DynamixelHandler()
+    def __init__(self, ports=None):
+        # ports: {port name: ids} to spread the servos over several adapters, e.g.
+        # {'/dev/ttyUSB0': range(1, 15), '/dev/ttyUSB1': range(15, 25)}
+        # Every port has one I/O thread, so the motion engine and other calls can share it
+        self.dynamixel_handler = DynamixelBuses(ports or {PORT_NAME: range(1, 25)})
         self.all_ids = list(range(1, 25))
 
+        # Needs torque disabled the first time, the servos keep the mapping afterwards. Until
+        # it is made, read_all_state() reads the fields one by one
+        self.indirect = self.dynamixel_handler.configure_indirect(self.all_ids, MONITOR_FIELDS)
+        if not self.indirect:
+            print("Reading the state field by field until torque is disabled")
+
+        self.motions = MotionEngine(self.dynamixel_handler, self.all_ids, load_motions(MOTIONS, name_to_id, self.all_ids))
+
+    def perform(self, name):
+        # Play a sequence of motions.json and wait for it, asking before steps with a prompt
+        self.motions.play(name)
+        prompt = self.motions.wait()
+        while prompt is not None:
+            input(prompt)
+            self.motions.cue()
+            prompt = self.motions.wait()
+
     def read_all_servos(self):
         return self.dynamixel_handler.read_servo_positions(self.all_ids)
+
+    def read_all_state(self):
+        # Structured array of MONITOR_FIELDS, one row per servo
+        if self.indirect:
+            return self.dynamixel_handler.read_indirect(self.all_ids)
+
+        state = np.zeros(len(self.all_ids), dtype=[(field, REGISTER_FIELDS[field][1]) for field in MONITOR_FIELDS])
+        for field in MONITOR_FIELDS:
+            address, dtype = REGISTER_FIELDS[field]
+            size = np.dtype(dtype).itemsize
+            # The SDK gives the bytes as an unsigned value
+            values = self.dynamixel_handler.read_servos(self.all_ids, address, size)
+            state[field] = np.array(values, dtype='<u%d' % size).view(dtype)
+        return state
     
     def disable_torques(self):
+        self.motions.cancel()
         self.dynamixel_handler.disable_torques(self.all_ids)
+        if not self.indirect:
+            # The EEPROM area is writable now
+            self.indirect = self.dynamixel_handler.configure_indirect(self.all_ids, MONITOR_FIELDS)
 
     def go_to_base_position(self):
-        base_positions = [2048]*24
-        durations = [5000]*24
-        self.dynamixel_handler.move_many_servos(self.all_ids, base_positions, durations)
-        time.sleep(5)
+        self.perform('base_position')
 
     def stand(self):
-        base_positions = [2048]*25
-        base_positions[R_SHOULDER_X] = 2850          # Right shoulder
-        base_positions[L_SHOULDER_X] = 1250          # Left shoulder
-        base_positions[R_ELBOW] = 2400          # Right elbow
-        base_positions[L_ELBOW] = 1850         # Left elbow
-
-        first_base_positions = base_positions.copy()
-
-        durations = [4000]*24
-        self.dynamixel_handler.move_many_servos(self.all_ids, base_positions[1:], durations)
-        time.sleep(10)
-
-        base_positions[NECK_Y] = 1773
-        base_positions[NECK_X] = 2153
-        base_positions[NECK_Z] = 1459
-
-        self.dynamixel_handler.move_many_servos(self.all_ids, base_positions[1:], durations)
-        time.sleep(4)
-
-        base_positions[NECK_Y] = 1881
-        base_positions[NECK_X] = 2106
-        base_positions[NECK_Z] = 2675
-
-        self.dynamixel_handler.move_many_servos(self.all_ids, base_positions[1:], durations)
-        time.sleep(4)
-
-        base_positions[NECK_Y] = 2230
-        base_positions[NECK_X] = 2062
-        base_positions[NECK_Z] = 2089
-        base_positions[L_SHOULDER_Y] = 1500
-        base_positions[R_SHOULDER_Y] = 2500
-        base_positions[L_SHOULDER_Z] = 2300
-        base_positions[R_SHOULDER_Z] = 1700
-        base_positions[L_ELBOW] = 1500
-        base_positions[R_ELBOW] = 2500
-        base_positions[TORSO_Y] = 1970
-
-        self.dynamixel_handler.move_many_servos(self.all_ids, base_positions[1:], durations)
-        time.sleep(4)
-
-        self.dynamixel_handler.move_many_servos(self.all_ids, first_base_positions[1:], durations)
-        time.sleep(4)
+        self.perform('stand')
 
     def sit(self):
-        sit_pos = [2048]*25
-        sit_pos[R_SHOULDER_X] = 2850          # Right shoulder
-        sit_pos[L_SHOULDER_X] = 1250          # Left shoulder
-        sit_pos[R_ELBOW] = 2400          # Right elbow
-        sit_pos[L_ELBOW] = 1850         # Left elbow
-
-        sit_pos[R_HIP_X] = 1961
-        sit_pos[R_HIP_Z] = 2098
-        sit_pos[R_HIP_Y] = 961
-        sit_pos[R_KNEE] = 3077
-        sit_pos[R_FOOT] = 2669
-        sit_pos[L_HIP_X] = 2060
-        sit_pos[L_HIP_Z] = 1893
-        sit_pos[L_HIP_Y] = 3149
-        sit_pos[L_KNEE] = 1093
-        sit_pos[L_FOOT] = 1265
-
-        sit_pos = sit_pos[1:]
-
-        durations = [5000]*24
-
-        self.dynamixel_handler.move_many_servos(self.all_ids, sit_pos, durations)
-        time.sleep(6)
+        self.perform('sit')
 
     def side_split(self):
-        side_split_pos = [2048]*25
-        side_split_pos[R_SHOULDER_Y] = 2296
-        side_split_pos[R_SHOULDER_X] = 2738
-        side_split_pos[R_SHOULDER_Z] = 2241
-        side_split_pos[R_ELBOW] = 2565
-        side_split_pos[L_SHOULDER_Y] = 1893
-        side_split_pos[L_SHOULDER_X] = 1473
-        side_split_pos[L_SHOULDER_Z] = 1651
-        side_split_pos[L_ELBOW] = 1492
-        side_split_pos[TORSO_Z] = 2127
-        side_split_pos[TORSO_Y] = 1985
-        side_split_pos[TORSO_X] = 2096
-        side_split_pos[R_HIP_X] = 2077
-        side_split_pos[R_HIP_Z] = 2970
-        side_split_pos[R_HIP_Y] = 1050
-        side_split_pos[R_KNEE] = 2024
-        side_split_pos[R_FOOT] = 3096
-        side_split_pos[L_HIP_X] = 2072
-        side_split_pos[L_HIP_Z] = 1057
-        side_split_pos[L_HIP_Y] = 3072
-        side_split_pos[L_KNEE] = 2033
-        side_split_pos[L_FOOT] = 1035
-
-        side_split_pos = side_split_pos[1:]
-
-        durations = [5000]*24
-
-        self.dynamixel_handler.move_many_servos(self.all_ids, side_split_pos, durations)
-
-        time.sleep(6)
+        self.perform('side_split')
 
     def split(self):
-        split_pos = [2048]*25
-        split_pos[NECK_Y] = 1900
-        split_pos[R_SHOULDER_Y] = 1469
-        split_pos[R_SHOULDER_X] = 2975
-        split_pos[R_SHOULDER_Z] = 2049
-        split_pos[R_ELBOW] = 2320
-        split_pos[L_SHOULDER_Y] = 1277
-        split_pos[L_SHOULDER_X] = 1076
-        split_pos[L_SHOULDER_Z] = 2131
-        split_pos[L_ELBOW] = 1694
-        split_pos[TORSO_Z] = 2023
-        split_pos[TORSO_Y] = 2247
-        split_pos[TORSO_X] = 2074
-        split_pos[R_HIP_X] = 2050
-        split_pos[R_HIP_Z] = 2013
-        split_pos[R_HIP_Y] = 3015
-        split_pos[R_KNEE] = 2026
-        split_pos[R_FOOT] = 2931
-        split_pos[L_HIP_X] = 2048
-        split_pos[L_HIP_Z] = 2097
-        split_pos[L_HIP_Y] = 3150
-        split_pos[L_KNEE] = 2025
-        split_pos[L_FOOT] = 1020
-
-        split_pos = split_pos[1:]
-
-        durations = [5000]*24
-
-        self.dynamixel_handler.move_many_servos(self.all_ids, split_pos, durations)
-
-        time.sleep(6)
-    
+        self.perform('split')
 
     def pushup(self):
-        pushup_pos = [2048]*25
-
-        pushup_pos[L_ELBOW] = 1024
-        pushup_pos[R_ELBOW] = 3072
-
-        pushup_pos[R_SHOULDER_Y] = 3072
-        pushup_pos[L_SHOULDER_Y] = 1024
+        self.perform('pushup')
 
-        pushup_pos[R_SHOULDER_Z] = 1024
-        pushup_pos[L_SHOULDER_Z] = 3072
-        pushup_pos[NECK_Y] = 1325
-
-        up_pos = pushup_pos.copy()
-        up_pos[R_SHOULDER_X] = 2350
-        up_pos[R_ELBOW] = 2700
-
-        up_pos[L_SHOULDER_X] = 1750
-        up_pos[L_ELBOW] = 1422
-
-        pushup_pos = pushup_pos[1:]
-        up_pos = up_pos[1:]
-
-        durations = [5000]*24
-
-        self.dynamixel_handler.move_many_servos(self.all_ids, pushup_pos, durations)
-
-        input("Start push ups")
-        print("Starting push ups...")
-        
-        for _ in range(2):
-            self.dynamixel_handler.move_many_servos(self.all_ids, up_pos, durations)
-            time.sleep(6)
-
-            self.dynamixel_handler.move_many_servos(self.all_ids, pushup_pos, durations)
-            time.sleep(6)
-    
     def squat(self):
-        squat_pos = [2048]*25
-
-        squat_pos[NECK_Y] = 1800
-        squat_pos[R_SHOULDER_Y] = 2872
-        squat_pos[R_SHOULDER_X] = 2850
-        squat_pos[R_SHOULDER_Z] = 2048
-        squat_pos[R_ELBOW] = 2400
-        squat_pos[L_SHOULDER_Y] = 1224
-        squat_pos[L_SHOULDER_X] = 1250
-        squat_pos[L_SHOULDER_Z] = 2064
-        squat_pos[L_ELBOW] = 1850
-        squat_pos[TORSO_Z] = 2048
-        squat_pos[TORSO_Y] = 2400
-        squat_pos[TORSO_X] = 2048
-        squat_pos[R_HIP_X] = 2095 
-        squat_pos[R_HIP_Z] = 2248
-        squat_pos[R_HIP_Y] = 1448
-        squat_pos[R_KNEE] = 3078
-        squat_pos[R_FOOT] = 1751
-        squat_pos[L_HIP_X] = 1991
-        squat_pos[L_HIP_Z] = 1848
-        squat_pos[L_HIP_Y] = 2648
-        squat_pos[L_KNEE] = 1018
-        squat_pos[L_FOOT] = 2350
-
-        lean_backwards = squat_pos.copy()
-        lean_backwards[TORSO_Y] = 2350
-
-        base_positions = [2048]*25
-
-        # Go to base position with arm down
-        base_positions[R_SHOULDER_X] = 2848
-        base_positions[L_SHOULDER_X] = 1248
-        base_positions[R_ELBOW] = 2400
-        base_positions[L_ELBOW] = 1850
-
-        lean_forward = base_positions.copy()
-        lean_forward[TORSO_Y] = 2100
-
-        durations = [5000]*24
-        lean_forward_durations = [3000]*24
-        lean_backwards_durations = [7000]*24
-
-        self.dynamixel_handler.move_many_servos(self.all_ids, base_positions[1:], durations)
-
-        time.sleep(6)
-
-        input("Start")
-
-        self.dynamixel_handler.move_many_servos(self.all_ids, lean_forward[1:], lean_forward_durations)
-        
-        squat_durations = [10000]*24
-
-        self.dynamixel_handler.move_many_servos(self.all_ids, squat_pos[1:], squat_durations)
-
-        time.sleep(11)
-
-        input("Go up")
-
-        self.dynamixel_handler.move_many_servos(self.all_ids, lean_backwards[1:], lean_backwards_durations)
-
-        time.sleep(7)
-
-        base_positions[TORSO_Y] = 2048
-        base_positions[R_SHOULDER_Y] = 1900
-        base_positions[L_SHOULDER_Y] = 2200
-
-        first_durations = [8000]*24
-        
-        self.dynamixel_handler.move_many_servos(self.all_ids, base_positions[1:], first_durations)
-
-
-        new_base_positions = base_positions.copy()
-        new_base_positions[TORSO_Y] = 2040
-        new_base_positions[R_SHOULDER_Y] = 2048
-        new_base_positions[L_SHOULDER_Y] = 2048
-        second_durations = [7000]*24
-        time.sleep(4)
-
-        self.dynamixel_handler.move_many_servos(self.all_ids, new_base_positions[1:], second_durations)
-        
-        time.sleep(7)
\ No newline at end of file
+        self.perform('squat')
@@ -11,7 +11,7 @@ for i in range(3):
 
 humanoid.stand()
 
-voltages = humanoid.dynamixel_handler.read_servo_voltages([1, 2, 3, 20])
+voltages = humanoid.read_all_state()['voltage']
 print("Voltages: ", voltages)
 
 command = input("Press any key to disable torque")
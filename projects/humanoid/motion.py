@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# Keyframe motions defined in a data file (motions.json), keyed by the joint names of
+# id_to_name in humanoid.py:
+#   "poses": {
+#       "arms_down": {"r_shoulder_x": 2850, "l_shoulder_x": 1250},    # other joints at 2048
+#       "wave": {"base": "arms_down", "r_elbow": 2500},               # arms_down, changed
+#       "half_sit": {"blend": {"sit": 0.5, "zero": 0.5}}              # weighted mean of poses
+#   },
+#   "sequences": {
+#       "wave": [
+#           {"pose": "wave", "duration": 2000},                      # in ms
+#           {"prompt": "Wave again?"},                               # waits for cue()
+#           {"sequence": "wave_once", "repeat": 2},
+#           {"pose": "arms_down", "duration": 3000, "next": 1000}    # next step after 1 s
+#       ]
+#   }
+# A step starts once the previous one has taken its "next" time, which is its duration
+# unless given, so moves follow each other without gaps. Sequences are compiled once into
+# arrays of goal positions and durations and played by a MotionEngine:
+#   engine = MotionEngine(handler, ids, load_motions('motions.json', name_to_id, ids))
+#   engine.play('stand')
+#   engine.chain('sit')     # after stand
+#   engine.cancel()
+from collections import namedtuple, deque
+import numpy as np
+import threading
+import json
+import time
+
+# Position of joints that a pose does not give
+CENTER_POSITION = 2048
+
+# Compiled sequence of K steps for n servos: goals and durations (K, n), time from each step
+# to the next in ms (K,) and the prompt to wait for before each step, None for none. The
+# sequence ends next[-1] ms after its last step
+Sequence = namedtuple('Sequence', ['goals', 'durations', 'next', 'prompts'])
+
+def compile_poses(poses, name_to_id, ids):
+    # {pose name: goal positions (n,)} in the order of ids
+    index = {id: index for index, id in enumerate(ids)}
+    compiled = {}
+
+    def compile_pose(name, seen):
+        if name in compiled:
+            return compiled[name]
+        if name in seen:
+            raise ValueError("Pose %s is based on itself" % name)
+        if name not in poses:
+            raise ValueError("Unknown pose %s" % name)
+        definition = dict(poses[name])
+
+        if 'blend' in definition:
+            weights = definition.pop('blend')
+            goals = sum(weight * compile_pose(other, seen | {name}) for other, weight in weights.items()) / sum(weights.values())
+        elif 'base' in definition:
+            goals = compile_pose(definition.pop('base'), seen | {name}).copy()
+        else:
+            goals = np.full(len(ids), CENTER_POSITION, dtype=np.float64)
+
+        for joint, position in definition.items():
+            if joint not in name_to_id:
+                raise ValueError("Unknown joint %s in pose %s" % (joint, name))
+            goals[index[name_to_id[joint]]] = position
+        compiled[name] = goals
+        return goals
+
+    for name in poses:
+        compile_pose(name, set())
+    return {name: np.rint(goals).astype(np.int32) for name, goals in compiled.items()}
+
+def compile_sequences(sequences, poses):
+    # {sequence name: Sequence}, with nested sequences inlined
+    steps = {}
+
+    def flatten(name, seen):
+        # Steps as (pose, duration, next, prompt)
+        if name in steps:
+            return steps[name]
+        if name in seen:
+            raise ValueError("Sequence %s contains itself" % name)
+        if name not in sequences:
+            raise ValueError("Unknown sequence %s" % name)
+
+        flat = []
+        prompt = None
+        for step in sequences[name]:
+            if 'prompt' in step:
+                prompt = step['prompt']
+            elif 'pose' in step:
+                if step['pose'] not in poses:
+                    raise ValueError("Unknown pose %s in sequence %s" % (step['pose'], name))
+                flat.append((step['pose'], step['duration'], step.get('next', step['duration']), prompt))
+                prompt = None
+            elif 'sequence' in step:
+                inner = flatten(step['sequence'], seen | {name})
+                for _ in range(step.get('repeat', 1)):
+                    if inner:
+                        flat.append(inner[0][:3] + (prompt if prompt is not None else inner[0][3],))
+                        flat += inner[1:]
+                        prompt = None
+            else:
+                raise ValueError("Step %s of sequence %s has no pose, sequence or prompt" % (step, name))
+        if prompt is not None:
+            raise ValueError("Sequence %s ends with a prompt" % name)
+        steps[name] = flat
+        return flat
+
+    compiled = {}
+    for name in sequences:
+        flat = flatten(name, set())
+        if not flat:
+            raise ValueError("Sequence %s has no steps" % name)
+        goals = np.stack([poses[pose] for pose, _, _, _ in flat])
+        compiled[name] = Sequence(
+            goals=goals,
+            durations=np.broadcast_to(np.array([duration for _, duration, _, _ in flat], dtype=np.uint32)[:, None], goals.shape).copy(),
+            next=np.array([next_time for _, _, next_time, _ in flat], dtype=np.uint32),
+            prompts=[prompt for _, _, _, prompt in flat],
+        )
+    return compiled
+
+def load_motions(path, name_to_id, ids):
+    # {sequence name: Sequence} of a motion file, for the servos ids
+    with open(path) as file:
+        motions = json.load(file)
+    poses = compile_poses(motions.get('poses', {}), name_to_id, ids)
+    return compile_sequences(motions.get('sequences', {}), poses)
+
+class MotionEngine:
+    # Plays sequences on its own thread, sending each step when it is due and waiting on a
+    # condition in between, so play(), chain(), cancel() and cue() take effect at once. A
+    # sequence started while another one moves the servos takes over from where they are,
+    # since time-based profiles start from the current trajectory
+    def __init__(self, handler, ids, sequences):
+        # handler: DynamixelHandler or DynamixelBuses, called from the engine thread
+        self.handler = handler
+        self.ids = list(ids)
+        self.sequences = sequences
+
+        self.condition = threading.Condition()
+        self.current = None
+        self.step = 0
+        # time.monotonic() at which the next step is due
+        self.deadline = time.monotonic()
+        self.pending = deque()
+        # Prompt of the step waiting for cue(), None if not waiting
+        self.prompt = None
+        self.cued = False
+        self.running = True
+        self.thread = threading.Thread(target=self.main, daemon=True)
+        self.thread.start()
+
+    def sequence(self, name, blend=None):
+        # The compiled sequence, with the first step taking blend ms if given
+        sequence = self.sequences[name]
+        if blend is not None:
+            durations = sequence.durations.copy()
+            durations[0] = blend
+            next_times = sequence.next.copy()
+            next_times[0] = blend
+            sequence = sequence._replace(durations=durations, next=next_times)
+        return sequence
+
+    def play(self, name, blend=None):
+        # Start a sequence now, instead of the current one and anything chained
+        sequence = self.sequence(name, blend)
+        with self.condition:
+            self.pending.clear()
+            self.start(sequence, time.monotonic())
+            self.condition.notify_all()
+
+    def chain(self, name, blend=None):
+        # Start a sequence when the current one and those chained before have ended
+        sequence = self.sequence(name, blend)
+        with self.condition:
+            if self.current is None and not self.pending:
+                self.start(sequence, time.monotonic())
+            else:
+                self.pending.append(sequence)
+            self.condition.notify_all()
+
+    def cancel(self):
+        # Send no more steps, a move in progress still ends at its goal
+        with self.condition:
+            self.pending.clear()
+            self.current = None
+            self.prompt = None
+            self.condition.notify_all()
+
+    def cue(self):
+        # Continue after the prompt that is being waited for
+        with self.condition:
+            if self.prompt is not None:
+                self.prompt = None
+                self.cued = True
+                self.deadline = time.monotonic()
+                self.condition.notify_all()
+
+    def busy(self):
+        with self.condition:
+            return self.current is not None or bool(self.pending)
+
+    def wait(self, timeout=None):
+        # Wait until all sequences have ended or one waits for a prompt. Returns the prompt,
+        # None once done (or on timeout)
+        with self.condition:
+            self.condition.wait_for(lambda: self.prompt is not None or (self.current is None and not self.pending), timeout)
+            return self.prompt
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
+
+    def start(self, sequence, start_time):
+        self.current = sequence
+        self.step = 0
+        self.deadline = start_time
+        self.prompt = None
+        self.cued = False
+
+    def main(self):
+        with self.condition:
+            while self.running:
+                if self.current is None:
+                    if self.pending:
+                        # Right after the end of the previous one
+                        self.start(self.pending.popleft(), self.deadline)
+                        continue
+                    self.condition.notify_all()
+                    self.condition.wait()
+                    continue
+
+                timeout = self.deadline - time.monotonic()
+                if self.prompt is not None or timeout > 0:
+                    self.condition.wait(None if self.prompt is not None else timeout)
+                    continue
+
+                sequence, step = self.current, self.step
+                if step == len(sequence.next):
+                    self.current = None
+                    continue
+                if sequence.prompts[step] is not None and not self.cued:
+                    self.prompt = sequence.prompts[step]
+                    self.condition.notify_all()
+                    continue
+
+                self.cued = False
+                self.step += 1
+                self.deadline += sequence.next[step] / 1000
+
+                # The bus is not held up by the condition, so that other threads can play or
+                # cancel meanwhile
+                self.condition.release()
+                error = None
+                try:
+                    self.handler.move_many_servos(self.ids, sequence.goals[step].tolist(), sequence.durations[step].tolist())
+                except Exception as e:
+                    error = e
+                finally:
+                    self.condition.acquire()
+
+                if error is not None:
+                    print("%s" % error)
+                    if self.current is sequence:
+                        self.current = None
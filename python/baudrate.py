@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# Move a servo chain to a higher baud rate and store the bus settings, which
+# DynamixelHandler() picks up from then on:
+#   python3 baudrate.py 1000000
+#   python3 baudrate.py 4000000 --port /dev/ttyUSB0 --ids 1 2 3 --latency-timer 1
+from helper_functions import *
+from simulated_port import SimulatedPort, SimulatedServo
+import argparse
+
+parser = argparse.ArgumentParser(description="Move all servos to another baud rate and store the bus settings")
+parser.add_argument('baudrate', type=int, choices=list(BAUD_RATES))
+parser.add_argument('--port', default='/dev/ttyUSB0')
+parser.add_argument('--ids', type=int, nargs='+', default=list(range(1, 13)))
+parser.add_argument('--return-delay-time', type=int, default=0, help="in units of 2 us (default: %(default)s)")
+parser.add_argument('--latency-timer', type=int, default=1, help="USB latency timer in ms (default: %(default)s)")
+parser.add_argument('--measure', type=float, default=2.0, help="seconds to measure the loop rate for (default: %(default)s)")
+parser.add_argument('--simulate', action='store_true', help="use simulated servos at %d bps instead of the port" % BAUDRATE)
+args = parser.parse_args()
+
+if args.simulate:
+    # Under its own port name, so that neither the saved settings nor the latency timer of
+    # the real adapter are taken for it
+    portHandler = SimulatedPort([SimulatedServo(id) for id in args.ids], realtime=True)
+else:
+    portHandler = PortHandler(args.port)
+dynamixel_handler = DynamixelHandler(portHandler)
+
+old_baudrate = dynamixel_handler.find_baudrate(args.ids)
+if old_baudrate is None:
+    print("Servos %s do not all answer at any baud rate" % args.ids)
+    quit(1)
+print("Servos found at %d bps" % old_baudrate)
+
+latency_timer = None
+if not args.simulate:
+    if set_latency_timer(args.port, args.latency_timer):
+        print("Latency timer set to %d ms" % args.latency_timer)
+    latency_timer = read_latency_timer(args.port)
+
+print("Loop rate at %d bps: %.1f Hz" % (old_baudrate, dynamixel_handler.measure_loop_rate(args.ids, args.measure)))
+
+old_return_delay_times = [dynamixel_handler.read_register(id, ADDR_RETURN_DELAY_TIME, 1) for id in args.ids]
+if None in old_return_delay_times:
+    print("Failed to read the return delay time of servos %s" % [id for id, value in zip(args.ids, old_return_delay_times) if value is None])
+    quit(1)
+
+# Written whether or not the baud rate changes, and put back if anything fails
+if not dynamixel_handler.set_return_delay_times(args.ids, [args.return_delay_time] * len(args.ids)):
+    print("Servos did not take the return delay time, restoring it")
+    dynamixel_handler.set_return_delay_times(args.ids, old_return_delay_times)
+    quit(1)
+
+if old_baudrate != args.baudrate and not dynamixel_handler.migrate_baudrate(args.ids, args.baudrate):
+    # Only reaches the servos if they are back at the old baud rate
+    if not dynamixel_handler.set_return_delay_times(args.ids, old_return_delay_times):
+        print("Return delay time not restored")
+    quit(1)
+
+loop_rate = dynamixel_handler.measure_loop_rate(args.ids, args.measure)
+print("Loop rate at %d bps: %.1f Hz" % (args.baudrate, loop_rate))
+
+config = {
+    "baudrate": args.baudrate,
+    "return_delay_time": args.return_delay_time,
+    "loop_rate": round(loop_rate, 1),
+}
+if latency_timer is not None:
+    config["latency_timer"] = latency_timer
+
+if args.simulate:
+    print(json.dumps(config, indent=4))
+else:
+    save_bus_config(args.port, config)
+    print("Saved to %s" % BUS_CONFIG)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# Record of the bus transactions of a DynamixelHandler:
+#   trace = dynamixel_handler.trace
+#   trace.stats()['fast_sync_read']      # calls, mean/max time and histogram
+#   trace.records()                      # the last transactions, oldest first
+#   trace.dump('trace.npy')
+import numpy as np
+import time
+
+# Transaction types
+OPERATIONS = ('read', 'write', 'sync_read', 'fast_sync_read', 'bulk_read', 'fast_bulk_read', 'sync_write', 'ping', 'reboot')
+OPERATION = {operation: index for index, operation in enumerate(OPERATIONS)}
+
+# Histogram buckets of power of two microseconds: bucket b counts times below 2**b us
+HISTOGRAM_BUCKETS = 24
+
+RECORD = np.dtype([
+    ('operation', 'u1'),
+    ('servos', '<u2'),
+    ('bytes', '<u4'),               # Data bytes read or written, without the packet overhead
+    ('start', '<i8'),               # perf_counter_ns()
+    ('end', '<i8'),
+    ('result', '<i2'),              # COMM_SUCCESS or the error of the SDK
+])
+
+class BusTrace:
+    # The last size transactions are kept in a ring of columns. There is no lock: record()
+    # is only called from the thread using the bus, and readers copy the ring and drop the
+    # rows that were overwritten while they copied. The histograms and totals cover all
+    # transactions since the last clear()
+    def __init__(self, size=4096):
+        self.size = size
+        self.ring = np.zeros(size, dtype=RECORD)
+        self.columns = [self.ring[field] for field in RECORD.names]
+        # Number of transactions recorded, the next one goes to count % size
+        self.count = 0
+        # Offset of time.time() to perf_counter_ns(), to convert to wall clock time stamps
+        self.wall_offset = time.time() - time.perf_counter_ns() / 1e9
+
+        self.histogram = np.zeros((len(OPERATIONS), HISTOGRAM_BUCKETS), dtype=np.int64)
+        self.calls = np.zeros(len(OPERATIONS), dtype=np.int64)
+        self.errors = np.zeros(len(OPERATIONS), dtype=np.int64)
+        self.busy_ns = np.zeros(len(OPERATIONS), dtype=np.int64)
+        self.max_ns = np.zeros(len(OPERATIONS), dtype=np.int64)
+        self.bytes = np.zeros(len(OPERATIONS), dtype=np.int64)
+        self.start_ns = time.perf_counter_ns()
+
+    def record(self, operation, servos, nbytes, start, end, result):
+        # operation: index in OPERATIONS, start and end from perf_counter_ns()
+        index = self.count % self.size
+        for column, value in zip(self.columns, (operation, servos, nbytes, start, end, result)):
+            column[index] = value
+        self.count += 1
+
+        duration = end - start
+        self.histogram[operation, min((duration // 1000).bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+        self.calls[operation] += 1
+        self.busy_ns[operation] += duration
+        self.bytes[operation] += nbytes
+        if duration > self.max_ns[operation]:
+            self.max_ns[operation] = duration
+        if result != 0:
+            self.errors[operation] += 1
+
+    def records(self):
+        # Copy of the kept transactions, oldest first
+        count = self.count
+        ring = self.ring.copy()
+        # Rows written during the copy, and the one that may be in progress, replaced the
+        # oldest ones once the ring is full
+        start = max(self.count + 1 - self.size, 0)
+        if start >= count:
+            return ring[:0]
+        return np.roll(ring, -(start % self.size))[:count - start]
+
+    def last(self):
+        # The latest transaction, None if there is none
+        while self.count:
+            count = self.count
+            record = self.ring[(count - 1) % self.size].copy()
+            # Unless the ring went round while copying it
+            if self.count - count < self.size - 1:
+                return record
+        return None
+
+    def wall_time(self, ns):
+        # time.time() of a perf_counter_ns() time stamp
+        return self.wall_offset + ns / 1e9
+
+    def midpoint(self):
+        # Wall clock time of the middle of the latest transaction
+        record = self.last()
+        if record is None:
+            return None
+        return self.wall_time((int(record['start']) + int(record['end'])) / 2)
+
+    def stats(self):
+        # Per operation that was used: calls, errors, data bytes, mean and max time in us,
+        # histogram in power of two us buckets and the share of time the bus was busy with it
+        elapsed = max(time.perf_counter_ns() - self.start_ns, 1)
+        stats = {}
+        for operation in np.flatnonzero(self.calls):
+            calls = self.calls[operation]
+            histogram = self.histogram[operation]
+            stats[OPERATIONS[operation]] = {
+                "calls": int(calls),
+                "errors": int(self.errors[operation]),
+                "bytes": int(self.bytes[operation]),
+                "mean": float(self.busy_ns[operation] / calls / 1e3),
+                "max": float(self.max_ns[operation] / 1e3),
+                "histogram": histogram[:np.flatnonzero(histogram)[-1] + 1].tolist(),
+                "utilization": float(self.busy_ns[operation] / elapsed),
+            }
+        return stats
+
+    def percentile(self, operation, q):
+        # Time in us below which q percent of the kept transactions of the operation took
+        records = self.records()
+        records = records[records['operation'] == OPERATION[operation]]
+        if not len(records):
+            return None
+        return float(np.percentile(records['end'] - records['start'], q) / 1e3)
+
+    def clear(self):
+        self.count = 0
+        for array in (self.histogram, self.calls, self.errors, self.busy_ns, self.max_ns, self.bytes):
+            array[:] = 0
+        self.start_ns = time.perf_counter_ns()
+
+    def dump(self, path):
+        # The kept transactions as a .npy file of RECORD, np.load(path) reads them back
+        np.save(path, self.records())
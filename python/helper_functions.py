@@ -1,10 +1,23 @@
 #!/usr/bin/env python
 from dynamixel_sdk import *                    # Uses Dynamixel SDK library
+from periodic import Periodic
+from bus_trace import BusTrace, OPERATION
+import dynamixel_sdk.port_handler
+from collections import namedtuple
+import json
+import os
+import struct
+import numpy as np
+import queue
+import threading
 
 ADDR_TORQUE_ENABLE          = 64
 ADDR_GOAL_POSITION          = 116
 ADDR_PROFILE_VELOCITY       = 112
 ADDR_DRIVE_MODE             = 10
+ADDR_BAUD_RATE              = 8
+ADDR_RETURN_DELAY_TIME      = 9
+ADDR_LED                    = 65
 ADDR_PRESENT_POSITION       = 132
 ADDR_POSITION_TRAJECTORY    = 140
 ADDR_VELOCITY_TRAJECTORY    = 136
@@ -12,12 +25,139 @@ ADDR_PROFILE_ACCELERATION   = 108
 ADDR_PRESENT_VELOCITY       = 128
 ADDR_PRESENT_PWM            = 124
 ADDR_PRESENT_CURRENT        = 126
+ADDR_PRESENT_VOLTAGE        = 144
+ADDR_PRESENT_TEMPERATURE    = 146
+ADDR_HARDWARE_ERROR_STATUS  = 70
+ADDR_INDIRECT_ADDRESS       = 168
+ADDR_INDIRECT_DATA          = 224
+INDIRECT_SIZE               = 20               # Indirect address/data 1-20
+EEPROM_SIZE                 = 64               # Registers below are locked while torque is on
 BAUDRATE                    = 57600
 PROTOCOL_VERSION            = 2.0
+ACCELERATION_TIME           = 600              # ms, of the profile of move_many_servos
+
+# Bus settings chosen with python/baudrate.py, by port name:
+# {port: {"baudrate": ..., "return_delay_time": ..., "latency_timer": ...}}
+BUS_CONFIG                  = os.path.expanduser('~/.config/cps/dynamixel.json')
+
+# The FTDI USB serial converter holds received bytes for up to latency_timer ms (16 by
+# default) before passing them on, which adds to every status packet
+LATENCY_TIMER_PATH          = '/sys/bus/usb-serial/devices/%s/latency_timer'
+
+# Profile acceleration, profile velocity and goal position are contiguous (108-119)
+# and are written together as one sync write
+PROFILE_GOAL = struct.Struct('<IIi')
+LED = struct.Struct('<B')
+
+# Baud rate register values
+BAUD_RATES = {9600: 0, 57600: 1, 115200: 2, 1000000: 3, 2000000: 4, 3000000: 5, 4000000: 6}
+
+# Present state registers, all signed and within 124-143: field name -> (address, dtype)
+STATE_FIELDS = {
+    'pwm':                 (ADDR_PRESENT_PWM, '<i2'),
+    'current':             (ADDR_PRESENT_CURRENT, '<i2'),
+    'velocity':            (ADDR_PRESENT_VELOCITY, '<i4'),
+    'position':            (ADDR_PRESENT_POSITION, '<i4'),
+    'velocity_trajectory': (ADDR_VELOCITY_TRAJECTORY, '<i4'),
+    'position_trajectory': (ADDR_POSITION_TRAJECTORY, '<i4'),
+}
+
+# Registers that can be mapped into the indirect data block: field name -> (address, dtype)
+REGISTER_FIELDS = dict(STATE_FIELDS, **{
+    'voltage':        (ADDR_PRESENT_VOLTAGE, '<u2'),
+    'temperature':    (ADDR_PRESENT_TEMPERATURE, 'u1'),
+    'hardware_error': (ADDR_HARDWARE_ERROR_STATUS, 'u1'),
+})
+
+# (start address, length, dtype) of the register block covering some fields, by field names
+state_layouts = {}
+
+def state_layout(fields):
+    fields = tuple(fields)
+    layout = state_layouts.get(fields)
+    if layout is None:
+        start = min(STATE_FIELDS[field][0] for field in fields)
+        end = max(STATE_FIELDS[field][0] + np.dtype(STATE_FIELDS[field][1]).itemsize for field in fields)
+        dtype = np.dtype({
+            'names': list(fields),
+            'formats': [STATE_FIELDS[field][1] for field in fields],
+            'offsets': [STATE_FIELDS[field][0] - start for field in fields],
+            'itemsize': end - start,
+        })
+        layout = (start, end - start, dtype)
+        state_layouts[fields] = layout
+    return layout
+
+def load_bus_config(port_name):
+    try:
+        with open(BUS_CONFIG) as file:
+            return json.load(file).get(port_name, {})
+    except (OSError, ValueError):
+        return {}
+
+def read_latency_timer(port_name):
+    try:
+        with open(LATENCY_TIMER_PATH % os.path.basename(port_name)) as file:
+            return int(file.read())
+    except (OSError, ValueError):
+        return None
+
+def set_latency_timer(port_name, latency_timer):
+    # Linux only, and writing usually needs root (or a udev rule)
+    try:
+        with open(LATENCY_TIMER_PATH % os.path.basename(port_name), 'w') as file:
+            file.write(str(latency_timer))
+    except OSError as e:
+        print("Failed to set the latency timer: %s" % e)
+        return False
+
+    # The SDK adds twice the latency timer to its status packet timeouts
+    dynamixel_sdk.port_handler.LATENCY_TIMER = latency_timer
+    return True
+
+def save_bus_config(port_name, config):
+    try:
+        with open(BUS_CONFIG) as file:
+            configs = json.load(file)
+    except (OSError, ValueError):
+        configs = {}
+    configs[port_name] = config
+
+    os.makedirs(os.path.dirname(BUS_CONFIG), exist_ok=True)
+    with open(BUS_CONFIG, 'w') as file:
+        json.dump(configs, file, indent=4)
+
+class SyncWriter:
+    # Sync write of one struct layout to a fixed set of servos. The parameter buffer
+    # ([id, data] per servo) is kept between writes, and only the data of servos whose
+    # values changed is packed again
+    def __init__(self, portHandler, packetHandler, ids, address, layout, trace):
+        self.portHandler = portHandler
+        self.packetHandler = packetHandler
+        self.trace = trace
+        self.address = address
+        self.layout = layout
+        self.stride = 1 + layout.size
+        self.param = bytearray(self.stride * len(ids))
+        self.param[::self.stride] = bytes(ids)
+        self.values = [None] * len(ids)
+
+    def write(self, values):
+        # One tuple of layout fields per servo, in the order of ids
+        for index, value in enumerate(values):
+            if value != self.values[index]:
+                self.layout.pack_into(self.param, index * self.stride + 1, *value)
+                self.values[index] = value
+
+        start = time.perf_counter_ns()
+        dxl_comm_result = self.packetHandler.syncWriteTxOnly(self.portHandler, self.address, self.layout.size, self.param, len(self.param))
+        self.trace.record(OPERATION['sync_write'], len(self.values), self.layout.size * len(self.values), start, time.perf_counter_ns(), dxl_comm_result)
+        return dxl_comm_result
 
 class DynamixelHandler:
-    def __init__(self):
-        self.portHandler = PortHandler('/dev/ttyUSB0')
+    def __init__(self, portHandler=None, fast_read=True, trace_size=4096):
+        # Another port can be given, e.g. a SimulatedPort (python/simulated_port.py)
+        self.portHandler = portHandler or PortHandler('/dev/ttyUSB0')
 
         self.packetHandler = PacketHandler(PROTOCOL_VERSION)
         if self.portHandler.openPort():
@@ -26,54 +166,294 @@ class DynamixelHandler:
             print("Failed to open the port")
             quit()
 
+        # Baud rate and latency timer of a migrated chain, see python/baudrate.py
+        self.bus_config = load_bus_config(self.portHandler.getPortName())
+        latency_timer = self.bus_config.get('latency_timer')
+        if latency_timer is not None:
+            if read_latency_timer(self.portHandler.getPortName()) == latency_timer:
+                dynamixel_sdk.port_handler.LATENCY_TIMER = latency_timer
+            else:
+                set_latency_timer(self.portHandler.getPortName(), latency_timer)
+
         # Set port baudrate
-        if self.portHandler.setBaudRate(BAUDRATE):
+        if self.portHandler.setBaudRate(self.bus_config.get('baudrate', BAUDRATE)):
             print("Succeeded to change the baudrate")
         else:
             print("Failed to change the baudrate")
             quit()
 
-    def move_many_servos(self, ids, positions, durations):
-        groupSyncWrite = GroupSyncWrite(self.portHandler, self.packetHandler, ADDR_GOAL_POSITION, 4)
+        # Last value written to each register, per servo: {id: {address: value}}
+        # Writes of values a servo already holds are skipped
+        self.register_cache = {}
 
-        for index, id in enumerate(ids):
-            self.packetHandler.write1ByteTxRx(self.portHandler, id, ADDR_TORQUE_ENABLE, 1)
-            self.packetHandler.write1ByteTxRx(self.portHandler, id, ADDR_DRIVE_MODE, 4)         # 4 = Time-based profile
-            self.packetHandler.write4ByteTxRx(self.portHandler, id, ADDR_PROFILE_VELOCITY, durations[index])
-            self.packetHandler.write4ByteTxRx(self.portHandler, id, ADDR_PROFILE_ACCELERATION, 600)         #0.6s acceleration duration
+        # Prepared sync reads and writes, by (address, length or layout, ids)
+        self.sync_reads = {}
+        self.sync_writers = {}
+        self.bulk_reads = {}
+
+        # Fast Sync/Bulk Read is tried first, groups of servos that do not support it are
+        # remembered here and read normally
+        self.fast_read = fast_read
+        self.slow_reads = set()
+
+        # Structured dtype of the indirect data block, per servo, see configure_indirect()
+        self.indirect_layouts = {}
+
+        # Every transaction on the bus, with its time and result (python/bus_trace.py)
+        self.trace = BusTrace(trace_size)
+
+    def traced(self, operation, servos, nbytes, function, *args):
+        # Call function(*args) of the SDK and record it in the trace. The SDK returns the
+        # communication result alone, or second to last after the values read
+        start = time.perf_counter_ns()
+        result = function(*args)
+        end = time.perf_counter_ns()
+        self.trace.record(OPERATION[operation], servos, nbytes, start, end, result if isinstance(result, int) else result[-2])
+        return result
+
+    def sync_read(self, ids, address, bytelen):
+        key = (address, bytelen, tuple(ids))
+        groupSyncRead = self.sync_reads.get(key)
+        if groupSyncRead is None:
+            groupSyncRead = GroupSyncRead(self.portHandler, self.packetHandler, address, bytelen)
+            for id in ids:
+                groupSyncRead.addParam(id)
+            self.sync_reads[key] = groupSyncRead
+        return groupSyncRead
+
+    def bulk_read(self, reads):
+        # reads: (id, address, bytelen) per servo, at most one per id
+        key = tuple(reads)
+        groupBulkRead = self.bulk_reads.get(key)
+        if groupBulkRead is None:
+            groupBulkRead = GroupBulkRead(self.portHandler, self.packetHandler)
+            for id, address, bytelen in reads:
+                groupBulkRead.addParam(id, address, bytelen)
+            self.bulk_reads[key] = groupBulkRead
+        return groupBulkRead
+
+    def read_group(self, group):
+        # Fast Sync/Bulk Read: all servos answer in one status packet instead of one each.
+        # If it fails but a normal read works, the servos do not support it (older
+        # firmware) and the group is read normally from then on
+        servos = len(group.data_dict)
+        if isinstance(group, GroupSyncRead):
+            operation, fast_operation, fast_read = 'sync_read', 'fast_sync_read', group.fastSyncRead
+            nbytes = group.data_length * servos
+        else:
+            operation, fast_operation, fast_read = 'bulk_read', 'fast_bulk_read', group.fastBulkRead
+            nbytes = sum(length for _, _, length in group.data_dict.values())
 
-            param_goal_position = [DXL_LOBYTE(DXL_LOWORD(positions[index])), DXL_HIBYTE(DXL_LOWORD(positions[index])), DXL_LOBYTE(DXL_HIWORD(positions[index])), DXL_HIBYTE(DXL_HIWORD(positions[index]))]
-            groupSyncWrite.addParam(id, param_goal_position)
+        if not self.fast_read or group in self.slow_reads:
+            return self.traced(operation, servos, nbytes, group.txRxPacket)
+
+        dxl_comm_result = self.traced(fast_operation, servos, nbytes, fast_read)
+        if dxl_comm_result == COMM_SUCCESS:
+            return dxl_comm_result
+
+        dxl_comm_result = self.traced(operation, servos, nbytes, group.txRxPacket)
+        if dxl_comm_result == COMM_SUCCESS:
+            self.slow_reads.add(group)
+        return dxl_comm_result
+
+    def sync_writer(self, ids, address, layout):
+        key = (address, layout.format, tuple(ids))
+        writer = self.sync_writers.get(key)
+        if writer is None:
+            writer = SyncWriter(self.portHandler, self.packetHandler, ids, address, layout, self.trace)
+            self.sync_writers[key] = writer
+        return writer
+
+    def invalidate_cache(self, ids=None):
+        # Forget what was written, so that the next move writes everything again
+        if ids is None:
+            self.register_cache.clear()
+        else:
+            for id in ids:
+                self.register_cache.pop(id, None)
+
+    def read_register(self, id, address, bytelen):
+        if bytelen == 1:
+            value, dxl_comm_result, dxl_error = self.traced('read', 1, 1, self.packetHandler.read1ByteTxRx, self.portHandler, id, address)
+        elif bytelen == 2:
+            value, dxl_comm_result, dxl_error = self.traced('read', 1, 2, self.packetHandler.read2ByteTxRx, self.portHandler, id, address)
+        else:
+            value, dxl_comm_result, dxl_error = self.traced('read', 1, 4, self.packetHandler.read4ByteTxRx, self.portHandler, id, address)
+
+        if dxl_comm_result != COMM_SUCCESS or dxl_error != 0:
+            return None
+        return value
+
+    def write_register(self, id, address, value, bytelen):
+        cache = self.register_cache.setdefault(id, {})
+        if cache.get(address) == value:
+            return True
+
+        if bytelen == 1:
+            dxl_comm_result, dxl_error = self.traced('write', 1, 1, self.packetHandler.write1ByteTxRx, self.portHandler, id, address, value)
+        elif bytelen == 2:
+            dxl_comm_result, dxl_error = self.traced('write', 1, 2, self.packetHandler.write2ByteTxRx, self.portHandler, id, address, value)
+        else:
+            dxl_comm_result, dxl_error = self.traced('write', 1, 4, self.packetHandler.write4ByteTxRx, self.portHandler, id, address, value)
 
-        dxl_comm_result = groupSyncWrite.txPacket()
         if dxl_comm_result != COMM_SUCCESS:
             print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
+            # The servo state is unknown after a communication error
+            self.invalidate_cache([id])
+            return False
 
-        groupSyncWrite.clearParam()
+        if dxl_error != 0 and self.read_register(id, address, bytelen) != value:
+            # Rejected, e.g. the EEPROM area (drive mode) is locked while torque is enabled,
+            # which is only fine if the register already holds the value
+            print("%s" % self.packetHandler.getRxPacketError(dxl_error))
+            return False
 
-    def read_servo(self, ids, address, bytelen=4):
-        groupSyncRead = GroupSyncRead(self.portHandler, self.packetHandler, address, bytelen)
+        cache[address] = value
+        return True
+
+    def sync_write_register(self, ids, address, value, bytelen):
+        # Write a value to all servos that do not hold it yet, as one sync write
+        ids = [id for id in ids if self.register_cache.get(id, {}).get(address) != value]
+        if not ids:
+            return True
+
+        if address < EEPROM_SIZE:
+            # Only the status packet tells whether an EEPROM write was rejected, so these are
+            # written one by one and only cached once they took
+            return all([self.write_register(id, address, value, bytelen) for id in ids])
 
+        groupSyncWrite = GroupSyncWrite(self.portHandler, self.packetHandler, address, bytelen)
+        param = list(value.to_bytes(bytelen, 'little'))
         for id in ids:
-            groupSyncRead.addParam(id)
+            groupSyncWrite.addParam(id, param)
 
-        start_time = time.time()
-        dxl_comm_result = groupSyncRead.txRxPacket()
-        end_time = time.time()
+        dxl_comm_result = self.traced('sync_write', len(ids), bytelen * len(ids), groupSyncWrite.txPacket)
         if dxl_comm_result != COMM_SUCCESS:
             print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
+            self.invalidate_cache(ids)
+            return False
+
+        # Sync writes have no status packets, RAM registers are assumed to be written
+        for id in ids:
+            self.register_cache.setdefault(id, {})[address] = value
+        return True
+
+    def move_many_servos_profiled(self, ids, positions, durations, accelerations):
+        # Time-based profile: durations and accelerations are in ms
+        # Drive mode is in the EEPROM area, which is locked once torque is enabled
+        self.sync_write_register(ids, ADDR_DRIVE_MODE, 4, 1)         # 4 = Time-based profile
+        self.sync_write_register(ids, ADDR_TORQUE_ENABLE, 1, 1)
+
+        writer = self.sync_writer(ids, ADDR_PROFILE_ACCELERATION, PROFILE_GOAL)
+        dxl_comm_result = writer.write(zip(accelerations, durations, positions))
+        if dxl_comm_result != COMM_SUCCESS:
+            print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
+            self.invalidate_cache(ids)
+
+    def move_many_servos(self, ids, positions, durations):
+        self.move_many_servos_profiled(ids, positions, durations, [ACCELERATION_TIME]*len(ids))
+
+    def read_servo(self, ids, address, bytelen=4):
+        groupSyncRead = self.sync_read(ids, address, bytelen)
+
+        dxl_comm_result = self.read_group(groupSyncRead)
+        if dxl_comm_result != COMM_SUCCESS:
+            print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
+            self.invalidate_cache(ids)
             
+        res = np.array([groupSyncRead.getData(id, address, bytelen) for id in ids], dtype='<u%d' % bytelen)
+
+        # The values are two's complement, reinterpret them as signed
+        return res.view('<i%d' % bytelen).tolist()
+
+    def read_servos_bulk(self, reads):
+        # Read a register of every servo, which may differ per servo, in one bulk read.
+        # reads: (id, address, bytelen) per servo, at most one per id
+        groupBulkRead = self.bulk_read(reads)
+
+        dxl_comm_result = self.read_group(groupBulkRead)
+        if dxl_comm_result != COMM_SUCCESS:
+            print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
+            self.invalidate_cache([id for id, _, _ in reads])
+
         res = []
-        
-        for id in ids:
-            position = groupSyncRead.getData(id, address, bytelen)
-            if (1 << (bytelen*8-1)) & (position):  # The position is a negative number in two's complement, we make sure it's saved as negative also in Python
-                new_position = position - 2**(bytelen*8)
-                position = new_position
-            res.append(position)
+        for id, address, bytelen in reads:
+            value = groupBulkRead.getData(id, address, bytelen)
+            res.append(value - ((value >> (bytelen*8-1)) << (bytelen*8)))  # Two's complement
 
         return res
 
+    def read_state(self, ids, fields=tuple(STATE_FIELDS)):
+        # Read the given present state fields of all servos in one sync read of the register
+        # block covering them. Returns a structured array with one row per id
+        start, _, dtype = state_layout(fields)
+        return self.read_block(ids, start, dtype)
+
+    def read_block(self, ids, start, dtype):
+        # One sync read of dtype.itemsize bytes from start, as a structured array with one
+        # row per id. Servos that did not answer are left as zeros, like getData() does
+        groupSyncRead = self.sync_read(ids, start, dtype.itemsize)
+
+        dxl_comm_result = self.read_group(groupSyncRead)
+        if dxl_comm_result != COMM_SUCCESS:
+            print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
+            self.invalidate_cache(ids)
+
+        raw = np.zeros((len(ids), dtype.itemsize), dtype=np.uint8)
+        for index, id in enumerate(ids):
+            if groupSyncRead.isAvailable(id, start, dtype.itemsize):
+                raw[index] = groupSyncRead.data_dict[id]
+
+        return raw.view(dtype).reshape(len(ids))
+
+    def configure_indirect(self, ids, fields):
+        # Map the fields (of REGISTER_FIELDS) one after the other into the indirect data block
+        # of every servo, so that read_indirect() gets them all in one sync read. Servos that
+        # are mapped like this already are left alone, the others need torque disabled
+        dtype = np.dtype([(field, REGISTER_FIELDS[field][1]) for field in fields])
+        if dtype.itemsize > INDIRECT_SIZE:
+            print("Fields %s take %d bytes, the indirect data block has %d" % (list(fields), dtype.itemsize, INDIRECT_SIZE))
+            return False
+
+        addresses = []
+        for field in fields:
+            address = REGISTER_FIELDS[field][0]
+            addresses += range(address, address + dtype[field].itemsize)
+        param = struct.pack('<%dH' % len(addresses), *addresses)
+
+        groupSyncRead = self.sync_read(ids, ADDR_INDIRECT_ADDRESS, len(param))
+        for attempt in range(2):
+            dxl_comm_result = self.read_group(groupSyncRead)
+            if dxl_comm_result != COMM_SUCCESS:
+                print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
+                return False
+
+            ids_to_write = [id for id in ids if bytes(groupSyncRead.data_dict[id]) != param]
+            if not ids_to_write:
+                break
+            if attempt > 0:
+                print("Servos %s did not accept the indirect addresses, is torque disabled?" % ids_to_write)
+                return False
+
+            groupSyncWrite = GroupSyncWrite(self.portHandler, self.packetHandler, ADDR_INDIRECT_ADDRESS, len(param))
+            for id in ids_to_write:
+                groupSyncWrite.addParam(id, list(param))
+                self.indirect_layouts.pop(id, None)
+            self.traced('sync_write', len(ids_to_write), len(param) * len(ids_to_write), groupSyncWrite.txPacket)
+
+        for id in ids:
+            self.indirect_layouts[id] = dtype
+        return True
+
+    def read_indirect(self, ids):
+        # Read the fields mapped with configure_indirect() of all servos in one sync read.
+        # Returns a structured array with one row per id
+        dtype = self.indirect_layouts.get(ids[0])
+        if dtype is None or any(self.indirect_layouts.get(id) != dtype for id in ids):
+            raise ValueError("Servos %s do not share an indirect layout, see configure_indirect()" % list(ids))
+
+        return self.read_block(ids, ADDR_INDIRECT_DATA, dtype)
+
     def read_servo_positions(self, ids):
         return self.read_servo(ids, ADDR_PRESENT_POSITION)
 
@@ -94,4 +474,205 @@ class DynamixelHandler:
 
     def disable_torques(self, ids):
         for id in ids:
-            self.packetHandler.write1ByteTxRx(self.portHandler, id, ADDR_TORQUE_ENABLE, 0)
\ No newline at end of file
+            self.traced('write', 1, 1, self.packetHandler.write1ByteTxRx, self.portHandler, id, ADDR_TORQUE_ENABLE, 0)
+        # Servos may be moved, power cycled or reconfigured while limp
+        self.invalidate_cache(ids)
+
+    def reboot_servos(self, ids):
+        for id in ids:
+            dxl_comm_result, dxl_error = self.traced('reboot', 1, 0, self.packetHandler.reboot, self.portHandler, id)
+            if dxl_comm_result != COMM_SUCCESS:
+                print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
+        # A reboot resets the RAM area of the control table, including torque enable
+        self.invalidate_cache(ids)
+
+    def ping_servos(self, ids):
+        # Ids that answer at the current baud rate
+        found = []
+        for id in ids:
+            _, dxl_comm_result, _ = self.traced('ping', 1, 0, self.packetHandler.ping, self.portHandler, id)
+            if dxl_comm_result == COMM_SUCCESS:
+                found.append(id)
+        return found
+
+    def find_baudrate(self, ids):
+        # Switch the port to the baud rate at which all servos answer, None if there is none
+        for baudrate in [self.portHandler.getBaudRate()] + list(BAUD_RATES):
+            if self.portHandler.setBaudRate(baudrate) and len(self.ping_servos(ids)) == len(ids):
+                return baudrate
+        return None
+
+    def set_return_delay_times(self, ids, return_delay_times):
+        # Return delay time per servo, in units of 2 us (250 by default). It is in the EEPROM
+        # area, so torque is disabled first. Returns whether all servos took it
+        self.disable_torques(ids)
+        return all([self.write_register(id, ADDR_RETURN_DELAY_TIME, return_delay_time, 1) for id, return_delay_time in zip(ids, return_delay_times)])
+
+    def migrate_baudrate(self, ids, baudrate):
+        # Move all servos to another baud rate. The register is in the EEPROM area, so torque
+        # is disabled first. If any servo does not answer at the new baud rate, the servos that
+        # do are moved back
+        old_baudrate = self.portHandler.getBaudRate()
+        if baudrate not in BAUD_RATES:
+            print("Unsupported baud rate %d" % baudrate)
+            return False
+
+        missing = sorted(set(ids) - set(self.ping_servos(ids)))
+        if missing:
+            print("Servos %s do not answer at %d bps" % (missing, old_baudrate))
+            return False
+
+        self.disable_torques(ids)
+        for id in ids:
+            # Servos switch after sending the status packet of the write
+            dxl_comm_result, dxl_error = self.traced('write', 1, 1, self.packetHandler.write1ByteTxRx, self.portHandler, id, ADDR_BAUD_RATE, BAUD_RATES[baudrate])
+            if dxl_comm_result != COMM_SUCCESS:
+                print("%s" % self.packetHandler.getTxRxResult(dxl_comm_result))
+            elif dxl_error != 0:
+                print("%s" % self.packetHandler.getRxPacketError(dxl_error))
+        self.invalidate_cache(ids)
+
+        if not self.portHandler.setBaudRate(baudrate):
+            # The servos that took the write only listen at the new baud rate, which the port
+            # cannot send at, so they cannot be moved back from here
+            print("Failed to change the port to %d bps, servos may be left there, use find_baudrate() to locate them" % baudrate)
+            return False
+
+        found = self.ping_servos(ids)
+        if len(found) == len(ids):
+            return True
+        print("Servos %s do not answer at %d bps, rolling back" % (sorted(set(ids) - set(found)), baudrate))
+
+        for id in found:
+            self.traced('write', 1, 1, self.packetHandler.write1ByteTxRx, self.portHandler, id, ADDR_BAUD_RATE, BAUD_RATES[old_baudrate])
+        self.portHandler.setBaudRate(old_baudrate)
+        if len(self.ping_servos(ids)) != len(ids):
+            print("Not all servos are back at %d bps, use find_baudrate() to locate them" % old_baudrate)
+        return False
+
+    def measure_loop_rate(self, ids, seconds=1.0):
+        # Loops per second of a control loop: a sync read of the positions and a sync write,
+        # of the LEDs so that nothing moves
+        writer = self.sync_writer(ids, ADDR_LED, LED)
+        loops = 0
+        start_time = time.perf_counter()
+        while time.perf_counter() - start_time < seconds:
+            self.read_servo_positions(ids)
+            writer.write([(loops & 1,)] * len(ids))
+            loops += 1
+
+        return loops / (time.perf_counter() - start_time)
+
+# Latest read of a BusThread: time stamp (middle of the last bus transaction of the read), values and number of reads so far
+Snapshot = namedtuple('Snapshot', ['time_stamp', 'values', 'count'])
+
+class Command:
+    # Handle of a command queued on a BusThread. sent_time is the time the command was
+    # handed to the port, once it has been sent
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self.queued_time = time.time()
+        self.sent_time = None
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def wait(self, timeout=None):
+        # Returns sent_time, None on timeout
+        self.done.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.sent_time
+
+class BusThread:
+    # Owned-bus mode: one thread does all traffic on the port of a DynamixelHandler. It reads
+    # the servos every period and sends queued commands in between, so commands only wait
+    # for a read in progress. Readers take the latest snapshot without blocking. The read
+    # schedule and its overruns and jitter are in periodic
+    def __init__(self, handler, ids, period=0.01, read=DynamixelHandler.read_servo_positions, callback=None):
+        # read(handler, ids) gives the values of a snapshot, callback(snapshot) is called from
+        # the bus thread after every read
+        self.handler = handler
+        self.ids = ids
+        self.periodic = Periodic(period)
+        self.read = read
+        self.callback = callback
+        self.snapshot = None
+        self.commands = queue.SimpleQueue()
+        self.running = False
+        self.thread = threading.Thread(target=self.main, daemon=True)
+
+    def start(self):
+        self.running = True
+        self.periodic.restart()
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.commands.put(None)
+        self.thread.join()
+
+    def latest(self):
+        return self.snapshot
+
+    def submit(self, function, *args):
+        # Queue function(handler, *args) and return its Command
+        command = Command(function, args)
+        self.commands.put(command)
+        return command
+
+    def move_many_servos(self, ids, positions, durations):
+        return self.submit(DynamixelHandler.move_many_servos, ids, positions, durations)
+
+    def move_many_servos_profiled(self, ids, positions, durations, accelerations):
+        return self.submit(DynamixelHandler.move_many_servos_profiled, ids, positions, durations, accelerations)
+
+    def send(self, command):
+        if command is None:
+            return
+        try:
+            command.result = command.function(self.handler, *command.args)
+        except Exception as e:
+            command.error = e
+        command.sent_time = time.time()
+        command.done.set()
+
+    def main(self):
+        count = 0
+        while self.running:
+            # Commands are sent until the read is close, the rest is left to periodic.wait()
+            timeout = self.periodic.remaining() - self.periodic.spin_ns / 1e9
+            if timeout <= 0:
+                self.periodic.wait()
+                transactions = self.handler.trace.count
+                start_time = time.time()
+                values = self.read(self.handler, self.ids)
+                end_time = time.time()
+
+                # The middle of the bus transaction, without the time spent decoding it
+                time_stamp = (start_time + end_time) / 2
+                if self.handler.trace.count > transactions:
+                    time_stamp = self.handler.trace.midpoint()
+
+                count += 1
+                self.snapshot = Snapshot(time_stamp, values, count)
+                if self.callback is not None:
+                    self.callback(self.snapshot)
+
+                # Commands queued during the read are sent even if the next read is due
+                # already, so that reads slower than the period do not hold them back
+                while not self.commands.empty():
+                    self.send(self.commands.get())
+                continue
+
+            try:
+                self.send(self.commands.get(timeout=timeout))
+            except queue.Empty:
+                pass
+
+        # Commands still queued are not sent
+        while not self.commands.empty():
+            command = self.commands.get()
+            if command is not None:
+                command.done.set()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# Periodic scheduler for control and telemetry loops:
+#   periodic = Periodic(1/100)
+#   while running:
+#       periodic.wait()
+#       ...
+#   print(periodic.stats())
+import time
+
+class Periodic:
+    # Deadlines are absolute (start + k * period on the monotonic clock), so the rate does not
+    # drift with the time spent per iteration. wait() sleeps until shortly before the deadline
+    # and only spins for the rest, since sleeps can overshoot by a scheduler tick
+    def __init__(self, period, spin=0.0005):
+        self.period_ns = round(period * 1e9)
+        self.spin_ns = round(spin * 1e9)
+        # The first wait() takes a whole period
+        self.deadline = time.perf_counter_ns() + self.period_ns
+
+        self.count = 0
+        # Iterations that ended after the next deadline, and deadlines skipped because of them
+        self.overruns = 0
+        self.skipped = 0
+        # Lateness of the wake-ups in ns, without overruns
+        self.jitter_sum = 0
+        self.jitter_sum_squares = 0
+        self.jitter_max = 0
+
+    def restart(self):
+        self.deadline = time.perf_counter_ns() + self.period_ns
+
+    def remaining(self):
+        # Seconds until the next deadline, negative if it has passed
+        return (self.deadline - time.perf_counter_ns()) / 1e9
+
+    def wait(self):
+        # Wait for the next deadline and return how late the wake-up was, in seconds
+        self.count += 1
+        now = time.perf_counter_ns()
+        if now > self.deadline:
+            # Overrun: returns at once, deadlines passed by a whole period are skipped rather
+            # than run back to back
+            missed = (now - self.deadline) // self.period_ns
+            self.overruns += 1
+            self.skipped += missed
+            self.deadline += missed * self.period_ns
+            late = now - self.deadline
+            self.deadline += self.period_ns
+            return late / 1e9
+
+        if now < self.deadline - self.spin_ns:
+            time.sleep((self.deadline - self.spin_ns - now) / 1e9)
+        while now < self.deadline:
+            now = time.perf_counter_ns()
+
+        jitter = now - self.deadline
+        self.jitter_sum += jitter
+        self.jitter_sum_squares += jitter * jitter
+        self.jitter_max = max(self.jitter_max, jitter)
+
+        self.deadline += self.period_ns
+        return jitter / 1e9
+
+    def stats(self):
+        # Jitter in us
+        count = max(self.count - self.overruns, 1)
+        mean = self.jitter_sum / count
+        variance = max(self.jitter_sum_squares / count - mean * mean, 0)
+        return {
+            "count": self.count,
+            "overruns": self.overruns,
+            "skipped": self.skipped,
+            "jitter_mean": mean / 1e3,
+            "jitter_std": variance ** 0.5 / 1e3,
+            "jitter_max": self.jitter_max / 1e3,
+        }
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# Simulated Dynamixel bus for running DynamixelHandler without hardware:
+#   dynamixel_handler = DynamixelHandler(SimulatedPort([SimulatedServo(id) for id in ids]))
+# Instruction packets written to the port are parsed and answered with Protocol 2.0 status
+# packets from the control tables of the simulated servos, so the packet building and
+# parsing of the SDK is exercised as on a real bus. With realtime=True, packets also take as
+# long on the simulated line as they would at the baud rate and return delay time of the port
+# and servos, for measuring timing.
+from dynamixel_sdk import *                    # Uses Dynamixel SDK library
+from dynamixel_sdk.protocol2_packet_handler import Protocol2PacketHandler
+from collections import deque
+import struct
+import time
+
+CONTROL_TABLE_SIZE          = 1024
+ADDR_MODEL_NUMBER           = 0
+ADDR_FIRMWARE_VERSION       = 6
+ADDR_ID                     = 7
+ADDR_BAUD_RATE              = 8
+ADDR_RETURN_DELAY_TIME      = 9
+ADDR_TORQUE_ENABLE          = 64
+ADDR_GOAL_POSITION          = 116
+ADDR_PRESENT_POSITION       = 132
+ADDR_POSITION_TRAJECTORY    = 140
+ADDR_INDIRECT_ADDRESS       = 168
+ADDR_INDIRECT_DATA          = 224
+INDIRECT_SIZE               = 20
+MODEL_NUMBER                = 1020             # XM430-W350
+
+# Baud rate register values
+BAUD_RATES = {0: 9600, 1: 57600, 2: 115200, 3: 1000000, 4: 2000000, 5: 3000000, 6: 4000000, 7: 4500000}
+
+ERRNUM_INSTRUCTION          = 2
+ERRNUM_ACCESS               = 7
+
+# Only used for its CRC and byte stuffing
+protocol = Protocol2PacketHandler()
+
+class SimulatedServo:
+    # fast_read=False simulates firmware without Fast Sync Read and Fast Bulk Read, which
+    # does not answer these instructions at all
+    def __init__(self, id, fast_read=True, firmware_version=45):
+        self.id = id
+        self.fast_read = fast_read
+        self.control_table = bytearray(CONTROL_TABLE_SIZE)
+        struct.pack_into('<H', self.control_table, ADDR_MODEL_NUMBER, MODEL_NUMBER)
+        self.control_table[ADDR_FIRMWARE_VERSION] = firmware_version
+        self.control_table[ADDR_ID] = id
+        self.control_table[ADDR_BAUD_RATE] = 1
+        self.control_table[ADDR_RETURN_DELAY_TIME] = 250
+        for index in range(INDIRECT_SIZE):
+            struct.pack_into('<H', self.control_table, ADDR_INDIRECT_ADDRESS + 2*index, ADDR_INDIRECT_DATA + index)
+
+    def get(self, address, bytelen):
+        return int.from_bytes(self.control_table[address:address+bytelen], 'little', signed=True)
+
+    def set(self, address, value, bytelen):
+        self.control_table[address:address+bytelen] = (value & ((1 << (bytelen*8)) - 1)).to_bytes(bytelen, 'little')
+
+    def target(self, address):
+        # Indirect data bytes stand for the byte at their indirect address
+        if ADDR_INDIRECT_DATA <= address < ADDR_INDIRECT_DATA + INDIRECT_SIZE:
+            return struct.unpack_from('<H', self.control_table, ADDR_INDIRECT_ADDRESS + 2*(address - ADDR_INDIRECT_DATA))[0] % CONTROL_TABLE_SIZE
+        return address
+
+    def read(self, address, bytelen):
+        # Returns (error, data)
+        if address + bytelen > CONTROL_TABLE_SIZE:
+            return ERRNUM_ACCESS, b''
+        return 0, bytes(self.control_table[self.target(a)] for a in range(address, address + bytelen))
+
+    def write(self, address, data):
+        # Returns the error
+        if address + len(data) > CONTROL_TABLE_SIZE:
+            return ERRNUM_ACCESS
+        # The EEPROM area (below 64) and the indirect addresses are locked while torque is enabled
+        if self.control_table[ADDR_TORQUE_ENABLE]:
+            if address < ADDR_TORQUE_ENABLE or (address < ADDR_INDIRECT_DATA and address + len(data) > ADDR_INDIRECT_ADDRESS):
+                return ERRNUM_ACCESS
+
+        for a, value in zip(range(address, address + len(data)), data):
+            self.control_table[self.target(a)] = value
+
+        # Goal positions are reached immediately
+        if address <= ADDR_GOAL_POSITION < address + len(data):
+            position = self.control_table[ADDR_GOAL_POSITION:ADDR_GOAL_POSITION+4]
+            self.control_table[ADDR_PRESENT_POSITION:ADDR_PRESENT_POSITION+4] = position
+            self.control_table[ADDR_POSITION_TRAJECTORY:ADDR_POSITION_TRAJECTORY+4] = position
+        return 0
+
+    def return_delay(self):
+        # In seconds, the register is in units of 2 us
+        return self.control_table[ADDR_RETURN_DELAY_TIME] * 2e-6
+
+    def baudrate(self):
+        return BAUD_RATES.get(self.control_table[ADDR_BAUD_RATE])
+
+    def reboot(self):
+        self.control_table[ADDR_TORQUE_ENABLE] = 0
+
+class SimulatedPort(PortHandler):
+    def __init__(self, servos, port_name='simulated', realtime=False):
+        super().__init__(port_name)
+        self.servos = {servo.id: servo for servo in servos}
+        self.rx = bytearray()
+        self.realtime = realtime
+        # Status packets still on the line, as (time they are received, packet)
+        self.pending = deque()
+        # Time the line is free again
+        self.line_time = 0.0
+        # Raw instruction packets written to the port
+        self.tx_log = []
+
+    def servo(self, id):
+        # Servos only see packets sent at their baud rate
+        servo = self.servos.get(id)
+        if servo is None or servo.baudrate() != self.baudrate:
+            return None
+        return servo
+
+    def openPort(self):
+        return self.setBaudRate(self.baudrate)
+
+    def closePort(self):
+        self.is_open = False
+
+    def clearPort(self):
+        self.rx.clear()
+        self.pending.clear()
+
+    def setBaudRate(self, baudrate):
+        if self.getCFlagBaud(baudrate) <= 0:
+            return False
+        self.baudrate = baudrate
+        self.is_open = True
+        self.tx_time_per_byte = (1000.0 / self.baudrate) * 10.0
+        return True
+
+    def byte_time(self):
+        # Start bit, 8 data bits and stop bit
+        return 10.0 / self.baudrate
+
+    def receive(self):
+        now = time.perf_counter()
+        while self.pending and self.pending[0][0] <= now:
+            self.rx += self.pending.popleft()[1]
+
+    def getBytesAvailable(self):
+        self.receive()
+        return len(self.rx)
+
+    def readPort(self, length):
+        self.receive()
+        if not self.rx:
+            # Like the system call of a serial port read, lets other threads run
+            time.sleep(0)
+        data = bytes(self.rx[:length])
+        del self.rx[:length]
+        return data
+
+    def writePort(self, packet):
+        packet = list(packet)
+        self.tx_log.append(bytes(packet))
+        sent_time = max(self.line_time, time.perf_counter()) + len(packet) * self.byte_time()
+        self.line_time = sent_time
+        self.handle_instruction(packet)
+        if self.realtime:
+            # Returns once the packet is sent, so that status timeouts start after it
+            time.sleep(max(0.0, sent_time - time.perf_counter()))
+        return len(packet)
+
+    def respond(self, id, packet):
+        if not self.realtime:
+            self.rx += packet
+            return
+        self.line_time += self.servos[id].return_delay() + len(packet) * self.byte_time()
+        self.pending.append((self.line_time, packet))
+
+    def status(self, id, error, data):
+        # Status packet of one servo, byte stuffed like the instruction packets
+        packet = [0xFF, 0xFF, 0xFD, 0x00, id, 0, 0, INST_STATUS, error] + list(data) + [0, 0]
+        packet[5:7] = struct.pack('<H', len(packet) - 7)
+        packet = protocol.addStuffing(packet)
+        length = struct.unpack_from('<H', bytes(packet[5:7]))[0] + 7
+        crc = protocol.updateCRC(0, packet, length - 2)
+        packet[length-2:length] = struct.pack('<H', crc)
+        self.respond(id, bytes(packet[:length]))
+
+    def fast_status(self, reads):
+        # One status packet for all servos of a Fast Sync/Bulk Read: [error, id, data, crc]
+        # per servo, where each crc covers the packet up to it as each servo appends its part
+        # in turn. Nothing is sent if any servo does not support it
+        if not all(self.servo(id) and self.servo(id).fast_read for id, _, _ in reads):
+            return
+        packet = [0xFF, 0xFF, 0xFD, 0x00, BROADCAST_ID, 0, 0, INST_STATUS]
+        length = 1 + sum(4 + bytelen for _, _, bytelen in reads) + 2
+        packet[5:7] = struct.pack('<H', length)
+        for id, address, bytelen in reads:
+            error, data = self.servo(id).read(address, bytelen)
+            packet += [error, id] + list(data.ljust(bytelen, b'\0'))
+            packet += struct.pack('<H', protocol.updateCRC(0, packet, len(packet)))
+        packet += struct.pack('<H', protocol.updateCRC(0, packet, len(packet)))
+        self.respond(reads[0][0], bytes(packet))
+
+    def handle_instruction(self, packet):
+        if len(packet) < 10 or packet[:4] != [0xFF, 0xFF, 0xFD, 0x00]:
+            return
+        length = packet[PKT_LENGTH_L] | (packet[PKT_LENGTH_H] << 8)
+        if len(packet) != length + 7:
+            return
+        if protocol.updateCRC(0, packet, length + 5) != packet[length+5] | (packet[length+6] << 8):
+            return
+
+        packet = protocol.removeStuffing(packet)
+        length = packet[PKT_LENGTH_L] | (packet[PKT_LENGTH_H] << 8)
+        id = packet[PKT_ID]
+        instruction = packet[PKT_INSTRUCTION]
+        param = bytes(packet[PKT_INSTRUCTION+1:PKT_INSTRUCTION+length-2])
+
+        if id == BROADCAST_ID:
+            self.handle_broadcast(instruction, param)
+            return
+
+        servo = self.servo(id)
+        if servo is None:
+            return
+
+        if instruction == INST_PING:
+            self.status(id, 0, servo.control_table[ADDR_MODEL_NUMBER:ADDR_MODEL_NUMBER+2] + servo.control_table[ADDR_FIRMWARE_VERSION:ADDR_FIRMWARE_VERSION+1])
+        elif instruction == INST_READ and len(param) == 4:
+            address, bytelen = struct.unpack('<HH', param)
+            self.status(id, *servo.read(address, bytelen))
+        elif instruction == INST_WRITE and len(param) > 2:
+            address, = struct.unpack_from('<H', param)
+            self.status(id, servo.write(address, param[2:]), b'')
+        elif instruction == INST_REBOOT:
+            servo.reboot()
+            self.status(id, 0, b'')
+        else:
+            self.status(id, ERRNUM_INSTRUCTION, b'')
+
+    def handle_broadcast(self, instruction, param):
+        if instruction in (INST_SYNC_READ, INST_FAST_SYNC_READ, INST_SYNC_WRITE):
+            address, bytelen = struct.unpack_from('<HH', param)
+            param = param[4:]
+
+        if instruction == INST_SYNC_READ:
+            # Servos answer one by one, in the order of the instruction
+            for id in param:
+                if self.servo(id):
+                    self.status(id, *self.servo(id).read(address, bytelen))
+        elif instruction == INST_FAST_SYNC_READ:
+            self.fast_status([(id, address, bytelen) for id in param])
+        elif instruction in (INST_BULK_READ, INST_FAST_BULK_READ):
+            reads = [struct.unpack_from('<BHH', param, offset) for offset in range(0, len(param), 5)]
+            if instruction == INST_BULK_READ:
+                for id, address, bytelen in reads:
+                    if self.servo(id):
+                        self.status(id, *self.servo(id).read(address, bytelen))
+            else:
+                self.fast_status(reads)
+        elif instruction == INST_SYNC_WRITE:
+            for offset in range(0, len(param), 1 + bytelen):
+                servo = self.servo(param[offset])
+                if servo is not None:
+                    servo.write(address, param[offset+1:offset+1+bytelen])
+        elif instruction == INST_BULK_WRITE:
+            offset = 0
+            while offset + 5 <= len(param):
+                id, address, bytelen = struct.unpack_from('<BHH', param, offset)
+                servo = self.servo(id)
+                if servo is not None:
+                    servo.write(address, param[offset+5:offset+5+bytelen])
+                offset += 5 + bytelen
@@ -1,6 +1,7 @@
 from helper_functions import *
-import threading
-import json
+from telemetry import Telemetry
+from telemetry_log import TelemetryLog
+from tracking import analyse, print_results
 
 BR_INNER_SHOULDER = 1
 BR_OUTER_SHOULDER = 2
@@ -39,11 +40,18 @@ all_ids = back_right_ids + back_left_ids + front_right_ids + front_left_ids
 dynamixel_handler = DynamixelHandler()
 trajectory = []
 
-# Contains tuples of (time command was sent, commanded position, duration)
-motor_commands_history = [[] for _ in range(13)]
+# Written to disk while running, convert to standup_data.json with
+#   python3 telemetry_log.py standup_positions.tlog --commands standup_commands.tlog
+# Time command was sent, commanded position, duration and acceleration time, per servo
+motor_commands_history = TelemetryLog('standup_commands.tlog', all_ids, {'position': '<i4', 'duration': '<u4', 'acceleration': '<u4'}, names=motor_dict, block_size=1)
 
-# Contains tuples (time stamp, position)
-motor_positions_history = [[] for _ in range(13)]
+# Time stamp and position, per servo
+motor_positions_history = TelemetryLog('standup_positions.tlog', all_ids, {'position': '<i4'}, names=motor_dict)
+
+# The commands and the last minute of positions are kept in memory as well, for the tracking
+# analysis at the end
+recent_commands = Telemetry(all_ids, {'position': '<i4', 'duration': '<u4', 'acceleration': '<u4'}, chunk_size=100, ring=False)
+recent_positions = Telemetry(all_ids, {'position': '<i4'}, chunk_size=6000)
 
 print(dynamixel_handler.read_servo_positions(all_ids))
 
@@ -56,49 +64,33 @@ positions = [pos_1, pos_2, pos_3, pos_4]
 
 duration = 1000
 
-finished = False
-
-mutex = threading.Lock()
-
-def read_motors():
-    freq = 100
-
-    while not finished:
-        start_time = time.time()
-
-        with mutex:
-            start_read_time = time.time()
-            positions = dynamixel_handler.read_servo_positions(all_ids)
-            end_read_time = time.time()
-
-        # Takes around 6ms to read motors. Take time stamp as the average between start and end of reading. 
-        time_stamp = (end_read_time+start_read_time)/2
-        for i in range(12):
-            motor_positions_history[i+1].append((time_stamp, positions[i]))
-
-        while time.time() - start_time < 1/freq:
-            pass
+def log_positions(snapshot):
+    # The time stamp is the middle of the sync read, see dynamixel_handler.trace.stats()
+    motor_positions_history.append(snapshot.time_stamp, {'position': snapshot.values})
+    recent_positions.append(snapshot.time_stamp, {'position': snapshot.values})
 
-read_motors_thread = threading.Thread(target=read_motors)
-read_motors_thread.start()
+# All bus traffic from here on goes through the bus thread, reading at 100 Hz
+bus = BusThread(dynamixel_handler, all_ids, period=1/100, callback=log_positions)
+bus.start()
 
 for pos in positions:
-    with mutex: 
-        current_time = time.time()
-        dynamixel_handler.move_many_servos(all_ids, pos, [duration]*12)
-    for id in all_ids:
-        motor_commands_history[id].append((current_time, pos[id-1], duration))
+    command = bus.move_many_servos(all_ids, pos, [duration]*12)
+    sent_time = command.wait()
+    command_sample = {'position': pos, 'duration': duration, 'acceleration': ACCELERATION_TIME}
+    motor_commands_history.append(sent_time, command_sample)
+    recent_commands.append(sent_time, command_sample)
     time.sleep(duration/1000)
 
-finished = True
-read_motors_thread.join()
+bus.stop()
+print("Reads: %s" % bus.periodic.stats())
+for operation, stats in dynamixel_handler.trace.stats().items():
+    print("%s: %s" % (operation, stats))
 
-motor_data = {}
-for i in range(12):
-    motor_data[motor_dict[i+1]] = {
-        "Position History": motor_positions_history[i+1],
-        "Command History": motor_commands_history[i+1]
-    }
+# The bus thread has stopped, so the windows are complete
+time_stamps, columns = recent_positions.window()
+command_times, commands = recent_commands.window()
+print_results(analyse(time_stamps, columns['position'], command_times, commands['position'], commands['duration'], commands['acceleration']), [motor_dict[id] for id in all_ids])
 
-with open('standup_data.json', 'w') as file:
-    json.dump(motor_data, file, indent=4)
\ No newline at end of file
+motor_commands_history.close()
+motor_positions_history.close()
+print("Logged %d positions and %d commands" % (len(motor_positions_history), len(motor_commands_history)))
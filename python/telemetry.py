@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# Telemetry history in preallocated NumPy arrays:
+#   telemetry = Telemetry(ids, {'position': '<i4'}, chunk_size=60000)   # last 10 min at 100 Hz
+#   telemetry.append(time_stamp, {'position': positions})
+#   time_stamps, columns = telemetry.window(time.time() - 1.0)           # the last second
+#   columns['position'][:, telemetry.index[id]]
+import numpy as np
+
+class Telemetry:
+    # One time stamp column and, per field, an array with one column per servo. Samples are
+    # appended as whole rows into chunks of chunk_size rows. With ring=True there is only one
+    # chunk and the oldest rows are overwritten, so memory stays fixed. Otherwise another
+    # chunk is allocated when the last one is full. Time stamps must not decrease
+    __slots__ = ('ids', 'index', 'dtypes', 'chunk_size', 'ring', 'chunks', 'position', 'size')
+
+    def __init__(self, ids, fields, chunk_size=60000, ring=True):
+        # fields: {field name: dtype}
+        self.ids = list(ids)
+        self.index = {id: index for index, id in enumerate(self.ids)}
+        self.dtypes = {field: np.dtype(dtype) for field, dtype in fields.items()}
+        self.chunk_size = chunk_size
+        self.ring = ring
+        self.chunks = [self.new_chunk()]
+        # Next row in the last chunk, and number of rows kept
+        self.position = 0
+        self.size = 0
+
+    def new_chunk(self):
+        time_stamps = np.zeros(self.chunk_size, dtype=np.float64)
+        columns = {field: np.zeros((self.chunk_size, len(self.ids)), dtype=dtype) for field, dtype in self.dtypes.items()}
+        return time_stamps, columns
+
+    def __len__(self):
+        return self.size
+
+    def nbytes(self):
+        return sum(time_stamps.nbytes + sum(column.nbytes for column in columns.values()) for time_stamps, columns in self.chunks)
+
+    def clear(self):
+        del self.chunks[1:]
+        self.position = 0
+        self.size = 0
+
+    def append(self, time_stamp, sample):
+        # sample: {field: value per servo, in the order of ids}, or a structured array with a
+        # row per servo such as read_state() returns
+        if self.position == self.chunk_size:
+            if not self.ring:
+                self.chunks.append(self.new_chunk())
+            self.position = 0
+
+        time_stamps, columns = self.chunks[-1]
+        time_stamps[self.position] = time_stamp
+        for field, column in columns.items():
+            column[self.position] = sample[field]
+        self.position += 1
+
+        if not self.ring or self.size < self.chunk_size:
+            self.size += 1
+
+    def segments(self):
+        # (time stamps, columns) views of the kept rows, oldest first
+        if self.ring:
+            time_stamps, columns = self.chunks[0]
+            parts = [(0, self.position)]
+            if self.size == self.chunk_size:
+                parts.insert(0, (self.position, self.chunk_size))
+            return [(time_stamps[start:end], {field: column[start:end] for field, column in columns.items()}) for start, end in parts]
+
+        segments = list(self.chunks[:-1])
+        time_stamps, columns = self.chunks[-1]
+        segments.append((time_stamps[:self.position], {field: column[:self.position] for field, column in columns.items()}))
+        return segments
+
+    def window(self, start_time=-np.inf, end_time=np.inf, fields=None):
+        # Rows with start_time <= time stamp <= end_time, as a time stamp array and
+        # {field: array with one row per sample and one column per servo}, of all fields
+        # or the given ones
+        fields = list(self.dtypes) if fields is None else fields
+        time_stamps = []
+        columns = {field: [] for field in fields}
+        for segment_time_stamps, segment_columns in self.segments():
+            start = np.searchsorted(segment_time_stamps, start_time, 'left')
+            end = np.searchsorted(segment_time_stamps, end_time, 'right')
+            if start < end:
+                time_stamps.append(segment_time_stamps[start:end])
+                for field in fields:
+                    columns[field].append(segment_columns[field][start:end])
+
+        if not time_stamps:
+            return np.zeros(0), {field: np.zeros((0, len(self.ids)), dtype=self.dtypes[field]) for field in fields}
+        return np.concatenate(time_stamps), {field: np.concatenate(parts) for field, parts in columns.items()}
+
+    def column(self, id, field, start_time=-np.inf, end_time=np.inf):
+        # Time stamps and values of one field of one servo
+        time_stamps, columns = self.window(start_time, end_time, [field])
+        return time_stamps, columns[field][:, self.index[id]]
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# Append-only binary telemetry log, written while a run is in progress:
+#   log = TelemetryLog('positions.tlog', ids, {'position': '<i4'}, names=motor_dict)
+#   log.append(time_stamp, {'position': positions})
+#   log.close()
+# and read back by memory mapping, without parsing:
+#   log = read_log('positions.tlog')
+#   log.records['position'][:, log.index[id]]
+# Converting a position log and a command log to the JSON layout of standup_data.json:
+#   python3 telemetry_log.py positions.tlog --commands commands.tlog -o standup_data.json
+#
+# File layout: MAGIC, the length of the header as <u4, the header as JSON (ids, names and
+# {field: dtype}), padding to a multiple of 8 bytes, then one fixed-width record per sample:
+# the time stamp as <f8 followed by each field with one value per servo, in header order.
+# Records are written in blocks, so a crash loses at most the last block, and a partly
+# written record at the end is ignored by the reader.
+import numpy as np
+import argparse
+import struct
+import json
+import os
+
+MAGIC = b'CPSTLOG1'
+HEADER_LENGTH = struct.Struct('<I')
+ALIGNMENT = 8
+
+def record_dtype(ids, fields):
+    # fields: {field name: dtype}, values in little endian unless given otherwise
+    return np.dtype([('time_stamp', '<f8')] + [(field, np.dtype(dtype).newbyteorder('<'), (len(ids),)) for field, dtype in fields.items()])
+
+class TelemetryLog:
+    # Samples are copied into a preallocated block of records, which is written to the
+    # file as it is when full, so appending does not allocate
+    def __init__(self, path, ids, fields, names=None, block_size=100):
+        # names: {id: name}, kept in the header for the converter
+        self.ids = list(ids)
+        self.index = {id: index for index, id in enumerate(self.ids)}
+        self.dtype = record_dtype(self.ids, fields)
+        self.block = np.zeros(block_size, dtype=self.dtype)
+        self.position = 0
+        self.count = 0
+
+        header = {
+            "ids": self.ids,
+            "names": [names[id] for id in self.ids] if names is not None else None,
+            "fields": {field: self.dtype[field].base.str for field in fields},
+        }
+        header = json.dumps(header).encode()
+        size = len(MAGIC) + HEADER_LENGTH.size + len(header)
+        header += b' ' * (-size % ALIGNMENT)
+
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC + HEADER_LENGTH.pack(len(header)) + header)
+        self.file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def append(self, time_stamp, sample):
+        # sample: {field: value per servo, in the order of ids}, or a structured array with a
+        # row per servo such as read_state() returns
+        record = self.block[self.position]
+        record['time_stamp'] = time_stamp
+        for field in self.dtype.names[1:]:
+            record[field] = sample[field]
+        self.position += 1
+        self.count += 1
+        if self.position == len(self.block):
+            self.flush()
+
+    def flush(self):
+        # Writes the records of the current block
+        if self.position:
+            self.file.write(self.block[:self.position].data)
+            self.file.flush()
+            self.position = 0
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+class LogReader:
+    # Records of a log memory mapped as a structured array: records['time_stamp'] and
+    # records[field], with one column per servo
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            magic = file.read(len(MAGIC))
+            if magic != MAGIC:
+                raise ValueError("%s is not a telemetry log" % path)
+            length, = HEADER_LENGTH.unpack(file.read(HEADER_LENGTH.size))
+            header = json.loads(file.read(length))
+
+        self.path = path
+        self.ids = header["ids"]
+        self.index = {id: index for index, id in enumerate(self.ids)}
+        names = header["names"] or [str(id) for id in self.ids]
+        self.names = dict(zip(self.ids, names))
+        self.fields = header["fields"]
+        self.dtype = record_dtype(self.ids, self.fields)
+
+        offset = len(MAGIC) + HEADER_LENGTH.size + length
+        count = (os.path.getsize(path) - offset) // self.dtype.itemsize
+        if count:
+            self.records = np.memmap(path, dtype=self.dtype, mode='r', offset=offset, shape=(count,))
+        else:
+            # mmap cannot map an empty range
+            self.records = np.zeros(0, dtype=self.dtype)
+
+    def __len__(self):
+        return len(self.records)
+
+    def window(self, start_time=-np.inf, end_time=np.inf):
+        # Records with start_time <= time stamp <= end_time, time stamps must not decrease
+        time_stamps = self.records['time_stamp']
+        start = np.searchsorted(time_stamps, start_time, 'left')
+        end = np.searchsorted(time_stamps, end_time, 'right')
+        return self.records[start:end]
+
+    def column(self, id, field, start_time=-np.inf, end_time=np.inf):
+        # Time stamps and values of one field of one servo
+        records = self.window(start_time, end_time)
+        return records['time_stamp'], records[field][:, self.index[id]]
+
+def read_log(path):
+    return LogReader(path)
+
+def to_motor_data(positions, commands=None):
+    # The layout of standup_data.json: per servo name, "Position History" as
+    # [time, position] and "Command History" as [time, position, duration]
+    motor_data = {}
+    for id in sorted(positions.ids):
+        time_stamps, values = positions.column(id, 'position')
+        history = {"Position History": list(zip(time_stamps.tolist(), values.tolist()))}
+        if commands is not None and id in commands.index:
+            command_times, command_positions = commands.column(id, 'position')
+            _, durations = commands.column(id, 'duration')
+            history["Command History"] = list(zip(command_times.tolist(), command_positions.tolist(), durations.tolist()))
+        motor_data[positions.names[id]] = history
+    return motor_data
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert telemetry logs to the JSON layout of standup_data.json")
+    parser.add_argument('positions', help="log with a position field")
+    parser.add_argument('--commands', help="log with position and duration fields")
+    parser.add_argument('-o', '--output', default='standup_data.json')
+    args = parser.parse_args()
+
+    positions = read_log(args.positions)
+    commands = read_log(args.commands) if args.commands else None
+    with open(args.output, 'w') as file:
+        json.dump(to_motor_data(positions, commands), file, indent=4)
+    print("%d samples written to %s" % (len(positions), args.output))
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# Compares commanded against actual motion of a recorded run:
+#   python3 tracking.py standup_positions.tlog standup_commands.tlog
+#   python3 tracking.py --json standup_data.json
+# The commands are (time, goal position, duration), with time-based profiles as sent by
+# move_many_servos_profiled(): the servo accelerates for the acceleration time, moves at a
+# constant velocity and decelerates for the acceleration time, reaching the goal after
+# the duration. The reference position of this profile is rebuilt for every servo and
+# sample, and the tracking error, lag and settling times are computed for all servos at
+# once.
+from helper_functions import ACCELERATION_TIME
+from telemetry_log import read_log
+import numpy as np
+import argparse
+import json
+
+def profile(t, start, goal, acceleration_time, duration):
+    # Position and velocity of a time-based trapezoidal profile, t seconds after it was
+    # commanded. All arguments are broadcast, times are in seconds. The acceleration time is
+    # at most half the duration, giving a triangular profile
+    acceleration_time = np.minimum(acceleration_time, duration / 2)
+    t = np.clip(t, 0, duration)
+    # Peak velocity, and the acceleration with a guard against zero acceleration times
+    velocity = (goal - start) / np.maximum(duration - acceleration_time, 1e-9)
+    acceleration = velocity / np.maximum(acceleration_time, 1e-9)
+    # Constant velocity, less what is missing while accelerating and past the start of the
+    # deceleration, without branching per sample
+    accelerating = np.maximum(acceleration_time - t, 0)
+    decelerating = np.maximum(t - (duration - acceleration_time), 0)
+    position = start + velocity * (t - acceleration_time / 2) + acceleration / 2 * (accelerating * accelerating - decelerating * decelerating)
+    velocity = velocity - acceleration * (accelerating + decelerating)
+    # The goal is reached once the duration has passed, at once for a duration of 0
+    finished = t >= duration
+    position = np.where(finished, goal, position)
+    velocity = np.where(finished, 0.0, velocity)
+    return position, velocity
+
+def reference(time_stamps, positions, command_times, goals, durations, accelerations):
+    # time_stamps (N,) and positions (N, servos) of the samples, command_times (K,) and goals,
+    # durations and accelerations (K, servos) of the commands, durations and accelerations in
+    # ms. Returns the reference positions and velocities (N, servos), NaN before the first
+    # command, and the index of the command active at each sample (N,), -1 before it
+    positions = np.asarray(positions, dtype=np.float64)
+    goals = np.asarray(goals, dtype=np.float64)
+    durations = np.broadcast_to(np.asarray(durations, dtype=np.float64) / 1000, goals.shape)
+    accelerations = np.broadcast_to(np.asarray(accelerations, dtype=np.float64) / 1000, goals.shape)
+
+    if not len(command_times):
+        nothing = np.full(positions.shape, np.nan)
+        return nothing, nothing, np.full(len(time_stamps), -1)
+
+    # Each profile starts from where the previous one was when it was commanded, the first
+    # from the last sample before it. One step per command, vectorized over the servos
+    starts = np.empty_like(goals)
+    first = max(np.searchsorted(time_stamps, command_times[0], 'right') - 1, 0)
+    starts[0] = positions[first]
+    for k in range(1, len(command_times)):
+        starts[k], _ = profile(command_times[k] - command_times[k-1], starts[k-1], goals[k-1], accelerations[k-1], durations[k-1])
+
+    active = np.searchsorted(command_times, time_stamps, 'right') - 1
+    k = np.maximum(active, 0)
+    position, velocity = profile((time_stamps - command_times[k])[:, None], starts[k], goals[k], accelerations[k], durations[k])
+    before = (active < 0)[:, None]
+    return np.where(before, np.nan, position), np.where(before, np.nan, velocity), active
+
+def settling_times(time_stamps, positions, command_times, goals, tolerance):
+    # Seconds from each command until the servo stays within tolerance of its goal, as
+    # (K, servos), NaN if it is not within tolerance by the next command or the end
+    positions = np.asarray(positions, dtype=np.float64)
+    goals = np.asarray(goals, dtype=np.float64)
+    if not len(command_times):
+        return np.zeros(goals.shape)
+    count = len(time_stamps)
+    starts = np.searchsorted(time_stamps, command_times, 'left')
+    ends = np.append(starts[1:], count)
+
+    active = np.searchsorted(command_times, time_stamps, 'right') - 1
+    outside = np.abs(positions - goals[np.maximum(active, 0)]) > tolerance
+    # Index of the last sample outside the tolerance of each command, -1 if there is none
+    index = np.where(outside, np.arange(count)[:, None], -1)
+    empty = starts >= ends
+    last_outside = np.full(goals.shape, -1)
+    if count and not empty.all():
+        last_outside[~empty] = np.maximum.reduceat(index, starts[~empty], axis=0)
+    settled = np.maximum(last_outside + 1, starts[:, None])
+
+    result = np.full(goals.shape, np.nan)
+    done = (settled < ends[:, None]) & ~empty[:, None]
+    result[done] = time_stamps[settled[done]] - np.broadcast_to(command_times[:, None], goals.shape)[done]
+    return result
+
+def analyse(time_stamps, positions, command_times, goals, durations, accelerations=ACCELERATION_TIME, tolerance=20):
+    # Positions and tolerance in position units. Returns the reference and error (N, servos),
+    # and per servo the RMS and largest error, and the lag in seconds: the delay that best
+    # explains the error as error = -lag * reference velocity, in the least squares sense.
+    # Settling times are per command and servo
+    time_stamps = np.asarray(time_stamps, dtype=np.float64)
+    command_times = np.asarray(command_times, dtype=np.float64)
+    positions = np.asarray(positions, dtype=np.float64)
+    position, velocity, active = reference(time_stamps, positions, command_times, goals, durations, accelerations)
+
+    error = positions - position
+    tracked = active >= 0
+    tracked_error = error[tracked]
+    tracked_velocity = velocity[tracked]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rms_error = np.sqrt(np.sum(tracked_error**2, axis=0) / len(tracked_error))
+        lag = -np.sum(tracked_error * tracked_velocity, axis=0) / np.sum(tracked_velocity**2, axis=0)
+    max_error = np.max(np.abs(tracked_error), axis=0, initial=0.0)
+
+    return {
+        "reference": position,
+        "error": error,
+        "rms_error": rms_error,
+        "max_error": max_error,
+        "lag": lag,
+        "settling_time": settling_times(time_stamps, positions, command_times, goals, tolerance),
+    }
+
+def load_logs(positions_path, commands_path):
+    # Arrays of a run recorded with TelemetryLog, and the servo names
+    positions = read_log(positions_path)
+    commands = read_log(commands_path)
+    if commands.ids != positions.ids:
+        raise ValueError("%s and %s have different servos" % (positions_path, commands_path))
+    accelerations = commands.records['acceleration'] if 'acceleration' in commands.fields else ACCELERATION_TIME
+    run = {
+        "time_stamps": positions.records['time_stamp'],
+        "positions": positions.records['position'],
+        "command_times": commands.records['time_stamp'],
+        "goals": commands.records['position'],
+        "durations": commands.records['duration'],
+        "accelerations": accelerations,
+    }
+    return run, [positions.names[id] for id in positions.ids]
+
+def load_json(path):
+    # Arrays of a run in the layout of standup_data.json, which has the same time stamps
+    # for all servos
+    with open(path) as file:
+        motor_data = json.load(file)
+    names = list(motor_data)
+    positions = [np.array(motor_data[name]["Position History"], dtype=np.float64).reshape(-1, 2) for name in names]
+    commands = [np.array(motor_data[name]["Command History"], dtype=np.float64).reshape(-1, 3) for name in names]
+    run = {
+        "time_stamps": positions[0][:, 0],
+        "positions": np.stack([history[:, 1] for history in positions], axis=1),
+        "command_times": commands[0][:, 0],
+        "goals": np.stack([history[:, 1] for history in commands], axis=1),
+        "durations": np.stack([history[:, 2] for history in commands], axis=1),
+        "accelerations": ACCELERATION_TIME,
+    }
+    return run, names
+
+def print_results(result, names):
+    # Table of the results of analyse(), one row per servo name
+    print("%-20s %10s %10s %10s %12s" % ("servo", "rms error", "max error", "lag [ms]", "settling [ms]"))
+    for index, name in enumerate(names):
+        # Longest settling time, NaN if the servo did not settle after some command
+        settling = np.max(result["settling_time"][:, index], initial=0.0)
+        print("%-20s %10.1f %10.1f %10.1f %12.1f" % (name, result["rms_error"][index], result["max_error"][index], result["lag"][index] * 1000, settling * 1000))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Tracking error, lag and settling time of a recorded run")
+    parser.add_argument('positions', nargs='?', help="position log")
+    parser.add_argument('commands', nargs='?', help="command log")
+    parser.add_argument('--json', help="standup_data.json instead of logs")
+    parser.add_argument('--tolerance', type=float, default=20, help="of the settling time, in position units (default: %(default)s)")
+    args = parser.parse_args()
+
+    if args.json:
+        run, names = load_json(args.json)
+    elif args.positions and args.commands:
+        run, names = load_logs(args.positions, args.commands)
+    else:
+        parser.error("give a position and a command log, or --json")
+
+    print_results(analyse(tolerance=args.tolerance, **run), names)